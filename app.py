@@ -5,21 +5,22 @@ import os
 import argparse
 import time
 
+from contextlib import ExitStack
 from pathlib import Path
+from typing import Optional, List
 
 from fastapi import FastAPI
-from langchain import ConversationChain, PromptTemplate
-from langchain.chains import RetrievalQAWithSourcesChain
-from langchain.document_loaders import PyPDFLoader
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from langchain import PromptTemplate
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.embeddings import OpenAIEmbeddings
 from langchain.memory import ConversationBufferMemory, ChatMessageHistory, ConversationSummaryBufferMemory
 from langchain.output_parsers import pydantic
 
-from langchain.vectorstores import FAISS
 from aiogram import Bot, Dispatcher, types
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.utils import executor
-from langchain.prompts import SystemMessagePromptTemplate, HumanMessagePromptTemplate, ChatPromptTemplate
 from openai.error import RateLimitError
 from pydantic import ValidationError
 from tenacity import (
@@ -30,56 +31,126 @@ from tenacity import (
 from langchain.schema import messages_from_dict, messages_to_dict
 from starlette import status
 
-from sql_writer import SQLHistoryWriter
+from async_sql_writer import AsyncSQLHistoryWriter
+from memory_session import MemorySessionManager
+from llm_executor import LLMExecutor, ExecutorBusyError
+from chains import ChainRegistry
+from context_builder import ContextBuilder
+from summarizer import SummaryWorker
+from index_store import LazyVectorStore, INDEX_DIR
+from embedding_cache import CachedEmbeddings
+from streaming import stream_answer
+from quota import QuotaCounter, SQLQuotaStore
+from history_queue import HistoryQueue
+from profile_cache import ProfileCache
 from data import Message, Start
 from config import DEFAULT_TEMPLATE, Prompt, WELCOME_MESSAGE, DATA_STRUCTURE, PREMIUM_MESSAGE, LIMIT_MESSAGE, \
-    ERROR_MESSAGE, PREMIUM_TEMPLATE, BASIC_TEMPLATE
-from utils import load_roles_from_file, load_user_roles, save_user_roles
+    ERROR_MESSAGE, BUSY_MESSAGE
+from utils import load_roles_from_file, load_user_roles, save_user_roles, index_roles
 from langchain.chat_models import ChatOpenAI
 
 os.environ['SQL_CONFIG_PATH'] = 'config/sql_config_prod.json'
 
 DATABASE_DIR = Path(__file__).parent / "database"
 ROLES_FILE = "config/roles.json"
+EMBEDDING_CACHE_DIR = "embedding_cache"
 USER_ROLES_FILE = "user_roles.json"
+HISTORY_SPOOL_FILE = DATABASE_DIR / "history_spool.ndjson"
 
 START_ENDPOINT = "/api/start"
 MESSAGE_ENDPOINT = "/api/message"
+MESSAGE_STREAM_ENDPOINT = "/api/message/stream"
 CHANGE_PROMPT_ENDPOINT = "/api/change_prompt"
 DELETE_ENDPOINT = "/api/delete_user_history"
 PREMIUM_ENDPOINT = "/api/premium_mode"
 BASIC_ENDPOINT = "/api/basic_mode"
-HISTORY_WRITER = SQLHistoryWriter.from_config(Path(os.environ.get('SQL_CONFIG_PATH')))
+STATS_ENDPOINT = "/api/stats"
+HISTORY_WRITER = AsyncSQLHistoryWriter.from_config(Path(os.environ.get('SQL_CONFIG_PATH')))
+# Message counts of the free quota, kept in memory and added to the database in the background
+QUOTA = QuotaCounter(SQLQuotaStore(HISTORY_WRITER))
+# ConversationHistory rows, inserted in batches and spooled to a file while the database is down
+HISTORY_QUEUE = HistoryQueue(HISTORY_WRITER, HISTORY_SPOOL_FILE)
+# Subscriptions of recent users, invalidated by the endpoints changing them
+PROFILE_CACHE = ProfileCache(
+    max_size=int(os.environ.get("PROFILE_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("PROFILE_CACHE_TTL", 300)),
+)
 
 app = FastAPI()
 
+
+@app.on_event("startup")
+async def on_startup():
+    await HISTORY_WRITER.open()
+    VECTOR_STORE.load_in_background()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await QUOTA.close()
+    await SUMMARIES.close()
+    await HISTORY_QUEUE.close()
+    await HISTORY_WRITER.close()
+    LLM_EXECUTOR.shutdown()
+
+
 model_type_kwargs = {"stop": ["\nUser:"]}
 
-LLM = ChatOpenAI(model_name="gpt-4", model_kwargs=model_type_kwargs, max_tokens=256, temperature=0.7)
-MEMORY = ConversationSummaryBufferMemory(llm=LLM, input_key='question', output_key='answer', max_token_limit=2000)
+# Streaming only reports tokens to request callbacks, the chain still returns the full answer
+LLM = ChatOpenAI(model_name="gpt-4", model_kwargs=model_type_kwargs, max_tokens=256, temperature=0.7,
+                 streaming=True)
+# Pruned messages are summarised by SUMMARIES after the reply instead of inside the request
+MEMORY_SESSIONS = MemorySessionManager(llm=LLM, max_token_limit=2000, defer_summary=True)
+SUMMARY_LLM = ChatOpenAI(model_name=os.environ.get("SUMMARY_MODEL", "gpt-3.5-turbo"), temperature=0)
+SUMMARIES = SummaryWorker(
+    SUMMARY_LLM,
+    HISTORY_WRITER,
+    concurrency=int(os.environ.get("SUMMARY_CONCURRENCY", 2)),
+)
+# Chain calls block, so they run on a bounded thread pool instead of the event loop
+LLM_EXECUTOR = LLMExecutor(
+    max_concurrency=int(os.environ.get("LLM_MAX_CONCURRENCY", 8)),
+    max_queue=int(os.environ.get("LLM_MAX_QUEUE", 32)),
+)
 
 # Load roles from the JSON file
 ROLES = load_roles_from_file(ROLES_FILE)
+ROLES_BY_COMMAND = index_roles(ROLES, "command")
 
 # Load user roles at the start of your program
 USER_ROLES = load_user_roles(user_roles_file=USER_ROLES_FILE)
 
-# Create datastore
-if os.path.exists("data_store"):
-    vector_store = FAISS.load_local(
-        "data_store",
-        OpenAIEmbeddings()
-    )
-    print("Loaded from local disk.")
-else:
-    file = "kb.pdf"
-    loader = PyPDFLoader(file)
-    input_text = loader.load_and_split()
-    embeddings = OpenAIEmbeddings()
-    print(input_text)
-    vector_store = FAISS.from_documents(input_text, embeddings)
-    # Save the files `to local disk.
-    vector_store.save_local("data_store")
+# The index is built offline with `python ingest.py` and loaded on first use
+# Repeated questions and openers are answered from the embedding cache without an API call
+OPENAI_EMBEDDINGS = OpenAIEmbeddings()
+EMBEDDINGS = CachedEmbeddings(
+    OPENAI_EMBEDDINGS,
+    model=OPENAI_EMBEDDINGS.model,
+    cache_dir=Path(os.environ.get("EMBEDDING_CACHE_DIR", EMBEDDING_CACHE_DIR)),
+)
+VECTOR_STORE = LazyVectorStore(
+    index_dir=Path(INDEX_DIR),
+    embeddings=EMBEDDINGS,
+    embedding_model=EMBEDDINGS.model,
+    retrieval={
+        "index_type": os.environ.get("FAISS_INDEX_TYPE", "flat"),
+        "quantization": os.environ.get("FAISS_QUANTIZATION", "none"),
+        "pq_m": int(os.environ.get("FAISS_PQ_M", 64)),
+        "k": int(os.environ.get("RETRIEVAL_K", 4)),
+        "score_threshold": float(os.environ["RETRIEVAL_SCORE_THRESHOLD"])
+        if "RETRIEVAL_SCORE_THRESHOLD" in os.environ else None,
+    },
+)
+
+# Prompts and chains of every subscription tier are built once and reused by all requests
+CHAINS = ChainRegistry(llm=LLM, retriever=VECTOR_STORE.as_retriever())
+# Retrieved documents get the part of the context window left by the prompt, memory and answer
+CONTEXT = ContextBuilder(
+    LLM,
+    context_window=int(os.environ.get("CONTEXT_WINDOW", 8192)),
+    answer_tokens=LLM.max_tokens,
+    document_tokens=int(os.environ.get("DOCUMENT_TOKENS", 1500)),
+)
 
 
 # @dispatcher.message_handler(commands=["assistant", "hypnotherapist", "psychotherapist", "doctor"])
@@ -88,7 +159,7 @@ async def set_role(message: types.Message):
     command = message.get_command()
 
     # Find the role corresponding to the command
-    role = next((r for r in ROLES if r["command"] == command), None)
+    role = ROLES_BY_COMMAND.get(command)
 
     if role:
         USER_ROLES[user_id] = role["name"]
@@ -109,45 +180,38 @@ async def show_message_count(message: types.Message):
 # @dispatcher.message_handler(commands=["free"])
 async def show_message_count(message: types.Message):
     user_id = str(message.from_user.id)
-    # Load message counts from a JSON file (if it exists)
-    if os.path.isfile("message_counts.json"):
-        # If it exists, load the data from the file
-        with open("message_counts.json", "r") as f:
-            USER_TO_CONVERSATION_ID = json.load(f)
-    else:
-        USER_TO_CONVERSATION_ID = {}
-        # If it doesn't exist, create an empty dictionary
-        return {"result": ERROR_MESSAGE}
-    print(USER_TO_CONVERSATION_ID)
-    count = USER_TO_CONVERSATION_ID[user_id]
-    remaining = 50 - int(count)
+    remaining = await QUOTA.remaining(user_id)
     return {"result": f"Remaining {remaining} free messages."}
 
 
 # Define the endpoint for deleting user history
 @app.post(DELETE_ENDPOINT)
 async def delete(request: Start):
-    HISTORY_WRITER.delete_user_history(str(request.user_id))
+    await HISTORY_WRITER.delete_user_history(str(request.user_id))
+    PROFILE_CACHE.invalidate(str(request.user_id))
 
 
 # Define the endpoint for premium upgrade
 @app.post(PREMIUM_ENDPOINT)
 async def premium(request: Start):
-    HISTORY_WRITER.update_subscription_to_premium(str(request.user_id))
+    await HISTORY_WRITER.update_subscription_to_premium(str(request.user_id))
+    PROFILE_CACHE.invalidate(str(request.user_id))
 
 
 # Define the endpoint for basic upgrade
 @app.post(BASIC_ENDPOINT)
 async def basic(request: Start):
-    HISTORY_WRITER.update_subscription_to_basic(str(request.user_id))
+    await HISTORY_WRITER.update_subscription_to_basic(str(request.user_id))
+    PROFILE_CACHE.invalidate(str(request.user_id))
 
 
 # Define the endpoint for handling queries
 @app.post(START_ENDPOINT)
 async def start(request: Start):
     USER_ROLES[str(request.user_id)] = "Psychotherapist"
-    HISTORY_WRITER.create_new_user(str(request.user_id))
-    HISTORY_WRITER.add_new_user_with_basic_subscription(str(request.user_id))
+    await HISTORY_WRITER.create_new_user(str(request.user_id))
+    await HISTORY_WRITER.add_new_user_with_basic_subscription(str(request.user_id))
+    PROFILE_CACHE.invalidate(str(request.user_id))
 
 
 @app.post(CHANGE_PROMPT_ENDPOINT)
@@ -156,87 +220,98 @@ async def health():
     return {"result": "OK"}
 
 
+@app.get(STATS_ENDPOINT)
+async def stats():
+    return {
+        "database_pool": HISTORY_WRITER.stats(),
+        "llm_executor": LLM_EXECUTOR.stats(),
+        "embedding_cache": EMBEDDINGS.stats(),
+        "quota": QUOTA.stats(),
+        "history_queue": HISTORY_QUEUE.stats(),
+        "profile_cache": PROFILE_CACHE.stats(),
+        "summaries": SUMMARIES.stats(),
+    }
+
+
 # Define the endpoint for handling queries
 @app.post(MESSAGE_ENDPOINT)
 # @retry(wait=wait_random_exponential(min=1, max=1000), stop=stop_after_attempt(6))
-async def handle_message(request: Message) -> dict:
-    users_subscription_id = HISTORY_WRITER.get_subscription_id(str(request.user_id))
+async def handle_message(request: Message):
     try:
-        retrieved_from_db = HISTORY_WRITER.get_checkpoint_by_user_id(str(request.user_id))
-        retrieved_messages = messages_from_dict(retrieved_from_db[0])
-        retrieved_chat_history = ChatMessageHistory(messages=retrieved_messages)
-        MEMORY.chat_memory = retrieved_chat_history
-        MEMORY.moving_summary_buffer = retrieved_from_db[1]
-
-        if users_subscription_id == "2":
-            print(users_subscription_id)
-            system_template = PREMIUM_TEMPLATE
-            messages = [
-                SystemMessagePromptTemplate.from_template(system_template),
-                HumanMessagePromptTemplate.from_template("{question}")
-            ]
-            prompt = ChatPromptTemplate.from_messages(messages)
-            chain_type_kwargs = {"prompt": prompt}
-            reloaded_chain = RetrievalQAWithSourcesChain.from_chain_type(
-                llm=LLM,
-                chain_type="stuff",
-                retriever=vector_store.as_retriever(),
-                return_source_documents=False,
-                verbose=True,
-                memory=MEMORY,
-                chain_type_kwargs=chain_type_kwargs
-            )
-            chatbot_response = reloaded_chain(request.message)
-            print(chatbot_response)
+        with LLM_EXECUTOR.admit():
+            return await answer_message(request)
+    except ExecutorBusyError:
+        return busy_response()
 
-            # Save the data to the file with new messages
-            print(MEMORY.moving_summary_buffer)
-
-            HISTORY_WRITER.write_checkpoint(user_id=str(request.user_id),
-                                            history=messages_to_dict(MEMORY.buffer),
-                                            memory_moving_summary_buffer=MEMORY.moving_summary_buffer
-                                            )
-            HISTORY_WRITER.write_message(
-                user_id=str(request.user_id),
-                user_message=request.message,
-                chatbot_message=chatbot_response['answer']
-            )
-            return {"result": chatbot_response['answer']}
-
-        if users_subscription_id == "1":
-            print(users_subscription_id)
-            system_template = BASIC_TEMPLATE
-            messages = [
-                SystemMessagePromptTemplate.from_template(system_template),
-                HumanMessagePromptTemplate.from_template("{question}")
-            ]
-            prompt = ChatPromptTemplate.from_messages(messages)
-            chain_type_kwargs = {"prompt": prompt}
-
-            reloaded_chain = ConversationChain(
-                llm=LLM,
-                verbose=True,
-                memory=MEMORY,
-                prompt=prompt,
-                input_key="question",
-                output_key="answer",
-            )
-            chatbot_response = reloaded_chain(request.message)
+
+# Define the endpoint streaming the answer as server-sent events
+@app.post(MESSAGE_STREAM_ENDPOINT)
+async def handle_message_stream(request: Message):
+    # Admit before the response starts, so a busy server still answers with a 503
+    slot = ExitStack()
+    try:
+        slot.enter_context(LLM_EXECUTOR.admit())
+    except ExecutorBusyError:
+        return busy_response()
+
+    async def events():
+        with slot:
+            async for event in stream_answer(lambda callbacks: answer_message(request, callbacks)):
+                yield event
+
+    # Also releases the slot if the stream never started; closing twice is a no-op
+    return StreamingResponse(events(), media_type="text/event-stream", background=BackgroundTask(slot.close))
+
+
+def busy_response() -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"result": BUSY_MESSAGE},
+        headers={"Retry-After": "1"},
+    )
+
+
+async def answer_message(request: Message, callbacks: Optional[List[BaseCallbackHandler]] = None) -> dict:
+    user_id = str(request.user_id)
+    try:
+        async with MEMORY_SESSIONS.user_lock(user_id):
+            # One query for the checkpoint, and for the subscription unless it is cached
+            profile = PROFILE_CACHE.get(user_id)
+            if profile is None:
+                token = PROFILE_CACHE.token()
+                users_subscription_id, history, summary = await HISTORY_WRITER.load_turn(user_id)
+                PROFILE_CACHE.set(user_id, {"subscription_id": users_subscription_id}, token)
+            else:
+                users_subscription_id = profile["subscription_id"]
+                _, history, summary = await HISTORY_WRITER.load_turn(user_id, with_subscription=False)
+            session = MEMORY_SESSIONS.create(user_id, history, summary)
+
+            try:
+                template = CHAINS.templates[users_subscription_id]
+                document_tokens = CONTEXT.document_budget(template, session.memory, request.message)
+                reloaded_chain = CHAINS.bind(users_subscription_id, session.memory, document_tokens)
+            except KeyError:
+                return {"result": ERROR_MESSAGE}
+
+            chatbot_response = await LLM_EXECUTOR.run(reloaded_chain, request.message, callbacks=callbacks)
             print(chatbot_response)
 
             # Save the data to the file with new messages
-            print(MEMORY.moving_summary_buffer)
-
-            HISTORY_WRITER.write_checkpoint(user_id=str(request.user_id),
-                                            history=messages_to_dict(MEMORY.buffer),
-                                            memory_moving_summary_buffer=MEMORY.moving_summary_buffer
-                                            )
-            HISTORY_WRITER.write_message(
-                user_id=str(request.user_id),
-                user_message=request.message,
-                chatbot_message=chatbot_response['answer']
-            )
-            return {"result": chatbot_response['answer']}
+            print(session.summary)
+
+            # Only the messages pruned and added by this turn are written
+            pruned, new_messages, summary = session.delta()
+            checkpoint_id = await HISTORY_WRITER.save_turn(user_id=user_id,
+                                                           pruned=pruned,
+                                                           messages=new_messages,
+                                                           memory_moving_summary_buffer=summary
+                                                           )
+            # The summary is updated in the background once the pruned messages are skipped
+            if checkpoint_id is not None:
+                SUMMARIES.submit(user_id, checkpoint_id, session.memory.pruned_messages)
+        # The history row is inserted in the background with the rows of other turns
+        HISTORY_QUEUE.put(user_id, request.message, chatbot_response['answer'])
+        return {"result": chatbot_response['answer']}
 
     except RateLimitError as e:
         # Handle RateLimitError
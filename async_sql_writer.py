@@ -0,0 +1,459 @@
+import asyncio
+import datetime
+import functools
+import itertools
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Optional, List, Tuple, AsyncIterator, Dict
+
+import psycopg2
+
+from sql_writer import SQLHistoryWriter, HistoryKey, history_key
+
+
+class PoolTimeoutError(Exception):
+    """
+    Raised when no database connection becomes available within the acquire timeout.
+    """
+
+
+class AsyncSQLHistoryWriter:
+    """
+    An asyncio counterpart of SQLHistoryWriter backed by a bounded connection pool.
+
+    Every pooled connection is a SQLHistoryWriter instance, and the blocking psycopg2 calls run
+    on a dedicated thread pool with one thread per connection, so database round trips never
+    block the event loop and concurrent requests overlap their storage I/O.
+
+    Args:
+        host: PostgreSQL Database host.
+        port: PostgreSQL Database port.
+        user: PostgreSQL Database user.
+        password: PostgreSQL Database user password.
+        database: PostgreSQL Database name.
+        min_size: Number of connections opened on startup and kept in the pool.
+        max_size: Maximum number of connections open at the same time.
+        acquire_timeout: Seconds to wait for a free connection before raising PoolTimeoutError.
+        health_check_interval: Seconds between liveness checks of idle connections (0 disables them).
+        **kwargs: Additional arguments to pass to psycopg2.connect.
+    """
+
+    def __init__(
+            self,
+            host: str,
+            port: str,
+            user: str,
+            password: str,
+            database: str,
+            min_size: int = 1,
+            max_size: int = 10,
+            acquire_timeout: float = 10.0,
+            health_check_interval: float = 30.0,
+            **kwargs
+    ) -> None:
+        if max_size < 1 or not 0 <= min_size <= max_size:
+            raise ValueError(f"Invalid pool size: min_size={min_size}, max_size={max_size}")
+
+        self._connection_params = {
+            'host': host,
+            'port': port,
+            'user': user,
+            'password': password,
+            'database': database,
+            **kwargs
+        }
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle = deque()
+        self._size = 0
+        self._slots = asyncio.Semaphore(max_size)
+        self._executor = ThreadPoolExecutor(max_workers=max_size, thread_name_prefix="sql-pool")
+        self._health_task = None
+        self._schema_checked = False
+        self._closing = False
+
+    @classmethod
+    def from_config(cls, file_path: Path) -> "AsyncSQLHistoryWriter":
+        """
+        Load the database configuration from a JSON file.
+
+        Pool settings (min_size, max_size, acquire_timeout, health_check_interval) are read from
+        an optional "pool" object next to the connection parameters.
+
+        Args:
+            file_path: Path to JSON file.
+        """
+        data = json.loads(file_path.read_text())
+        pool = data.pop("pool", {})
+        return cls(**data, **pool)
+
+    async def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _new_writer(self) -> SQLHistoryWriter:
+        # Only the first connection checks for pending migrations
+        writer = await self._call(
+            SQLHistoryWriter, check_schema=not self._schema_checked, **self._connection_params
+        )
+        self._schema_checked = True
+        return writer
+
+    async def _discard(self, writer: SQLHistoryWriter) -> None:
+        self._size -= 1
+        try:
+            await self._call(writer.close)
+        except psycopg2.Error:
+            pass
+
+    async def open(self) -> None:
+        """
+        Open min_size connections and start the background health checks.
+        """
+        while self._size < self.min_size:
+            self._size += 1
+            try:
+                self._idle.append(await self._new_writer())
+            except Exception:
+                self._size -= 1
+                raise
+        if self.health_check_interval and self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self) -> None:
+        """
+        Stop the health checks and close every connection, waiting for those still checked out.
+
+        Connections released after this call are closed instead of returning to the pool.
+        """
+        self._closing = True
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        while self._idle:
+            await self._discard(self._idle.pop())
+        # Every checked out connection holds a slot until it is released and closed
+        for _ in range(self.max_size):
+            await self._slots.acquire()
+        self._executor.shutdown(wait=False)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[SQLHistoryWriter]:
+        """
+        Check out a connection for the duration of the context.
+
+        Raises:
+            PoolTimeoutError: If no connection is free within acquire_timeout seconds.
+            RuntimeError: If the pool is closed.
+        """
+        if self._closing:
+            raise RuntimeError("The database pool is closed")
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeoutError(
+                f"No database connection available after {self.acquire_timeout} seconds"
+            ) from None
+
+        writer = None
+        try:
+            if self._idle:
+                writer = self._idle.pop()
+            else:
+                self._size += 1
+                try:
+                    writer = await self._new_writer()
+                except Exception:
+                    self._size -= 1
+                    raise
+            yield writer
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # The server went away; do not hand this connection out again
+            if writer is not None:
+                await self._discard(writer)
+                writer = None
+            raise
+        finally:
+            try:
+                # A transaction aborted by an error or left open by a read is ended first
+                if writer is not None and not await self._call(self._reset, writer):
+                    await self._discard(writer)
+                    writer = None
+            finally:
+                if writer is not None:
+                    if self._closing:
+                        await self._discard(writer)
+                    else:
+                        self._idle.append(writer)
+                self._slots.release()
+
+    async def _run(self, method: str, *args, **kwargs):
+        async with self.acquire() as writer:
+            return await self._call(getattr(writer, method), *args, **kwargs)
+
+    @staticmethod
+    def _reset(writer: SQLHistoryWriter) -> bool:
+        try:
+            writer.reset()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _ping(writer: SQLHistoryWriter) -> bool:
+        try:
+            # ping() issues SELECT 1 and reconnects once if the connection was lost
+            writer.ping()
+            return True
+        except psycopg2.Error:
+            return False
+
+    async def check_health(self) -> dict:
+        """
+        Ping every idle connection, replace broken ones and top the pool up to min_size.
+
+        Returns:
+            dict: The pool statistics after the check.
+        """
+        for _ in range(len(self._idle)):
+            await self._slots.acquire()
+            try:
+                if not self._idle:
+                    break
+                writer = self._idle.popleft()
+                if await self._call(self._ping, writer):
+                    self._idle.append(writer)
+                else:
+                    await self._discard(writer)
+            finally:
+                self._slots.release()
+
+        try:
+            await self.open()
+        except psycopg2.Error as e:
+            print(f"Database pool health check failed: {e}")
+        return self.stats()
+
+    async def _health_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            await self.check_health()
+
+    def stats(self) -> dict:
+        """
+        Return the current pool statistics.
+        """
+        return {
+            "size": self._size,
+            "idle": len(self._idle),
+            "in_use": self._size - len(self._idle),
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+        }
+
+    async def write_message(
+            self,
+            user_id: str,
+            user_message: str,
+            chatbot_message: str,
+            timestamp: Optional[datetime.datetime] = None,
+    ) -> None:
+        """
+        Add a new row to the ConversationHistory table, see SQLHistoryWriter.write_message.
+        """
+        await self._run("write_message", user_id, user_message, chatbot_message, timestamp)
+
+    async def write_messages(self, rows: List[Tuple[str, str, str, datetime.datetime]]) -> None:
+        """
+        Add several rows to the ConversationHistory table, see SQLHistoryWriter.write_messages.
+        """
+        await self._run("write_messages", rows)
+
+    async def write_checkpoint(
+            self,
+            user_id: str,
+            history: List[dict],
+            memory_moving_summary_buffer: str
+    ) -> None:
+        """
+        Update the user's ConversationCheckpoints row, see SQLHistoryWriter.write_checkpoint.
+        """
+        await self._run("write_checkpoint", user_id, history, memory_moving_summary_buffer)
+
+    async def compact_checkpoint(self, user_id: str) -> None:
+        """
+        Fold the message rows of a checkpoint into its snapshot, see SQLHistoryWriter.compact_checkpoint.
+        """
+        await self._run("compact_checkpoint", user_id)
+
+    async def load_turn(
+            self,
+            user_id: str,
+            with_subscription: bool = True,
+    ) -> Tuple[Optional[str], List[dict], Optional[str]]:
+        """
+        Fetch the subscription and checkpoint of a user in one query, see SQLHistoryWriter.load_turn.
+        """
+        return await self._run("load_turn", user_id, with_subscription)
+
+    async def save_turn(
+            self,
+            user_id: str,
+            pruned: int,
+            messages: List[dict],
+            memory_moving_summary_buffer: Optional[str],
+    ) -> Optional[int]:
+        """
+        Persist the checkpoint changes of a turn and return the checkpoint id, see SQLHistoryWriter.save_turn.
+        """
+        return await self._run("save_turn", user_id, pruned, messages, memory_moving_summary_buffer)
+
+    async def create_new_user(self, user_id) -> None:
+        """
+        Create a new user in the database.
+        """
+        await self._run("create_new_user", user_id)
+
+    async def delete_user_history(self, user_id) -> None:
+        """
+        Delete a user's history from the database.
+        """
+        await self._run("delete_user_history", user_id)
+
+    async def _stream(self, method: str, *args, chunk_size: int = 2000) -> AsyncIterator[tuple]:
+        # The connection stays checked out while the rows of its server-side cursor are read
+        async with self.acquire() as writer:
+            rows = getattr(writer, method)(*args, fetch_size=chunk_size)
+            try:
+                while True:
+                    chunk = await self._call(lambda: list(itertools.islice(rows, chunk_size)))
+                    if not chunk:
+                        return
+                    for row in chunk:
+                        yield row
+            finally:
+                await self._call(rows.close)
+
+    def get_all_messages_companions(self, chunk_size: int = 2000) -> AsyncIterator[tuple]:
+        """
+        Yield all messages in the Companions table, see SQLHistoryWriter.get_all_messages_companions.
+        """
+        return self._stream("get_all_messages_companions", chunk_size=chunk_size)
+
+    def get_all_messages(self, chunk_size: int = 2000) -> AsyncIterator[tuple]:
+        """
+        Yield all messages in the ConversationHistory table, see SQLHistoryWriter.get_all_messages.
+        """
+        return self._stream("get_all_messages", chunk_size=chunk_size)
+
+    async def get_history_page(
+            self,
+            user_id: Optional[str] = None,
+            after: Optional[HistoryKey] = None,
+            limit: int = 1000,
+    ) -> List[tuple]:
+        """
+        Fetch a page of ConversationHistory rows, see SQLHistoryWriter.get_history_page.
+        """
+        return await self._run("get_history_page", user_id, after, limit)
+
+    async def iter_history_pages(
+            self,
+            user_id: Optional[str] = None,
+            after: Optional[HistoryKey] = None,
+            page_size: int = 1000,
+    ) -> AsyncIterator[List[tuple]]:
+        """
+        Yield ConversationHistory rows page by page, checking out a connection only per page.
+        """
+        while True:
+            rows = await self.get_history_page(user_id, after, page_size)
+            if rows:
+                yield rows
+            if len(rows) < page_size:
+                return
+            after = history_key(rows[-1])
+
+    async def get_chat_history(self, user_id: str) -> List[dict]:
+        """
+        Retrieve the chat history for a given user_id, see SQLHistoryWriter.get_chat_history.
+        """
+        return await self._run("get_chat_history", user_id)
+
+    async def get_message_count_by_user_id(self, user_id: int) -> int:
+        """
+        Retrieve the count of messages sent by a given user_id across all conversations.
+        """
+        return await self._run("get_message_count_by_user_id", user_id)
+
+    async def get_message_count_by_user_and_conversation_id(self, user_id: int) -> int:
+        """
+        Retrieve the count of messages sent by a given user_id across all conversations.
+        """
+        return await self._run("get_message_count_by_user_and_conversation_id", user_id)
+
+    async def get_checkpoint_by_user_id(self, user_id: str) -> Tuple[List[dict], Optional[str]]:
+        """
+        Get Conversation Checkpoints for a specific user, see SQLHistoryWriter.get_checkpoint_by_user_id.
+        """
+        return await self._run("get_checkpoint_by_user_id", user_id)
+
+    async def get_summary(self, user_id: str, checkpoint_id: int) -> Tuple[Optional[str], Optional[int]]:
+        """
+        Get the moving summary of a checkpoint with its version, see SQLHistoryWriter.get_summary.
+        """
+        return await self._run("get_summary", user_id, checkpoint_id)
+
+    async def write_summary(
+            self,
+            user_id: str,
+            checkpoint_id: int,
+            memory_moving_summary_buffer: str,
+            version: int,
+    ) -> bool:
+        """
+        Replace the moving summary unless it changed since it was read, see SQLHistoryWriter.write_summary.
+        """
+        return await self._run("write_summary", user_id, checkpoint_id, memory_moving_summary_buffer, version)
+
+    async def get_subscription_id(self, user_id: str) -> Optional[str]:
+        """
+        Fetch the subscription of a user, see SQLHistoryWriter.get_subscription_id.
+        """
+        return await self._run("get_subscription_id", user_id)
+
+    async def update_subscription_to_premium(self, user_id: str) -> bool:
+        """
+        Switch a user to the premium subscription, see SQLHistoryWriter.update_subscription_to_premium.
+        """
+        return await self._run("update_subscription_to_premium", user_id)
+
+    async def update_subscription_to_basic(self, user_id: str) -> bool:
+        """
+        Switch a user to the basic subscription, see SQLHistoryWriter.update_subscription_to_basic.
+        """
+        return await self._run("update_subscription_to_basic", user_id)
+
+    async def add_new_user_with_basic_subscription(self, user_id: str) -> bool:
+        """
+        Give a new user the basic subscription, see SQLHistoryWriter.add_new_user_with_basic_subscription.
+        """
+        return await self._run("add_new_user_with_basic_subscription", user_id)
+
+    async def get_message_quota(self, user_id: str) -> int:
+        """
+        Fetch the stored message count of a user, see SQLHistoryWriter.get_message_quota.
+        """
+        return await self._run("get_message_quota", user_id)
+
+    async def add_message_quotas(self, counts: Dict[str, int]) -> None:
+        """
+        Add message counts of several users, see SQLHistoryWriter.add_message_quotas.
+        """
+        await self._run("add_message_quotas", counts)
@@ -0,0 +1,76 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional, AsyncIterator, Any
+
+import aiohttp
+
+
+class BackendClient:
+    """
+    A long-lived HTTP client of the FastAPI backend, shared by all bot handlers.
+
+    One aiohttp session with a keep-alive connection pool is opened on first use and reused
+    for every call, the number of calls in flight is bounded, and every call has a timeout.
+
+    Args:
+        base_url: URL of the backend, e.g. http://localhost:8000.
+        max_connections: Size of the keep-alive connection pool.
+        max_concurrency: Number of calls in flight; further calls wait for a free slot.
+        timeout: Seconds allowed for a regular call.
+        stream_timeout: Seconds allowed between two chunks of a streamed answer.
+        keepalive_timeout: Seconds an idle connection is kept open.
+    """
+
+    def __init__(
+            self,
+            base_url: str,
+            max_connections: int = 100,
+            max_concurrency: int = 100,
+            timeout: float = 30.0,
+            stream_timeout: float = 120.0,
+            keepalive_timeout: float = 60.0,
+    ) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.max_connections = max_connections
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.stream_timeout = aiohttp.ClientTimeout(total=None, sock_read=stream_timeout)
+        self.keepalive_timeout = keepalive_timeout
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # The session must be created inside the running event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_connections, keepalive_timeout=self.keepalive_timeout
+                ),
+                timeout=self.timeout,
+            )
+        return self._session
+
+    async def post(self, endpoint: str, payload: dict) -> Any:
+        """
+        POST a JSON payload to an endpoint and return the decoded JSON answer.
+        """
+        async with self._slots:
+            async with self._get_session().post(self.base_url + endpoint, json=payload) as response:
+                return await response.json()
+
+    @asynccontextmanager
+    async def stream(self, endpoint: str, payload: dict) -> AsyncIterator[aiohttp.ClientResponse]:
+        """
+        POST a JSON payload and yield the response for reading its body incrementally.
+        """
+        async with self._slots:
+            async with self._get_session().post(
+                    self.base_url + endpoint, json=payload, timeout=self.stream_timeout
+            ) as response:
+                yield response
+
+    async def close(self) -> None:
+        """
+        Close the session and its pooled connections.
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
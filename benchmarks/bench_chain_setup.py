@@ -0,0 +1,84 @@
+"""
+Measure the per-request cost of building tier chains from scratch versus ChainRegistry.bind.
+
+Run from the repository root:
+    python -m benchmarks.bench_chain_setup --iterations 2000
+"""
+import argparse
+import timeit
+from typing import List
+
+from langchain import ConversationChain
+from langchain.chains import RetrievalQAWithSourcesChain
+from langchain.memory import ConversationBufferMemory
+from langchain.schema import BaseRetriever, Document
+
+from chains import ChainRegistry, build_prompt, PREMIUM_SUBSCRIPTION_ID, BASIC_SUBSCRIPTION_ID
+from config import PREMIUM_TEMPLATE, BASIC_TEMPLATE
+from fake_llm import FakeChatModel
+
+
+class EmptyRetriever(BaseRetriever):
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        return []
+
+    async def aget_relevant_documents(self, query: str) -> List[Document]:
+        return []
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", help="Requests to simulate per tier", type=int, default=2000)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    llm = FakeChatModel(latency=0)
+    retriever = EmptyRetriever()
+    registry = ChainRegistry(llm=llm, retriever=retriever)
+
+    def memory():
+        return ConversationBufferMemory(input_key="question", output_key="answer")
+
+    def rebuild_premium():
+        RetrievalQAWithSourcesChain.from_chain_type(
+            llm=llm,
+            chain_type="stuff",
+            retriever=retriever,
+            return_source_documents=False,
+            verbose=True,
+            memory=memory(),
+            chain_type_kwargs={"prompt": build_prompt(PREMIUM_TEMPLATE)}
+        )
+
+    def rebuild_basic():
+        ConversationChain(
+            llm=llm,
+            verbose=True,
+            memory=memory(),
+            prompt=build_prompt(BASIC_TEMPLATE),
+            input_key="question",
+            output_key="answer",
+        )
+
+    # A bound chain must run like a freshly built one
+    for tier in (PREMIUM_SUBSCRIPTION_ID, BASIC_SUBSCRIPTION_ID):
+        answer = registry.bind(tier, memory())({"question": "How can I sleep better?"})["answer"]
+        print(f"tier {tier} bound chain answered: {answer!r}")
+
+    cases = [
+        ("premium rebuild", rebuild_premium),
+        ("premium bind", lambda: registry.bind(PREMIUM_SUBSCRIPTION_ID, memory())),
+        ("basic rebuild", rebuild_basic),
+        ("basic bind", lambda: registry.bind(BASIC_SUBSCRIPTION_ID, memory())),
+        ("premium bind+run", lambda: registry.bind(PREMIUM_SUBSCRIPTION_ID, memory())({"question": "Hi"})),
+        ("basic bind+run", lambda: registry.bind(BASIC_SUBSCRIPTION_ID, memory())({"question": "Hi"})),
+    ]
+    for name, func in cases:
+        seconds = timeit.timeit(func, number=args.iterations)
+        print(f"{name:>16}: {seconds / args.iterations * 1e6:8.1f} us per request")
+
+
+if __name__ == "__main__":
+    main()
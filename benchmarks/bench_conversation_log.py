@@ -0,0 +1,64 @@
+"""
+Compare the per-turn cost of rewriting database/<id>.json with ConversationLog as a history grows.
+
+Run from the repository root:
+    python -m benchmarks.bench_conversation_log --lengths 100 1000 10000
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from conversation_log import ConversationLog
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", help="History lengths in messages", type=int, nargs="+",
+                        default=[100, 1000, 10000])
+    parser.add_argument("--turns", help="Turns measured per length", type=int, default=50)
+    parser.add_argument("--window", help="Messages loaded per turn from the log", type=int, default=100)
+    return parser.parse_args()
+
+
+def message(kind, i):
+    return {"type": kind, "data": {"content": f"Message number {i} " * 10, "additional_kwargs": {}, "example": False}}
+
+
+def turn_with_file(path: Path, i: int) -> None:
+    # What main.py did every turn: read the whole history and write it back with the new turn
+    history = json.loads(path.read_text(encoding="utf-8"))
+    history += [message("human", i), message("ai", i)]
+    path.write_text(json.dumps(history), encoding="utf-8")
+
+
+def turn_with_log(log: ConversationLog, i: int, window: int) -> None:
+    log.tail("user", window)
+    log.append("user", [message("human", i), message("ai", i)])
+
+
+def main():
+    args = parse_args()
+    print(f"{'messages':>9} {'json file ms/turn':>18} {'log ms/turn':>12}")
+    for length in args.lengths:
+        history = [message("human" if i % 2 == 0 else "ai", i) for i in range(length)]
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "user.json"
+            path.write_text(json.dumps(history), encoding="utf-8")
+            started = time.perf_counter()
+            for i in range(args.turns):
+                turn_with_file(path, i)
+            file_cost = (time.perf_counter() - started) / args.turns
+
+            log = ConversationLog(Path(directory) / "logs")
+            log.append("user", history)
+            started = time.perf_counter()
+            for i in range(args.turns):
+                turn_with_log(log, i, args.window)
+            log_cost = (time.perf_counter() - started) / args.turns
+        print(f"{length:>9} {file_cost * 1000:>18.2f} {log_cost * 1000:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
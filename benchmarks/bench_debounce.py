@@ -0,0 +1,89 @@
+"""
+Compare the cancel-and-respawn task buffering with DebounceScheduler for many buffering users.
+
+Run from the repository root:
+    python -m benchmarks.bench_debounce --users 20000 --messages 5 --window 0.5
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from debounce import DebounceScheduler
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", help="Users buffering at the same time", type=int, default=20000)
+    parser.add_argument("--messages", help="Messages sent by every user", type=int, default=5)
+    parser.add_argument("--gap", help="Maximum seconds between two messages of a user", type=float, default=0.2)
+    parser.add_argument("--window", help="Buffer time window in seconds", type=float, default=0.5)
+    return parser.parse_args()
+
+
+class TaskBuffers:
+    # The buffering run.py used before: one task per message, cancelled by the next one
+    def __init__(self, flush, window):
+        self.flush = flush
+        self.window = window
+        self.buffers = {}
+        self.tasks_created = 0
+
+    def add(self, key, item):
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = {"items": []}
+        else:
+            buffer["task"].cancel()
+        buffer["items"].append(item)
+        buffer["task"] = asyncio.create_task(self.wait(key))
+        self.tasks_created += 1
+
+    async def wait(self, key):
+        await asyncio.sleep(self.window)
+        await self.flush(key, self.buffers.pop(key)["items"])
+
+
+async def send_messages(buffers, users, messages, gap):
+    async def user(key):
+        for i in range(messages):
+            buffers.add(key, f"message {i}")
+            await asyncio.sleep(random.uniform(0, gap))
+
+    await asyncio.gather(*(user(key) for key in range(users)))
+
+
+async def run(name, make_buffers, args):
+    flushed = {}
+    done = asyncio.Event()
+
+    async def flush(key, items):
+        flushed[key] = flushed.get(key, 0) + 1
+        if len(flushed) == args.users:
+            done.set()
+
+    buffers = make_buffers(flush)
+    started = time.perf_counter()
+    await send_messages(buffers, args.users, args.messages, args.gap)
+    await done.wait()
+    elapsed = time.perf_counter() - started
+    extra = f", {buffers.tasks_created} tasks created" if isinstance(buffers, TaskBuffers) else ""
+    print(
+        f"{name:>9}: {len(flushed)} users, {sum(flushed.values())} batches flushed in {elapsed:.2f}s{extra}"
+    )
+    if isinstance(buffers, DebounceScheduler):
+        await buffers.close()
+    # Both must flush every user's messages as one batch, or the timings compare unequal work
+    if sum(flushed.values()) != args.users:
+        raise SystemExit(f"{name} flushed {sum(flushed.values())} batches for {args.users} users")
+
+
+async def main():
+    args = parse_args()
+    random.seed(0)
+    await run("tasks", lambda flush: TaskBuffers(flush, args.window), args)
+    await run("scheduler", lambda flush: DebounceScheduler(flush, window=args.window, max_wait=10 * args.window), args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,61 @@
+"""
+Compare embedding a corpus in one sequential pass with the batched, concurrent IndexBuilder.
+
+Run from the repository root:
+    python -m benchmarks.bench_index_builder --chunks 5000 --latency 0.2 --concurrency 8
+"""
+import argparse
+import asyncio
+import time
+
+from langchain.schema import Document
+
+from fake_llm import FakeEmbeddings
+from index_builder import IndexBuilder
+from ingest import empty_store, add_embeddings
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", help="Number of chunks to embed", type=int, default=5000)
+    parser.add_argument("--latency", help="Fake embedding latency per request", type=float, default=0.2)
+    parser.add_argument("--batch_size", help="Chunks per request", type=int, default=64)
+    parser.add_argument("--concurrency", help="Requests in flight", type=int, default=8)
+    parser.add_argument("--rpm", help="Requests per minute allowed by the fake server", type=int, default=600)
+    parser.add_argument("--dimension", help="Vector size", type=int, default=1536)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    documents = [Document(page_content=f"chunk {i}", metadata={"source": "bench"}) for i in range(args.chunks)]
+
+    embeddings = FakeEmbeddings(dimension=args.dimension, latency=args.latency, requests_per_minute=args.rpm)
+    started = time.perf_counter()
+    vector_store = empty_store(embeddings, args.dimension)
+    for start in range(0, len(documents), args.batch_size):
+        batch = documents[start:start + args.batch_size]
+        add_embeddings(vector_store, batch, embeddings.embed_documents([d.page_content for d in batch]))
+    sequential = time.perf_counter() - started
+    print(f"sequential: {vector_store.index.ntotal} vectors in {sequential:.2f}s")
+
+    embeddings = FakeEmbeddings(dimension=args.dimension, latency=args.latency, requests_per_minute=args.rpm)
+    vector_store = empty_store(embeddings, args.dimension)
+    builder = IndexBuilder(
+        embeddings,
+        batch_size=args.batch_size,
+        max_concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+    )
+    started = time.perf_counter()
+    asyncio.run(builder.run(
+        [(i, document) for i, document in enumerate(documents)],
+        lambda batch, vectors: add_embeddings(vector_store, [d for _, d in batch], vectors),
+    ))
+    concurrent = time.perf_counter() - started
+    print(f"   builder: {vector_store.index.ntotal} vectors in {concurrent:.2f}s "
+          f"({sequential / concurrent:.1f}x, {embeddings.requests} requests)")
+
+
+if __name__ == "__main__":
+    main()
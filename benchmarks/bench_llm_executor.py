@@ -0,0 +1,77 @@
+"""
+Compare calling the chain inline in an async handler with running it on LLMExecutor.
+
+Run from the repository root:
+    python -m benchmarks.bench_llm_executor --requests 32 --latency 0.5
+"""
+import argparse
+import asyncio
+import time
+
+from langchain import ConversationChain
+from langchain.memory import ConversationBufferMemory
+
+from fake_llm import FakeChatModel
+from llm_executor import LLMExecutor, ExecutorBusyError
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", help="Concurrent requests", type=int, default=32)
+    parser.add_argument("--latency", help="Fake LLM latency in seconds", type=float, default=0.5)
+    parser.add_argument("--concurrency", help="Executor concurrency", type=int, default=8)
+    parser.add_argument("--queue", help="Executor queue depth", type=int, default=32)
+    return parser.parse_args()
+
+
+def build_chain(llm):
+    return ConversationChain(llm=llm, memory=ConversationBufferMemory())
+
+
+async def probe_health(stop: asyncio.Event) -> float:
+    # Worst delay seen by a cheap coroutine, i.e. how long /health would have to wait
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.01)
+        worst = max(worst, time.perf_counter() - started - 0.01)
+    return worst
+
+
+async def run(name, handler, requests):
+    stop = asyncio.Event()
+    probe = asyncio.create_task(probe_health(stop))
+    started = time.perf_counter()
+    results = await asyncio.gather(*(handler(f"message {i}") for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    worst_delay = await probe
+    answered = sum(result is not None for result in results)
+    print(
+        f"{name:>8}: {answered}/{requests} answered in {elapsed:.2f}s "
+        f"({answered / elapsed:.1f} req/s), worst event loop stall {worst_delay * 1000:.0f} ms"
+    )
+
+
+async def main():
+    args = parse_args()
+    llm = FakeChatModel(latency=args.latency)
+    executor = LLMExecutor(max_concurrency=args.concurrency, max_queue=args.queue)
+
+    async def inline(message):
+        return build_chain(llm)(message)
+
+    async def bounded(message):
+        try:
+            with executor.admit():
+                return await executor.run(build_chain(llm), message)
+        except ExecutorBusyError:
+            return None
+
+    await run("inline", inline, args.requests)
+    await run("executor", bounded, args.requests)
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
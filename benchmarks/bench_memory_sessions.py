@@ -0,0 +1,130 @@
+"""
+Run interleaved conversations of many users at once and check that no user sees another's turns,
+with per-request memory sessions and with the process-global MEMORY the API used to share.
+
+Every message is tagged with its user, so a prompt or stored history mentioning another
+user's tag is a leak. No database or OpenAI key is needed.
+
+Run from the repository root:
+    python -m benchmarks.bench_memory_sessions --users 50 --turns 5
+"""
+import argparse
+import asyncio
+import re
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain import ConversationChain
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.memory import ChatMessageHistory, ConversationSummaryBufferMemory
+from langchain.schema import BaseMessage, messages_from_dict, messages_to_dict
+
+from chains import build_prompt
+from config import BASIC_TEMPLATE
+from fake_llm import FakeChatModel
+from llm_executor import LLMExecutor
+from memory_session import MemorySessionManager
+
+USER_TAG = re.compile(r"\[user (\d+)\]")
+# Shared by all users, like the module-level MEMORY of the old app.py
+GLOBAL_MEMORY = ConversationSummaryBufferMemory(
+    llm=FakeChatModel(latency=0), input_key="question", output_key="answer", max_token_limit=100000
+)
+# Builds a memory per request, like MEMORY_SESSIONS of app.py
+SESSIONS = MemorySessionManager(FakeChatModel(latency=0), max_token_limit=100000)
+
+
+class RecordingChatModel(FakeChatModel):
+    """
+    A FakeChatModel that remembers the users tagged in every prompt it was sent.
+    """
+
+    prompts: List[set] = []
+
+    def _call(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> str:
+        self.prompts.append(set(USER_TAG.findall("\n".join(message.content for message in messages))))
+        return super()._call(messages, stop, run_manager, **kwargs)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", help="Users talking at the same time", type=int, default=50)
+    parser.add_argument("--turns", help="Messages sent by every user", type=int, default=5)
+    parser.add_argument("--latency", help="Fake LLM latency in seconds", type=float, default=0.05)
+    parser.add_argument("--concurrency", help="Executor concurrency", type=int, default=8)
+    return parser.parse_args()
+
+
+def build_chain(llm, memory):
+    return ConversationChain(
+        llm=llm,
+        memory=memory,
+        prompt=build_prompt(BASIC_TEMPLATE),
+        input_key="question",
+        output_key="answer",
+    )
+
+
+async def run_sessions(llm, executor, store, user_id, turns):
+    # The per-request memory of answer_message
+    for turn in range(turns):
+        async with SESSIONS.user_lock(user_id):
+            history, summary = store.get(user_id, ([], None))
+            session = SESSIONS.create(user_id, history, summary)
+            await executor.run(build_chain(llm, session.memory), {"question": f"[user {user_id}] turn {turn}"})
+            store[user_id] = (session.history, session.summary)
+
+
+async def run_global(llm, executor, store, user_id, turns):
+    # The shared MEMORY of the old handler: reset from the user's checkpoint, then run
+    memory = GLOBAL_MEMORY
+    for turn in range(turns):
+        history, summary = store.get(user_id, ([], None))
+        memory.chat_memory = ChatMessageHistory(messages=messages_from_dict(history))
+        memory.moving_summary_buffer = summary or ""
+        await executor.run(build_chain(llm, memory), {"question": f"[user {user_id}] turn {turn}"})
+        store[user_id] = (messages_to_dict(memory.chat_memory.messages), memory.moving_summary_buffer)
+
+
+def count_leaks(llm, store: Dict[str, Tuple[List[dict], Optional[str]]]) -> Tuple[int, int]:
+    leaked_prompts = sum(len(users) > 1 for users in llm.prompts)
+    leaked_histories = 0
+    for user_id, (history, _) in store.items():
+        users = set(USER_TAG.findall(" ".join(message["data"]["content"] for message in history)))
+        leaked_histories += bool(users - {user_id})
+    return leaked_prompts, leaked_histories
+
+
+async def run(name, handler, args):
+    llm = RecordingChatModel(latency=args.latency, prompts=[])
+    executor = LLMExecutor(max_concurrency=args.concurrency, max_queue=args.users)
+    store = {}
+    started = time.perf_counter()
+    await asyncio.gather(*(handler(llm, executor, store, str(user), args.turns) for user in range(args.users)))
+    elapsed = time.perf_counter() - started
+    executor.shutdown()
+    leaked_prompts, leaked_histories = count_leaks(llm, store)
+    print(
+        f"{name:>8}: {len(llm.prompts)} turns in {elapsed:.2f}s, "
+        f"{leaked_prompts} prompts and {leaked_histories}/{len(store)} histories with other users' messages"
+    )
+    return leaked_prompts + leaked_histories
+
+
+async def main():
+    args = parse_args()
+    leaks = await run("sessions", run_sessions, args)
+    await run("global", run_global, args)
+    if leaks:
+        raise SystemExit("Per-request sessions leaked messages between users")
+    print(f"Sessions kept {args.users} users apart")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
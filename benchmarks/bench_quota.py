@@ -0,0 +1,79 @@
+"""
+Compare the per-message cost of the JSON-file message counts with QuotaCounter as the user count grows.
+
+Run from the repository root:
+    python -m benchmarks.bench_quota --users 1000 100000 1000000
+"""
+import argparse
+import asyncio
+import json
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from quota import JSONQuotaStore, QuotaCounter, FREE_MESSAGE_LIMIT
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", help="Numbers of users with a count", type=int, nargs="+",
+                        default=[1000, 100000, 1000000])
+    parser.add_argument("--messages", help="Messages counted per run", type=int, default=100000)
+    parser.add_argument("--file_messages", help="Messages counted with the JSON file per run", type=int,
+                        default=20)
+    return parser.parse_args()
+
+
+def count_with_file(path: Path, user_id: str) -> bool:
+    # What main.py did for every message: read the whole file, increment, write it back
+    with open(path, "r") as f:
+        counts = json.load(f)
+    counts[user_id] = int(counts.get(user_id, 0)) + 1
+    with open(path, "w") as f:
+        json.dump(counts, f)
+    return counts[user_id] > FREE_MESSAGE_LIMIT
+
+
+async def count_with_counter(path: Path, users: int, messages: int):
+    counter = QuotaCounter(JSONQuotaStore(path), flush_interval=1.0)
+    user_ids = [str(random.randrange(users)) for _ in range(messages)]
+    timings = []
+    # The first pass reads every count from the store, the second one only increments
+    for _ in range(2):
+        started = time.perf_counter()
+        for user_id in user_ids:
+            await counter.increment(user_id)
+        timings.append((time.perf_counter() - started) / messages)
+    await counter.flush()
+    # A flush after a few seconds of traffic only writes the users who sent messages
+    for user_id in user_ids[:100]:
+        await counter.increment(user_id)
+    started = time.perf_counter()
+    await counter.flush()
+    timings.append(time.perf_counter() - started)
+    await counter.close()
+    return timings
+
+
+async def main():
+    args = parse_args()
+    random.seed(0)
+    print(f"{'users':>9} {'file us/msg':>12} {'first use us/msg':>17} {'counter us/msg':>15} {'flush ms':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "message_counts.json"
+        for users in args.users:
+            path.write_text(json.dumps({str(user_id): random.randrange(60) for user_id in range(users)}))
+
+            started = time.perf_counter()
+            for _ in range(args.file_messages):
+                count_with_file(path, str(random.randrange(users)))
+            file_cost = (time.perf_counter() - started) / args.file_messages
+
+            first_use_cost, counter_cost, flush_cost = await count_with_counter(path, users, args.messages)
+            print(f"{users:>9} {file_cost * 1e6:>12.0f} {first_use_cost * 1e6:>17.2f} {counter_cost * 1e6:>15.2f} "
+                  f"{flush_cost * 1e3:>9.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,80 @@
+"""
+Report recall@k against the exact flat index and queries per second for every index type.
+
+Run from the repository root:
+    python -m benchmarks.bench_retrieval --sizes 10000 100000 --dimension 256
+"""
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+from retrieval import build_faiss_index, INDEX_TYPES, QUANTIZATIONS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", help="Corpus sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--dimension", help="Vector size", type=int, default=256)
+    parser.add_argument("--queries", help="Number of queries", type=int, default=1000)
+    parser.add_argument("--k", help="Documents per query", type=int, default=4)
+    parser.add_argument("--nprobe", help="IVF lists visited per query", type=int, default=8)
+    parser.add_argument("--ef_search", help="HNSW search queue size", type=int, default=64)
+    return parser.parse_args()
+
+
+def clustered_vectors(rng, count, dimension, clusters=100):
+    # Embeddings of real text are clustered, uniform noise would flatter IVF and HNSW
+    centers = rng.standard_normal((clusters, dimension), dtype=np.float32)
+    labels = rng.integers(0, clusters, count)
+    return centers[labels] + 0.3 * rng.standard_normal((count, dimension), dtype=np.float32)
+
+
+def check_pq_dimensions(rng):
+    # Dimensions pq_m does not divide fall back to a smaller pq_m instead of failing
+    for dimension, pq_m in ((16, 64), (100, 64), (384, 64)):
+        corpus = clustered_vectors(rng, 1000, dimension)
+        for index_type in INDEX_TYPES:
+            index = build_faiss_index(corpus, index_type, "pq", pq_m=pq_m)
+            assert index.ntotal == len(corpus), (dimension, index_type)
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(0)
+    check_pq_dimensions(rng)
+    print(f"{'size':>8} {'index':>6} {'quant':>5} {'build s':>8} {'recall@k':>9} {'qps 1x1':>9} {'qps batch':>10}")
+    for size in args.sizes:
+        corpus = clustered_vectors(rng, size, args.dimension)
+        queries = clustered_vectors(rng, args.queries, args.dimension)
+        exact = faiss.IndexFlatL2(args.dimension)
+        exact.add(corpus)
+        _, truth = exact.search(queries, args.k)
+
+        for index_type in INDEX_TYPES:
+            for quantization in QUANTIZATIONS:
+                started = time.perf_counter()
+                index = build_faiss_index(corpus, index_type, quantization, pq_m=args.dimension // 16)
+                build = time.perf_counter() - started
+                if index_type == "ivf":
+                    faiss.extract_index_ivf(index).nprobe = args.nprobe
+                elif index_type == "hnsw":
+                    index.hnsw.efSearch = args.ef_search
+
+                started = time.perf_counter()
+                for query in queries[:200]:
+                    index.search(query[None, :], args.k)
+                single_qps = 200 / (time.perf_counter() - started)
+
+                started = time.perf_counter()
+                _, found = index.search(queries, args.k)
+                batch_qps = len(queries) / (time.perf_counter() - started)
+
+                recall = np.mean([len(set(f) & set(t)) / args.k for f, t in zip(found, truth)])
+                print(f"{size:>8} {index_type:>6} {quantization:>5} {build:>8.2f} {recall:>9.3f} "
+                      f"{single_qps:>9.0f} {batch_qps:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Measure the storage latency of a message turn against a local PostgreSQL: the four separate
+queries the API used to make versus load_turn and save_turn.
+
+Run from the repository root against a scratch database:
+    python -m benchmarks.bench_storage_turn --sql_config config/sql_config_local.json --turns 500
+"""
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+
+from sql_writer import SQLHistoryWriter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sql_config", help="Database configuration of SQLHistoryWriter", type=Path, required=True)
+    parser.add_argument("--turns", help="Turns measured per variant", type=int, default=500)
+    parser.add_argument("--buffer", help="Messages kept in the buffer", type=int, default=20)
+    return parser.parse_args()
+
+
+def message(kind, i):
+    return {"type": kind, "data": {"content": f"Message number {i} " * 20, "additional_kwargs": {}, "example": False}}
+
+
+def report(name, load_times, save_times):
+    load, save = np.array(load_times) * 1000, np.array(save_times) * 1000
+    total = load + save
+    print(f"{name:>9}: load p50 {np.median(load):.2f} ms, save p50 {np.median(save):.2f} ms, "
+          f"turn p50 {np.median(total):.2f} ms, p99 {np.percentile(total, 99):.2f} ms")
+
+
+def run_separate(writer, user_id, turns, buffer):
+    load_times, save_times = [], []
+    for i in range(turns):
+        started = time.perf_counter()
+        writer.get_subscription_id(user_id)
+        history, summary = writer.get_checkpoint_by_user_id(user_id)
+        loaded = time.perf_counter()
+        history = (history + [message("human", i), message("ai", i)])[-buffer:]
+        writer.write_checkpoint(user_id, history, summary or "")
+        writer.write_message(user_id, f"question {i}", f"answer {i}")
+        load_times.append(loaded - started)
+        save_times.append(time.perf_counter() - loaded)
+    return load_times, save_times
+
+
+def run_turns(writer, user_id, turns, buffer):
+    load_times, save_times = [], []
+    for i in range(turns):
+        started = time.perf_counter()
+        _, history, summary = writer.load_turn(user_id)
+        loaded = time.perf_counter()
+        pruned = max(0, len(history) + 2 - buffer)
+        writer.save_turn(user_id, pruned, [message("human", i), message("ai", i)], None)
+        # Written by HistoryQueue in the API, off the request path, but counted here like above
+        writer.write_message(user_id, f"question {i}", f"answer {i}")
+        load_times.append(loaded - started)
+        save_times.append(time.perf_counter() - loaded)
+    return load_times, save_times
+
+
+def main():
+    args = parse_args()
+    writer = SQLHistoryWriter.from_config(args.sql_config)
+    for name, run in (("separate", run_separate), ("turn", run_turns)):
+        user_id = f"bench-{name}-{time.time_ns()}"
+        writer.create_new_user(user_id)
+        writer.add_new_user_with_basic_subscription(user_id)
+        report(name, *run(writer, user_id, args.turns, args.buffer))
+        writer.delete_user_history(user_id)
+    writer.close()
+
+
+if __name__ == "__main__":
+    main()
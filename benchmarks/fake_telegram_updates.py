@@ -0,0 +1,128 @@
+"""
+Drive a bot in webhook mode with fake Telegram updates and answer its Bot API calls locally.
+
+Start the bot against the fake Bot API served here, e.g.
+    python run.py --telegram_token 123456:fake --telegram_api http://localhost:8081 \
+        --webhook_url http://localhost:8080/webhook
+then run from the repository root:
+    python -m benchmarks.fake_telegram_updates --chats 1000 --rate 500 --duration 10
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+
+from webhook import SECRET_TOKEN_HEADER
+
+# Telegram opens at most this many connections to a webhook
+MAX_CONNECTIONS = 100
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--webhook_url", help="Webhook of the bot", type=str, default="http://localhost:8080/webhook")
+    parser.add_argument("--webhook_secret", help="Secret token of the webhook", type=str, default=None)
+    parser.add_argument("--api_port", help="Port of the fake Bot API", type=int, default=8081)
+    parser.add_argument("--chats", help="Number of chats sending messages", type=int, default=1000)
+    parser.add_argument("--rate", help="Updates sent per second", type=float, default=500)
+    parser.add_argument("--duration", help="Seconds to send updates for", type=float, default=10)
+    return parser.parse_args()
+
+
+class FakeBotAPI:
+    # Answers every Bot API method successfully and counts the calls
+    def __init__(self):
+        self.calls = Counter()
+        self.message_ids = itertools.count(1)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        data = await request.post()
+        if method in ("sendMessage", "editMessageText"):
+            result = {
+                "message_id": int(data.get("message_id") or next(self.message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": int(data["chat_id"]), "type": "private"},
+                "text": data.get("text", ""),
+            }
+        elif method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+def fake_update(update_id: int, chat_id: int) -> dict:
+    user = {"id": chat_id, "is_bot": False, "first_name": "Load", "last_name": str(chat_id)}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": dict(user, type="private"),
+            "from": user,
+            "text": f"Message {update_id} from chat {chat_id}",
+        },
+    }
+
+
+async def send_updates(args, session):
+    headers = {SECRET_TOKEN_HEADER: args.webhook_secret} if args.webhook_secret else {}
+    connections = asyncio.Semaphore(MAX_CONNECTIONS)
+    latencies = []
+    statuses = Counter()
+
+    async def send(update):
+        async with connections:
+            started = time.perf_counter()
+            try:
+                async with session.post(args.webhook_url, json=update, headers=headers) as response:
+                    statuses[response.status] += 1
+            except aiohttp.ClientError as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    tasks = []
+    started = time.perf_counter()
+    for update_id in range(int(args.rate * args.duration)):
+        # Keep to the requested rate
+        delay = started + update_id / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(fake_update(update_id, random.randrange(1, args.chats + 1)))))
+    await asyncio.gather(*tasks)
+    return time.perf_counter() - started, latencies, statuses
+
+
+async def main():
+    args = parse_args()
+    api = FakeBotAPI()
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", args.api_port).start()
+
+    async with aiohttp.ClientSession() as session:
+        elapsed, latencies, statuses = await send_updates(args, session)
+    latencies = np.array(latencies) * 1000
+    print(f"{len(latencies)} updates sent in {elapsed:.2f}s ({len(latencies) / elapsed:.0f}/s)")
+    print(f"webhook responses: {dict(statuses)}")
+    print(f"webhook latency ms: p50 {np.percentile(latencies, 50):.1f}, "
+          f"p99 {np.percentile(latencies, 99):.1f}, max {latencies.max():.1f}")
+
+    # Give the bot time to finish the queued updates
+    await asyncio.sleep(5)
+    print(f"Bot API calls received: {dict(api.calls)}")
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
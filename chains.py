@@ -0,0 +1,85 @@
+from typing import Dict, Optional
+
+from langchain import ConversationChain
+from langchain.base_language import BaseLanguageModel
+from langchain.chains import RetrievalQAWithSourcesChain
+from langchain.chains.base import Chain
+from langchain.prompts import SystemMessagePromptTemplate, HumanMessagePromptTemplate, ChatPromptTemplate
+from langchain.schema import BaseMemory, BaseRetriever
+
+from config import PREMIUM_TEMPLATE, BASIC_TEMPLATE
+
+BASIC_SUBSCRIPTION_ID = "1"
+PREMIUM_SUBSCRIPTION_ID = "2"
+
+
+def build_prompt(system_template: str) -> ChatPromptTemplate:
+    """
+    Build the chat prompt used by every subscription tier.
+
+    Args:
+        system_template: Template of the system message.
+    """
+    messages = [
+        SystemMessagePromptTemplate.from_template(system_template),
+        HumanMessagePromptTemplate.from_template("{question}")
+    ]
+    return ChatPromptTemplate.from_messages(messages)
+
+
+class ChainRegistry:
+    """
+    Builds the prompt and chain of each subscription tier once and binds memory per request.
+
+    Binding makes a shallow copy of the prebuilt chain with the request's memory, so the
+    prompt, the LLM, the combine-documents chain and the retriever are shared between requests.
+
+    Args:
+        llm: Language model answering the user.
+        retriever: Retriever over the knowledge base used by the premium tier.
+    """
+
+    def __init__(self, llm: BaseLanguageModel, retriever: BaseRetriever) -> None:
+        self.templates: Dict[str, str] = {
+            PREMIUM_SUBSCRIPTION_ID: PREMIUM_TEMPLATE,
+            BASIC_SUBSCRIPTION_ID: BASIC_TEMPLATE,
+        }
+        self._chains: Dict[str, Chain] = {
+            PREMIUM_SUBSCRIPTION_ID: RetrievalQAWithSourcesChain.from_chain_type(
+                llm=llm,
+                chain_type="stuff",
+                retriever=retriever,
+                return_source_documents=False,
+                reduce_k_below_max_tokens=True,
+                verbose=True,
+                chain_type_kwargs={"prompt": build_prompt(PREMIUM_TEMPLATE)}
+            ),
+            BASIC_SUBSCRIPTION_ID: ConversationChain(
+                llm=llm,
+                verbose=True,
+                prompt=build_prompt(BASIC_TEMPLATE),
+                input_key="question",
+                output_key="answer",
+            ),
+        }
+
+    def bind(self, subscription_id: str, memory: BaseMemory, document_tokens: Optional[int] = None) -> Chain:
+        """
+        Return the chain of a subscription tier bound to a request's memory.
+
+        Args:
+            subscription_id: The user's subscription_id from testpayments.
+            memory: The request's conversation memory.
+            document_tokens: Maximum number of tokens of the retrieved documents, if the tier retrieves any.
+
+        Raises:
+            KeyError: If the subscription_id is not a known tier.
+        """
+        chain = self._chains[subscription_id]
+        update = {"memory": memory}
+        if document_tokens is not None and isinstance(chain, RetrievalQAWithSourcesChain):
+            # Documents are dropped from the end of the retrieved list until they fit
+            update["max_tokens_limit"] = document_tokens
+        # copy() would drop the fields excluded from export (callbacks, retriever) and copy the
+        # llm the same way, so the bound chain is constructed from the fields of the shared one
+        return type(chain).construct(_fields_set=chain.__fields_set__ | set(update), **{**chain.__dict__, **update})
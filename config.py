@@ -34,6 +34,8 @@ ERROR_MESSAGE = "Hi! Press /start to start a new conversation."
 
 LIMIT_MESSAGE = """Your limit is reached. Please buy a subscription to continue."""
 
+BUSY_MESSAGE = "We are currently under heavy load, please try again in a moment."
+
 DATA_STRUCTURE = {
     "history": [],
     "memory_moving_summary_buffer": ""
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+
+from langchain.base_language import BaseLanguageModel
+
+from memory_session import BudgetedSummaryBufferMemory, MESSAGE_OVERHEAD_TOKENS
+
+
+class ContextBuilder:
+    """
+    Splits the context window of the model between the parts of a prompt.
+
+    The system prompt, the moving summary, the recent turns, the question and the answer are
+    counted first; the retrieved documents get what is left, up to document_tokens. Message
+    counts come from the memory and other texts are counted once, so a turn only tokenizes
+    what is new in it.
+
+    Args:
+        llm: Language model whose tokenizer is used.
+        context_window: Number of tokens the model accepts, prompt and answer together.
+        answer_tokens: Tokens reserved for the answer, i.e. the max_tokens of the model.
+        document_tokens: Maximum number of tokens of retrieved documents in a prompt.
+        cache_size: Number of counted texts (templates, summaries) kept.
+    """
+
+    def __init__(
+            self,
+            llm: BaseLanguageModel,
+            context_window: int = 8192,
+            answer_tokens: int = 256,
+            document_tokens: int = 1500,
+            cache_size: int = 4096,
+    ) -> None:
+        self.llm = llm
+        self.context_window = context_window
+        self.answer_tokens = answer_tokens
+        self.document_tokens = document_tokens
+        self.cache_size = cache_size
+        self._counts = OrderedDict()
+
+    def count(self, text: str) -> int:
+        """
+        Return the number of tokens of a text, remembering the counts of recent texts.
+        """
+        count = self._counts.get(text)
+        if count is None:
+            count = self.llm.get_num_tokens(text) if text else 0
+            self._counts[text] = count
+            if len(self._counts) > self.cache_size:
+                self._counts.popitem(last=False)
+        else:
+            self._counts.move_to_end(text)
+        return count
+
+    def used_tokens(self, template: str, memory: BudgetedSummaryBufferMemory, question: str) -> int:
+        """
+        Return the number of tokens of a prompt and its answer, without the documents.
+        """
+        return (
+                self.count(template)
+                + self.count(memory.moving_summary_buffer)
+                + memory.buffer_tokens
+                + self.llm.get_num_tokens(question) + MESSAGE_OVERHEAD_TOKENS
+                + self.answer_tokens
+        )
+
+    def document_budget(self, template: str, memory: BudgetedSummaryBufferMemory, question: str) -> int:
+        """
+        Return the number of tokens the retrieved documents may take in the prompt.
+
+        Args:
+            template: The system template of the user's tier.
+            memory: The memory of the request.
+            question: The message of the user.
+        """
+        left = self.context_window - self.used_tokens(template, memory, question)
+        return max(0, min(self.document_tokens, left))
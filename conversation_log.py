@@ -0,0 +1,180 @@
+import json
+import os
+import struct
+from pathlib import Path
+from typing import List, Optional
+
+# Every index entry is the byte offset where a message line of the log ends
+INDEX_ENTRY = struct.Struct("<Q")
+
+
+class ConversationLog:
+    """
+    Append-only message logs of the users of the file-based bot, one JSON message per line.
+
+    Every user has a log `<user_id>.jsonl` of messages in the messages_to_dict format and an
+    index `<user_id>.idx` with the end offset of every line, so a turn is a single append and
+    the last messages are read without scanning the log. A log cut short by a crash is repaired
+    on the next access: a partial last line is dropped and missing index entries are rebuilt.
+    Legacy `<user_id>.json` histories are converted on first access.
+
+    Args:
+        directory: Directory of the logs.
+        fsync: Whether every append is flushed to disk before returning.
+    """
+
+    def __init__(self, directory: Path, fsync: bool = False) -> None:
+        self.directory = Path(directory)
+        self.fsync = fsync
+
+    def _log_path(self, user_id) -> Path:
+        return self.directory / f"{user_id}.jsonl"
+
+    def _index_path(self, user_id) -> Path:
+        return self.directory / f"{user_id}.idx"
+
+    def _legacy_path(self, user_id) -> Path:
+        return self.directory / f"{user_id}.json"
+
+    def exists(self, user_id) -> bool:
+        """
+        Whether the user has a log, converting a legacy history if there is one.
+        """
+        if self._log_path(user_id).is_file():
+            return True
+        legacy_path = self._legacy_path(user_id)
+        if not legacy_path.is_file():
+            return False
+        history = json.loads(legacy_path.read_text(encoding="utf-8") or "[]")
+        if isinstance(history, dict):
+            # Written by /start before the first message
+            history = history.get("history", [])
+        self._write(user_id, history)
+        legacy_path.unlink()
+        return True
+
+    def create(self, user_id) -> None:
+        """
+        Create an empty log for the user unless there is one already.
+        """
+        if not self.exists(user_id):
+            self._write(user_id, [])
+
+    def _write(self, user_id, messages: List[dict]) -> None:
+        # Replace the log and its index as a whole, used to create and to compact logs
+        self.directory.mkdir(parents=True, exist_ok=True)
+        lines = [(json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8") for message in messages]
+        offsets, end = [], 0
+        for line in lines:
+            end += len(line)
+            offsets.append(end)
+
+        log_path, index_path = self._log_path(user_id), self._index_path(user_id)
+        index_tmp = index_path.with_name(index_path.name + ".tmp")
+        log_tmp = log_path.with_name(log_path.name + ".tmp")
+        index_tmp.write_bytes(b"".join(INDEX_ENTRY.pack(offset) for offset in offsets))
+        log_tmp.write_bytes(b"".join(lines))
+        # The index goes first: an index ahead of its log is detected and rebuilt
+        os.replace(index_tmp, index_path)
+        os.replace(log_tmp, log_path)
+
+    def _read_index(self, user_id) -> List[int]:
+        index_path = self._index_path(user_id)
+        data = index_path.read_bytes() if index_path.is_file() else b""
+        data = data[:len(data) - len(data) % INDEX_ENTRY.size]
+        return [offset for offset, in INDEX_ENTRY.iter_unpack(data)]
+
+    def _read_entry(self, user_id, position: int) -> int:
+        with open(self._index_path(user_id), "rb") as index:
+            index.seek(position * INDEX_ENTRY.size)
+            return INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))[0]
+
+    def _repair(self, user_id) -> int:
+        """
+        Bring the index in line with the log and drop a partial last line.
+
+        Returns:
+            int: The number of messages in the log.
+        """
+        log_path, index_path = self._log_path(user_id), self._index_path(user_id)
+        size = log_path.stat().st_size
+        index_size = index_path.stat().st_size if index_path.is_file() else 0
+        count = index_size // INDEX_ENTRY.size
+        # In the common case only the last index entry is read
+        if index_size % INDEX_ENTRY.size == 0 and (self._read_entry(user_id, count - 1) if count else 0) == size:
+            return count
+
+        # Keep the entries that end on a line break inside the log, then index the rest
+        offsets = self._read_index(user_id)
+        with open(log_path, "rb") as log:
+            while offsets and offsets[-1] > size:
+                offsets.pop()
+            if offsets:
+                log.seek(offsets[-1] - 1)
+                if log.read(1) != b"\n":
+                    offsets = []
+            start = offsets[-1] if offsets else 0
+            log.seek(start)
+            end = start
+            for line in log:
+                if not line.endswith(b"\n"):
+                    break
+                end += len(line)
+                offsets.append(end)
+        if end < size:
+            # A crash interrupted the last append
+            os.truncate(log_path, end)
+        index_path.write_bytes(b"".join(INDEX_ENTRY.pack(offset) for offset in offsets))
+        return len(offsets)
+
+    def append(self, user_id, messages: List[dict]) -> None:
+        """
+        Append messages to the log of the user with a single write.
+        """
+        if not messages:
+            return
+        if not self.exists(user_id):
+            self._write(user_id, [])
+        count = self._repair(user_id)
+        position = self._read_entry(user_id, count - 1) if count else 0
+        lines = [(json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8") for message in messages]
+
+        offsets = []
+        for line in lines:
+            position += len(line)
+            offsets.append(position)
+        with open(self._log_path(user_id), "ab") as log:
+            log.write(b"".join(lines))
+            log.flush()
+            if self.fsync:
+                os.fsync(log.fileno())
+        # The log is written first: an index behind its log is completed on the next access
+        with open(self._index_path(user_id), "ab") as index:
+            index.write(b"".join(INDEX_ENTRY.pack(offset) for offset in offsets))
+
+    def count(self, user_id) -> int:
+        """
+        Return the number of messages in the log of the user.
+        """
+        return self._repair(user_id) if self.exists(user_id) else 0
+
+    def tail(self, user_id, n: Optional[int] = None) -> List[dict]:
+        """
+        Return the last n messages of the user, or all of them if n is None.
+        """
+        if not self.exists(user_id):
+            return []
+        count = self._repair(user_id)
+        # A message starts where the one before it ends
+        start = self._read_entry(user_id, count - n - 1) if n is not None and n < count else 0
+        with open(self._log_path(user_id), "rb") as log:
+            log.seek(start)
+            data = log.read()
+        return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+    def compact(self, user_id, keep: Optional[int] = None) -> None:
+        """
+        Rewrite the log of the user as a fresh snapshot, keeping only the last `keep` messages if given.
+        """
+        if self.exists(user_id):
+            self._write(user_id, self.tail(user_id, keep))
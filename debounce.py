@@ -0,0 +1,147 @@
+import asyncio
+import heapq
+import itertools
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+Flush = Callable[[Hashable, List[Any]], Awaitable[None]]
+
+
+class _Batch:
+    def __init__(self, batch_id: int, now: float, deadline: float) -> None:
+        self.batch_id = batch_id
+        self.items: List[Any] = []
+        self.started = now
+        self.deadline = deadline
+
+
+class DebounceScheduler:
+    """
+    Collects items per key and flushes them as one batch once the key has been quiet.
+
+    A batch is flushed `window` seconds after its last item, but never later than `max_wait`
+    seconds after its first one, or as soon as it holds `max_batch` items. Every batch is
+    flushed exactly once; items added while a batch is being flushed start a new one.
+
+    All deadlines are kept in one heap driven by a single task, with one heap entry per
+    buffering key: a new item only moves its batch's deadline, and the entry is pushed back
+    when it comes up before that deadline. The task waits for the earliest deadline on an event
+    loop timer, even one already past, so items whose timers came due first, e.g. the next
+    message of a user, are added before the batch is looked at; a lagging loop re-queues such
+    a batch instead of flushing part of it.
+
+    Args:
+        flush: Coroutine called with the key and the items of a batch.
+        window: Seconds of quiet after which a batch is flushed.
+        max_wait: Maximum seconds between the first item of a batch and its flush.
+        max_batch: Maximum number of items in a batch.
+    """
+
+    def __init__(self, flush: Flush, window: float = 3.0, max_wait: float = 15.0, max_batch: int = 20) -> None:
+        self.flush = flush
+        self.window = window
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self._batches: Dict[Hashable, _Batch] = {}
+        self._deadlines: List[Tuple[float, int, Hashable]] = []
+        self._ids = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._flushing = set()
+        # Deadline of the timer that fired last, None until the running task handles it
+        self._due: Optional[float] = None
+
+    def add(self, key: Hashable, item: Any) -> None:
+        """
+        Add an item to the batch of a key, starting a new batch if there is none.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        now = asyncio.get_running_loop().time()
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _Batch(next(self._ids), now, now + self.window)
+            heapq.heappush(self._deadlines, (batch.deadline, batch.batch_id, key))
+            if self._deadlines[0][1] == batch.batch_id:
+                self._wakeup.set()
+        else:
+            batch.deadline = min(now + self.window, batch.started + self.max_wait)
+        batch.items.append(item)
+        if len(batch.items) >= self.max_batch:
+            self._flush(key)
+
+    def pending(self, key: Hashable) -> List[Any]:
+        """
+        Return the items of a key waiting to be flushed.
+        """
+        batch = self._batches.get(key)
+        return list(batch.items) if batch is not None else []
+
+    def _flush(self, key: Hashable) -> None:
+        # The heap entry of the batch becomes stale and is dropped when it comes up
+        batch = self._batches.pop(key)
+        task = asyncio.create_task(self._call_flush(key, batch.items))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _call_flush(self, key: Hashable, items: List[Any]) -> None:
+        try:
+            await self.flush(key, items)
+        except Exception as e:
+            print(f"Flushing the batch of {key} failed: {e}")
+
+    def _expire(self, deadline: float) -> None:
+        self._due = deadline
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            if self._due is not None:
+                self._flush_due(self._due)
+                self._due = None
+            if not self._deadlines:
+                await self._wakeup.wait()
+                continue
+
+            timer = loop.call_at(self._deadlines[0][0], self._expire, self._deadlines[0][0])
+            try:
+                await self._wakeup.wait()
+            finally:
+                timer.cancel()
+
+    def _flush_due(self, due: float) -> None:
+        # Flush the batches whose deadline passed by the time the timer of `due` fired
+        while self._deadlines and self._deadlines[0][0] <= due:
+            deadline, batch_id, key = self._deadlines[0]
+            batch = self._batches.get(key)
+            if batch is None or batch.batch_id != batch_id:
+                heapq.heappop(self._deadlines)
+            elif batch.deadline > deadline:
+                # New items moved the deadline since the entry was pushed
+                heapq.heapreplace(self._deadlines, (batch.deadline, batch_id, key))
+            else:
+                heapq.heappop(self._deadlines)
+                self._flush(key)
+
+    def stats(self) -> dict:
+        return {
+            "buffering": len(self._batches),
+            "buffered_items": sum(len(batch.items) for batch in self._batches.values()),
+            "flushing": len(self._flushing),
+        }
+
+    async def close(self, flush_pending: bool = True) -> None:
+        """
+        Stop the scheduler, flushing the batches still buffered unless told otherwise.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if flush_pending:
+            for key in list(self._batches):
+                self._flush(key)
+        self._batches.clear()
+        self._deadlines.clear()
+        if self._flushing:
+            await asyncio.gather(*self._flushing)
@@ -0,0 +1,245 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional, Dict, Iterator
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize text for cache lookups: collapse whitespace and ignore case.
+    """
+    return " ".join(text.split()).casefold()
+
+
+class DiskEmbeddingStore:
+    """
+    An append-only on-disk table of embeddings.
+
+    Vectors are stored as rows of a float32 matrix that is read through a memory map, and
+    their keys are stored one per line in a companion file, so row i belongs to line i.
+    A vector is written before its key; a vector without a key, left by a crash, is cut off
+    before the next append. Appends hold an exclusive lock on a lock file and first read the
+    keys other processes appended, so the API and ingest.py can share the files.
+
+    Args:
+        directory: Directory of the cache files.
+        name: Base name of the cache files, usually derived from the model name.
+    """
+
+    def __init__(self, directory: Path, name: str) -> None:
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+        self._vectors_path = directory / f"{name}.f32"
+        self._keys_path = directory / f"{name}.keys"
+        self._meta_path = directory / f"{name}.json"
+        self._lock_path = directory / f"{name}.lock"
+
+        self.dimension = None
+        self._rows: Dict[str, int] = {}
+        # Number of complete key lines read and the byte offset where they end
+        self._row_count = 0
+        self._keys_offset = 0
+        self._matrix = None
+        with self._locked():
+            self._catch_up()
+            self._repair()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        with open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _catch_up(self) -> None:
+        # Read the dimension and the keys appended since the last read, by any process
+        if self.dimension is None and self._meta_path.is_file():
+            self.dimension = json.loads(self._meta_path.read_text())["dimension"]
+        if not self._keys_path.is_file():
+            return
+        with open(self._keys_path, "rb") as f:
+            f.seek(self._keys_offset)
+            data = f.read()
+        # A line without its line break was cut short by a crash
+        data = data[:data.rfind(b"\n") + 1]
+        for line in data.splitlines():
+            # A key added by two processes keeps its first row
+            self._rows.setdefault(line.decode("utf-8"), self._row_count)
+            self._row_count += 1
+        self._keys_offset += len(data)
+
+    def _repair(self) -> None:
+        # Drop a partial key line and the vectors without a key
+        if self._keys_path.is_file() and os.path.getsize(self._keys_path) > self._keys_offset:
+            os.truncate(self._keys_path, self._keys_offset)
+        if self.dimension and self._vectors_path.is_file():
+            size = self._row_count * 4 * self.dimension
+            if os.path.getsize(self._vectors_path) > size:
+                os.truncate(self._vectors_path, size)
+
+    def _map(self) -> np.memmap:
+        if self._matrix is None or self._matrix.shape[0] < self._row_count:
+            self._matrix = np.memmap(
+                self._vectors_path, dtype=np.float32, mode="r", shape=(self._row_count, self.dimension)
+            )
+        return self._matrix
+
+    def get(self, key: str) -> Optional[List[float]]:
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        return self._map()[row].tolist()
+
+    def add(self, key: str, vector: List[float]) -> None:
+        if key in self._rows:
+            return
+        with self._locked():
+            self._catch_up()
+            if key in self._rows:
+                return
+            if self.dimension is None:
+                self.dimension = len(vector)
+                self._meta_path.write_text(json.dumps({"dimension": self.dimension}))
+            self._repair()
+            with open(self._vectors_path, "ab") as f:
+                f.write(np.asarray(vector, dtype=np.float32).tobytes())
+            line = (key + "\n").encode("utf-8")
+            with open(self._keys_path, "ab") as f:
+                f.write(line)
+            self._rows[key] = self._row_count
+            self._row_count += 1
+            self._keys_offset += len(line)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings object with a content-addressed cache.
+
+    Texts are keyed by model name, kind (query or document) and normalized text. Lookups go
+    to an in-memory LRU first, then to an optional DiskEmbeddingStore, and only misses are
+    sent to the wrapped embeddings, de-duplicated within a call.
+
+    Args:
+        embeddings: The embeddings to wrap.
+        model: Name of the embedding model, part of every cache key.
+        cache_dir: Directory of the on-disk tier; None keeps the cache in memory only.
+        max_memory_items: Number of vectors kept in the in-memory LRU.
+    """
+
+    def __init__(
+            self,
+            embeddings: Embeddings,
+            model: str,
+            cache_dir: Optional[Path] = None,
+            max_memory_items: int = 10000,
+    ) -> None:
+        self.embeddings = embeddings
+        self.model = model
+        self.max_memory_items = max_memory_items
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._disk = DiskEmbeddingStore(cache_dir, model) if cache_dir else None
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _key(self, kind: str, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{kind}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, key: str) -> Optional[List[float]]:
+        vector = self._memory.get(key)
+        if vector is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return vector
+        if self._disk is not None:
+            vector = self._disk.get(key)
+            if vector is not None:
+                self.disk_hits += 1
+                self._remember(key, vector)
+                return vector
+        return None
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _store(self, key: str, vector: List[float]) -> None:
+        self._remember(key, vector)
+        if self._disk is not None:
+            self._disk.add(key, vector)
+
+    def _embed_many(self, kind: str, texts: List[str], embed) -> List[List[float]]:
+        keys = [self._key(kind, text) for text in texts]
+        vectors = {}
+        missing = {}
+        with self._lock:
+            for key, text in zip(keys, texts):
+                if key in vectors or key in missing:
+                    continue
+                vector = self._lookup(key)
+                if vector is None:
+                    missing[key] = text
+                else:
+                    vectors[key] = vector
+
+        if missing:
+            embedded = embed(list(missing.values()))
+            with self._lock:
+                self.misses += len(missing)
+                for key, vector in zip(missing, embedded):
+                    self._store(key, vector)
+                    vectors[key] = vector
+        return [vectors[key] for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed_many("document", texts, self.embeddings.embed_documents)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed several queries, sending all cache misses in a single request.
+        """
+        # OpenAI embeds queries and documents the same way, so misses can share one request
+        return self._embed_many("query", texts, self.embeddings.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key("query", text)
+        with self._lock:
+            vector = self._lookup(key)
+        if vector is not None:
+            return vector
+
+        vector = self.embeddings.embed_query(text)
+        with self._lock:
+            self.misses += 1
+            self._store(key, vector)
+        return vector
+
+    def stats(self) -> dict:
+        """
+        Return the hit and miss counters of the cache.
+        """
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_items": len(self._memory),
+            "disk_items": len(self._disk) if self._disk is not None else 0,
+        }
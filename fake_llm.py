@@ -0,0 +1,93 @@
+import hashlib
+import threading
+import time
+from collections import deque
+from typing import List, Optional, Any
+
+import numpy as np
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.chat_models.base import SimpleChatModel
+from langchain.embeddings.base import Embeddings
+from langchain.schema import BaseMessage
+from openai.error import RateLimitError
+
+
+class FakeChatModel(SimpleChatModel):
+    """
+    A chat model that streams a fixed text word by word over an artificial delay.
+
+    Used to benchmark and exercise the API without calling OpenAI.
+
+    Args:
+        response: Text returned for every call.
+        latency: Seconds spent "generating" the whole response, spread over its words.
+    """
+
+    response: str = "I hear you. Could you tell me a little more about how that made you feel?"
+    latency: float = 1.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def get_num_tokens(self, text: str) -> int:
+        # Words stand in for tokens, so no tokenizer has to be installed
+        return len(text.split())
+
+    def _call(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> str:
+        tokens = self.response.split(" ")
+        for i, token in enumerate(tokens):
+            time.sleep(self.latency / len(tokens))
+            if run_manager:
+                run_manager.on_llm_new_token(token if i == 0 else " " + token)
+        return self.response
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Embeddings that behave like a rate limited embedding server without calling OpenAI.
+
+    Vectors are derived from a hash of the text, so the same text always gets the same vector.
+
+    Args:
+        dimension: Size of the returned vectors.
+        latency: Seconds per request.
+        requests_per_minute: Requests allowed per sliding minute before RateLimitError is raised.
+    """
+
+    def __init__(self, dimension: int = 1536, latency: float = 0.2, requests_per_minute: int = 3000) -> None:
+        self.dimension = dimension
+        self.latency = latency
+        self.requests_per_minute = requests_per_minute
+        self.requests = 0
+        self._recent = deque()
+        self._lock = threading.Lock()
+
+    def _request(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+            if len(self._recent) >= self.requests_per_minute:
+                raise RateLimitError("Rate limit reached", headers={"Retry-After": "1"})
+            self._recent.append(now)
+            self.requests += 1
+        time.sleep(self.latency)
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        return np.random.default_rng(seed).standard_normal(self.dimension, dtype=np.float32).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._request()
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self._request()
+        return self._vector(text)
@@ -0,0 +1,99 @@
+"""
+Export the conversation history, e.g. for analytics or a user's data request.
+
+The history holds the users' therapy conversations, so the export is an operator tool run
+against the database and not an endpoint of the public API:
+    python history_export.py --sql_config config/sql_config_prod.json --format csv --output history.csv
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import io
+import json
+import sys
+from pathlib import Path
+from typing import AsyncIterator, List, Optional
+
+from async_sql_writer import AsyncSQLHistoryWriter
+from sql_writer import HISTORY_EXPORT_COLUMNS
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+def ndjson_chunk(rows: List[tuple]) -> str:
+    """
+    Format history rows as newline-delimited JSON objects.
+    """
+    return "".join(
+        json.dumps(dict(zip(HISTORY_EXPORT_COLUMNS, map(_value, row))), ensure_ascii=False) + "\n" for row in rows
+    )
+
+
+def csv_chunk(rows: List[tuple], header: bool = False) -> str:
+    """
+    Format history rows as CSV lines, preceded by the column names if header is set.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(HISTORY_EXPORT_COLUMNS)
+    writer.writerows([_value(value) for value in row] for row in rows)
+    return buffer.getvalue()
+
+
+async def export_history(
+        writer: AsyncSQLHistoryWriter,
+        export_format: str = "ndjson",
+        user_id: Optional[str] = None,
+        page_size: int = 1000,
+) -> AsyncIterator[str]:
+    """
+    Yield the ConversationHistory table, or the history of one user, as NDJSON or CSV.
+
+    Rows are read a page at a time with keyset pagination, so memory use does not depend on
+    the size of the table and no database connection is held while the client reads.
+
+    Args:
+        writer: The database pool of the backend.
+        export_format: One of EXPORT_FORMATS.
+        user_id: Only export the history of this user (default: all users).
+        page_size: Number of rows read and sent at a time.
+    """
+    if export_format == "csv":
+        yield csv_chunk([], header=True)
+    async for rows in writer.iter_history_pages(user_id, page_size=page_size):
+        yield csv_chunk(rows) if export_format == "csv" else ndjson_chunk(rows)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export the conversation history as NDJSON or CSV.")
+    parser.add_argument("--sql_config", help="Database configuration file", type=Path,
+                        default=Path("config/sql_config_prod.json"))
+    parser.add_argument("--format", help="Output format", choices=list(EXPORT_FORMATS), default="ndjson")
+    parser.add_argument("--user_id", help="Only export the history of this user", type=str, default=None)
+    parser.add_argument("--output", help="Output file (default: standard output)", type=Path, default=None)
+    parser.add_argument("--page_size", help="Rows read at a time", type=int, default=1000)
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+    writer = AsyncSQLHistoryWriter.from_config(args.sql_config)
+    await writer.open()
+    output = sys.stdout if args.output is None else open(args.output, "w", encoding="utf-8", newline="")
+    try:
+        async for chunk in export_history(writer, args.format, args.user_id, page_size=args.page_size):
+            output.write(chunk)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        await writer.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,171 @@
+import asyncio
+import datetime
+import json
+import os
+from collections import deque
+from pathlib import Path
+from typing import List, Optional, Tuple, TYPE_CHECKING
+
+import psycopg2
+
+if TYPE_CHECKING:
+    from async_sql_writer import AsyncSQLHistoryWriter
+
+# user_id, user_message, chatbot_message, timestamp
+HistoryRow = Tuple[str, str, str, datetime.datetime]
+
+
+class HistoryQueue:
+    """
+    Write-behind queue of ConversationHistory rows, inserted in batches off the response path.
+
+    Rows are inserted with one multi-row INSERT per batch, once max_batch rows are waiting or
+    every flush_interval seconds. A batch that cannot be written is appended to an NDJSON spool
+    file and replayed after the next successful flush, so history survives a database outage
+    and, once spooled, a restart. Rows still in memory are lost if the process is killed.
+
+    Args:
+        writer: The database pool of the backend.
+        spool_path: NDJSON file holding the rows that could not be written.
+        max_batch: Number of waiting rows that triggers a flush, and the maximum size of a batch.
+        flush_interval: Maximum number of seconds a row waits before it is written.
+    """
+
+    def __init__(
+            self,
+            writer: "AsyncSQLHistoryWriter",
+            spool_path: Path,
+            max_batch: int = 500,
+            flush_interval: float = 1.0,
+    ) -> None:
+        self.writer = writer
+        self.spool_path = Path(spool_path)
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._rows = deque()
+        self._wakeup = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._written = 0
+        self._spooled = 0
+        self._dropped = 0
+
+    def put(self, user_id: str, user_message: str, chatbot_message: str,
+            timestamp: Optional[datetime.datetime] = None) -> None:
+        """
+        Queue a history row; it is written by the background task.
+        """
+        self._rows.append((user_id, user_message, chatbot_message, timestamp or datetime.datetime.now()))
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+        if len(self._rows) >= self.max_batch:
+            self._wakeup.set()
+
+    async def _write(self, rows: List[HistoryRow]) -> None:
+        try:
+            await self.writer.write_messages(rows)
+            self._written += len(rows)
+        except (psycopg2.DataError, psycopg2.IntegrityError):
+            # A row the database rejects must not hold back the rest of its batch
+            for row in rows:
+                try:
+                    await self.writer.write_messages([row])
+                    self._written += 1
+                except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+                    self._dropped += 1
+                    print(f"Dropping history row of user {row[0]}: {e}")
+
+    async def flush(self) -> None:
+        """
+        Write the waiting rows in batches, spooling them if the database is unavailable.
+        """
+        while self._rows:
+            count = min(len(self._rows), self.max_batch)
+            rows = [self._rows.popleft() for _ in range(count)]
+            try:
+                await self._write(rows)
+            except Exception as e:
+                print(f"Writing history failed, spooling {len(rows) + len(self._rows)} rows: {e}")
+                rows.extend(self._rows)
+                self._rows.clear()
+                await asyncio.get_running_loop().run_in_executor(None, self._spool, rows)
+                return
+        if self.spool_path.is_file():
+            await self._replay()
+
+    def _spool(self, rows: List[HistoryRow], path: Optional[Path] = None) -> None:
+        path = path or self.spool_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as spool:
+            for user_id, user_message, chatbot_message, timestamp in rows:
+                spool.write(json.dumps([user_id, user_message, chatbot_message, timestamp.isoformat()],
+                                       ensure_ascii=False) + "\n")
+            spool.flush()
+            os.fsync(spool.fileno())
+        self._spooled += len(rows)
+
+    def _read_spool(self) -> List[HistoryRow]:
+        rows = []
+        for line in self.spool_path.read_text(encoding="utf-8").splitlines():
+            try:
+                user_id, user_message, chatbot_message, timestamp = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                continue
+            rows.append((user_id, user_message, chatbot_message, datetime.datetime.fromisoformat(timestamp)))
+        return rows
+
+    def _rewrite_spool(self, rows: List[HistoryRow]) -> None:
+        tmp_path = self.spool_path.with_name(self.spool_path.name + ".tmp")
+        tmp_path.unlink(missing_ok=True)
+        self._spooled = 0
+        self._spool(rows, tmp_path)
+        os.replace(tmp_path, self.spool_path)
+
+    async def _replay(self) -> None:
+        # Only the flush task writes to the spool, so nothing is appended while replaying
+        loop = asyncio.get_running_loop()
+        rows = await loop.run_in_executor(None, self._read_spool)
+        for start in range(0, len(rows), self.max_batch):
+            batch = rows[start:start + self.max_batch]
+            try:
+                await self._write(batch)
+            except Exception as e:
+                print(f"Replaying the history spool failed: {e}")
+                if start:
+                    await loop.run_in_executor(None, self._rewrite_spool, rows[start:])
+                return
+        self.spool_path.unlink(missing_ok=True)
+        self._spooled = 0
+        print(f"Replayed {len(rows)} spooled history rows")
+
+    async def _flush_loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Saving history failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "waiting": len(self._rows),
+            "written": self._written,
+            "spooled": self._spooled,
+            "dropped": self._dropped,
+        }
+
+    async def close(self) -> None:
+        """
+        Stop the background task and write or spool the waiting rows.
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
@@ -0,0 +1,119 @@
+import asyncio
+import random
+from typing import Callable, List, Sequence, Tuple, Any
+
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+from openai.error import RateLimitError
+
+from rate_limit import TokenBucket
+
+Item = Tuple[Any, Document]
+
+
+class EmbeddingBatchError(Exception):
+    """
+    Raised when some batches could not be embedded after all retries.
+    """
+
+
+class IndexBuilder:
+    """
+    Embeds documents in concurrent batches and streams the vectors to a callback.
+
+    Batches are paced by a requests-per-minute token bucket, a rate limit response pauses
+    every worker for its retry-after period, and only the failed batch is retried. At most
+    2 * max_concurrency batches are pending at a time, and every batch is handed to the
+    callback as soon as it is embedded, so memory stays bounded regardless of corpus size.
+
+    Args:
+        embeddings: Embeddings used for the documents.
+        batch_size: Number of documents per embedding request.
+        max_concurrency: Number of embedding requests in flight.
+        requests_per_minute: Request budget of the embedding API.
+        max_retries: Attempts per batch before giving up on it.
+    """
+
+    def __init__(
+            self,
+            embeddings: Embeddings,
+            batch_size: int = 64,
+            max_concurrency: int = 4,
+            requests_per_minute: float = 3000,
+            max_retries: int = 6,
+    ) -> None:
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate=requests_per_minute / 60, capacity=max_concurrency)
+
+    async def _embed(self, batch: List[Item]) -> List[List[float]]:
+        loop = asyncio.get_running_loop()
+        texts = [document.page_content for _, document in batch]
+        for attempt in range(1, self.max_retries + 1):
+            await self._bucket.acquire()
+            try:
+                return await loop.run_in_executor(None, self.embeddings.embed_documents, texts)
+            except RateLimitError as e:
+                retry_after = (e.headers or {}).get("Retry-After")
+                wait = float(retry_after) if retry_after else min(60.0, 2 ** attempt)
+                # Every worker shares the bucket, so they all back off together
+                self._bucket.pause(wait)
+                error = e
+            except Exception as e:
+                await asyncio.sleep(min(60.0, 2 ** attempt) * random.uniform(0.5, 1.0))
+                error = e
+            print(f"Embedding batch of {len(batch)} failed (attempt {attempt}/{self.max_retries}): {error}")
+        raise error
+
+    async def run(
+            self,
+            items: Sequence[Item],
+            on_batch: Callable[[List[Item], List[List[float]]], None],
+    ) -> None:
+        """
+        Embed all items and call on_batch with every embedded batch as it completes.
+
+        Args:
+            items: Pairs of a caller-defined key and the document to embed.
+            on_batch: Called on the event loop thread with a batch and its vectors.
+
+        Raises:
+            EmbeddingBatchError: If batches still failed after max_retries attempts; the
+                batches that succeeded have already been passed to on_batch.
+        """
+        queue = asyncio.Queue(maxsize=2 * self.max_concurrency)
+        failed = []
+
+        async def worker():
+            while True:
+                batch = await queue.get()
+                try:
+                    if batch is None:
+                        return
+                    try:
+                        vectors = await self._embed(batch)
+                    except Exception as e:
+                        failed.append((batch, e))
+                    else:
+                        on_batch(batch, vectors)
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.max_concurrency)]
+        try:
+            for start in range(0, len(items), self.batch_size):
+                await queue.put(list(items[start:start + self.batch_size]))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+        if failed:
+            raise EmbeddingBatchError(
+                f"{len(failed)} batches ({sum(len(batch) for batch, _ in failed)} documents) failed, "
+                f"last error: {failed[-1][1]}"
+            )
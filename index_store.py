@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import shutil
+import threading
+from pathlib import Path
+from typing import List, Optional, Sequence, Dict
+
+from langchain.embeddings.base import Embeddings
+from langchain.schema import BaseRetriever, Document
+from langchain.vectorstores import FAISS
+
+from retrieval import RetrievalEngine, QueryBatcher
+
+INDEX_DIR = "data_store"
+KB_FILE = "kb.pdf"
+MANIFEST_FILE = "manifest.json"
+CHUNKS_FILE = "chunks.json"
+SOURCE_SUFFIXES = (".pdf", ".txt", ".md")
+MANIFEST_VERSION = 1
+
+
+class IndexNotBuiltError(Exception):
+    """
+    Raised when the server needs the FAISS index but it has not been built yet.
+    """
+
+
+def source_hash(sources: Sequence[Path], embedding_model: str) -> str:
+    """
+    Hash the content of the source documents together with the embedding model.
+
+    Args:
+        sources: Paths of the source documents.
+        embedding_model: Name of the model used to embed them.
+    """
+    digest = hashlib.sha256(embedding_model.encode("utf-8"))
+    for path in sorted(Path(source) for source in sources):
+        digest.update(str(path).encode("utf-8"))
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(index_dir: Path) -> Optional[dict]:
+    """
+    Return the manifest stored next to the index, or None if there is none.
+    """
+    path = Path(index_dir) / MANIFEST_FILE
+    if not path.is_file():
+        return None
+    return json.loads(path.read_text())
+
+
+def discover_sources(paths: Sequence[Path]) -> List[Path]:
+    """
+    Expand directories into the supported documents they contain.
+
+    Args:
+        paths: Files and directories given on the command line.
+    """
+    sources = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            sources.extend(
+                sorted(p for p in path.rglob("*") if p.is_file() and p.suffix.lower() in SOURCE_SUFFIXES)
+            )
+        else:
+            sources.append(path)
+    return sources
+
+
+def manifest_sources(manifest: dict) -> List[Path]:
+    """
+    Return the source documents an index was built from, rediscovering the directories it was
+    built from so documents added to them since the build are included.
+    """
+    return discover_sources(manifest.get("inputs") or manifest.get("sources") or [])
+
+
+def save_index(vector_store: FAISS, index_dir: Path, manifest: dict, chunks: Dict[str, str]) -> None:
+    """
+    Save the index, its manifest and its chunk table, replacing the previous index at once.
+
+    The index is written to a temporary directory and swapped in when complete, so a
+    server never loads a half-written index.
+
+    Args:
+        vector_store: The index to save.
+        index_dir: Directory the index is saved to.
+        manifest: Build information stored in manifest.json.
+        chunks: Mapping of chunk hash to docstore id stored in chunks.json.
+    """
+    index_dir = Path(index_dir)
+    tmp_dir = index_dir.with_name(index_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    vector_store.save_local(str(tmp_dir))
+    (tmp_dir / CHUNKS_FILE).write_text(json.dumps(chunks))
+    (tmp_dir / MANIFEST_FILE).write_text(json.dumps(manifest, indent=2))
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    tmp_dir.rename(index_dir)
+
+
+def read_chunks(index_dir: Path) -> Dict[str, str]:
+    """
+    Return the chunk hash to docstore id table of an index, or an empty one.
+    """
+    path = Path(index_dir) / CHUNKS_FILE
+    if not path.is_file():
+        return {}
+    return json.loads(path.read_text())
+
+
+class LazyVectorStore:
+    """
+    Loads a prebuilt FAISS index on first use instead of at import time.
+
+    The server never embeds documents itself: a missing index raises IndexNotBuiltError and
+    a stale one (sources or embedding model changed since the build) is served with a warning
+    until the build command is run again. Unless sources are given, the index is checked
+    against the sources recorded in its manifest.
+
+    Args:
+        index_dir: Directory written by ingest.refresh_index.
+        embeddings: Embeddings used to embed queries; must match the index.
+        embedding_model: Name of the embedding model, compared with the manifest.
+        sources: Source documents or directories the index should be built from (default: the ones in the manifest).
+        retrieval: Keyword arguments of the RetrievalEngine (index type, quantization, k, ...).
+    """
+
+    def __init__(
+            self,
+            index_dir: Path,
+            embeddings: Embeddings,
+            embedding_model: str,
+            sources: Optional[Sequence[Path]] = None,
+            retrieval: Optional[dict] = None,
+    ) -> None:
+        self.index_dir = Path(index_dir)
+        self.embeddings = embeddings
+        self.embedding_model = embedding_model
+        self.sources = None if sources is None else discover_sources(sources)
+        self.retrieval = retrieval or {}
+        self.manifest = None
+        self._vector_store = None
+        self._batcher = None
+        self._lock = threading.Lock()
+
+    def get(self) -> FAISS:
+        """
+        Return the loaded index, loading it on the first call.
+
+        Raises:
+            IndexNotBuiltError: If no index exists in index_dir.
+        """
+        if self._vector_store is None:
+            with self._lock:
+                if self._vector_store is None:
+                    self._vector_store = self._load()
+        return self._vector_store
+
+    def batcher(self) -> QueryBatcher:
+        """
+        Return the query batcher over the configured RetrievalEngine, building it on the first call.
+        """
+        if self._batcher is None:
+            vector_store = self.get()
+            with self._lock:
+                if self._batcher is None:
+                    engine = RetrievalEngine(
+                        vector_store,
+                        embed_queries=getattr(self.embeddings, "embed_queries", None),
+                        **self.retrieval
+                    )
+                    self._batcher = QueryBatcher(engine)
+        return self._batcher
+
+    def _load(self) -> FAISS:
+        if not (self.index_dir / "index.faiss").is_file():
+            raise IndexNotBuiltError(
+                f"No FAISS index in {self.index_dir}, run `python ingest.py` first"
+            )
+
+        self.manifest = read_manifest(self.index_dir)
+        if self.manifest is None:
+            print(f"Index in {self.index_dir} has no manifest, rebuild it to enable staleness checks.")
+        elif self.manifest["embedding_model"] != self.embedding_model:
+            print(f"Index was built with {self.manifest['embedding_model']}, queries use {self.embedding_model}.")
+        elif self._stale():
+            print(f"Index version {self.manifest['index_version']} is stale, run `python ingest.py`.")
+
+        vector_store = FAISS.load_local(str(self.index_dir), self.embeddings)
+        print("Loaded from local disk.")
+        return vector_store
+
+    def _stale(self) -> bool:
+        sources = manifest_sources(self.manifest) if self.sources is None else self.sources
+        try:
+            return self.manifest["source_hash"] != source_hash(sources, self.embedding_model)
+        except FileNotFoundError:
+            # A source document was moved or deleted since the build
+            return True
+
+    def load_in_background(self) -> threading.Thread:
+        """
+        Start loading the index and building the retrieval engine on a daemon thread, so the
+        first retrieval does not wait for them.
+        """
+        def load():
+            try:
+                self.batcher()
+            except IndexNotBuiltError as e:
+                print(e)
+
+        thread = threading.Thread(target=load, name="faiss-load", daemon=True)
+        thread.start()
+        return thread
+
+    def as_retriever(self) -> "LazyRetriever":
+        return LazyRetriever(store=self)
+
+
+class LazyRetriever(BaseRetriever):
+    """
+    A retriever that resolves its LazyVectorStore on the first query.
+
+    Queries of concurrent requests are batched into one vectorized search.
+    """
+
+    def __init__(self, store: LazyVectorStore) -> None:
+        self.store = store
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        return self.store.batcher().search(query)
+
+    async def aget_relevant_documents(self, query: str) -> List[Document]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get_relevant_documents, query)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Show the state of the knowledge base FAISS index.")
+    parser.add_argument("--source", help="Source documents or directories (default: the ones in the manifest)",
+                        type=Path, nargs="+")
+    parser.add_argument("--index_dir", help="Index directory", type=Path, default=Path(INDEX_DIR))
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    manifest = read_manifest(args.index_dir)
+    if manifest is None:
+        print(f"No manifest in {args.index_dir}.")
+    else:
+        sources = manifest_sources(manifest) if args.source is None else discover_sources(args.source)
+        try:
+            current = source_hash(sources, manifest["embedding_model"])
+        except FileNotFoundError:
+            current = None
+        print(json.dumps(manifest, indent=2))
+        print("Index is up to date." if current == manifest["source_hash"] else "Index is stale, run `python ingest.py`.")
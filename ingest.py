@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import uuid
+from collections import Counter
+from pathlib import Path
+from typing import List, Sequence, Dict, Tuple
+
+import faiss
+import numpy as np
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.document_loaders import PyPDFLoader, TextLoader
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+from langchain.vectorstores import FAISS
+
+from embedding_cache import CachedEmbeddings
+from index_builder import IndexBuilder, EmbeddingBatchError
+from index_store import INDEX_DIR, KB_FILE, MANIFEST_VERSION, discover_sources, source_hash, read_manifest, \
+    read_chunks, save_index
+
+
+def load_chunks(source: Path) -> List[Document]:
+    """
+    Load a PDF or text document and split it into chunks.
+    """
+    if source.suffix.lower() == ".pdf":
+        loader = PyPDFLoader(str(source))
+    else:
+        loader = TextLoader(str(source), encoding="utf-8")
+    return loader.load_and_split()
+
+
+def hash_chunks(documents: Sequence[Document]) -> Dict[str, Document]:
+    """
+    Key every chunk by the hash of its source and content.
+
+    Metadata such as the page number is left out of the key, so a chunk that only moved
+    within its document keeps its embedding. Identical chunks in the same source are told
+    apart by their occurrence number.
+    """
+    chunks = {}
+    occurrences = Counter()
+    for document in documents:
+        identity = (document.metadata.get("source", ""), document.page_content)
+        occurrences[identity] += 1
+        digest = hashlib.sha256()
+        digest.update(json.dumps([*identity, occurrences[identity]]).encode("utf-8"))
+        chunks[digest.hexdigest()] = document
+    return chunks
+
+
+def empty_store(embeddings: Embeddings, dimension: int) -> FAISS:
+    """
+    Create an empty flat FAISS store for vectors of the given dimension.
+    """
+    return FAISS(embeddings.embed_query, faiss.IndexFlatL2(dimension), InMemoryDocstore({}), {})
+
+
+def add_embeddings(
+        vector_store: FAISS,
+        documents: Sequence[Document],
+        vectors: Sequence[Sequence[float]],
+) -> List[str]:
+    """
+    Append already embedded documents to a store.
+
+    Returns:
+        list: The docstore ids of the added documents.
+    """
+    start = vector_store.index.ntotal
+    vector_store.index.add(np.array(vectors, dtype=np.float32))
+    ids = [str(uuid.uuid4()) for _ in documents]
+    vector_store.docstore.add(dict(zip(ids, documents)))
+    vector_store.index_to_docstore_id.update({start + i: docstore_id for i, docstore_id in enumerate(ids)})
+    return ids
+
+
+def remove_documents(vector_store: FAISS, docstore_ids: Sequence[str]) -> None:
+    """
+    Remove documents and their vectors from a flat store.
+
+    A flat index shifts the remaining vectors down when ids are removed, so the
+    position to docstore id mapping is renumbered in the same order.
+    """
+    removed = set(docstore_ids)
+    if not removed:
+        return
+    positions = [position for position, docstore_id in vector_store.index_to_docstore_id.items()
+                 if docstore_id in removed]
+    vector_store.index.remove_ids(np.array(positions, dtype=np.int64))
+    remaining = [docstore_id for _, docstore_id in sorted(vector_store.index_to_docstore_id.items())
+                 if docstore_id not in removed]
+    vector_store.index_to_docstore_id = dict(enumerate(remaining))
+    for docstore_id in removed:
+        # InMemoryDocstore has no delete method
+        vector_store.docstore._dict.pop(docstore_id, None)
+
+
+def refresh_index(
+        sources: Sequence[Path],
+        index_dir: Path,
+        embeddings: Embeddings,
+        embedding_model: str,
+        force: bool = False,
+        batch_size: int = 64,
+        max_concurrency: int = 4,
+        requests_per_minute: float = 3000,
+) -> Tuple[int, int, int]:
+    """
+    Bring the FAISS index in line with the source documents, embedding only what changed.
+
+    Chunks are tracked by content hash in chunks.json: new or modified chunks are embedded
+    and added, chunks that disappeared are removed, unchanged chunks keep their vectors.
+
+    Args:
+        sources: Source documents or directories of PDF and text files.
+        index_dir: Directory of the index.
+        embeddings: Embeddings used to embed new chunks.
+        embedding_model: Name of the embedding model, stored in the manifest.
+        force: Discard the existing index and embed everything again.
+        batch_size: Number of chunks per embedding request.
+        max_concurrency: Number of embedding requests in flight.
+        requests_per_minute: Request budget of the embedding API.
+
+    Returns:
+        tuple: Number of added, removed and unchanged chunks.
+
+    Raises:
+        EmbeddingBatchError: If some batches failed; the rest is saved and picked up by the next run.
+    """
+    index_dir = Path(index_dir)
+    inputs = [str(source) for source in sources]
+    sources = discover_sources(sources)
+    current_hash = source_hash(sources, embedding_model)
+    manifest = read_manifest(index_dir)
+    if manifest and manifest["embedding_model"] != embedding_model:
+        # Vectors of different models cannot share an index
+        force = True
+    if not force and manifest and manifest["source_hash"] == current_hash:
+        return 0, 0, manifest.get("chunk_count", 0)
+
+    known = {} if force or manifest is None else read_chunks(index_dir)
+    vector_store = FAISS.load_local(str(index_dir), embeddings) if known else None
+
+    documents = hash_chunks([document for source in sources for document in load_chunks(source)])
+    added = [chunk for chunk in documents if chunk not in known]
+    removed = [chunk for chunk in known if chunk not in documents]
+
+    if vector_store is not None:
+        remove_documents(vector_store, [known.pop(chunk) for chunk in removed])
+        # Page numbers and other metadata may have changed without the content changing
+        for chunk, docstore_id in known.items():
+            vector_store.docstore._dict[docstore_id] = documents[chunk]
+
+    def write_batch(batch, vectors):
+        # Vectors go into the index as soon as their batch is embedded
+        nonlocal vector_store
+        if vector_store is None:
+            vector_store = empty_store(embeddings, len(vectors[0]))
+        ids = add_embeddings(vector_store, [document for _, document in batch], vectors)
+        known.update((chunk, docstore_id) for (chunk, _), docstore_id in zip(batch, ids))
+
+    builder = IndexBuilder(
+        embeddings,
+        batch_size=batch_size,
+        max_concurrency=max_concurrency,
+        requests_per_minute=requests_per_minute,
+    )
+    error = None
+    try:
+        asyncio.run(builder.run([(chunk, documents[chunk]) for chunk in added], write_batch))
+    except EmbeddingBatchError as e:
+        # Keep the batches that made it; without a source hash the next run diffs again
+        error = e
+        current_hash = None
+
+    if vector_store is None:
+        if error is not None:
+            raise error
+        raise ValueError(f"No documents found in {', '.join(map(str, sources)) or 'the given sources'}")
+
+    save_index(vector_store, index_dir, {
+        "manifest_version": MANIFEST_VERSION,
+        "index_version": (manifest["index_version"] + 1) if manifest else 1,
+        "source_hash": current_hash,
+        "embedding_model": embedding_model,
+        "inputs": inputs,
+        "sources": [str(source) for source in sources],
+        "chunk_count": len(known),
+        "built_at": datetime.datetime.now().isoformat(timespec="seconds"),
+    }, known)
+    if error is not None:
+        raise error
+    return len(added), len(removed), len(known) - len(added)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build or refresh the knowledge base FAISS index.")
+    parser.add_argument("--source", help="Source documents or directories", type=Path, nargs="+",
+                        default=[Path(KB_FILE)])
+    parser.add_argument("--index_dir", help="Index directory", type=Path, default=Path(INDEX_DIR))
+    parser.add_argument("--force", help="Embed every chunk again", action="store_true")
+    parser.add_argument("--batch_size", help="Chunks per embedding request", type=int, default=64)
+    parser.add_argument("--concurrency", help="Embedding requests in flight", type=int, default=4)
+    parser.add_argument("--rpm", help="Embedding requests per minute", type=float, default=3000)
+    parser.add_argument("--cache_dir", help="Embedding cache directory", type=Path, default=Path("embedding_cache"))
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # Rate limits are retried by IndexBuilder, which paces every worker accordingly
+    openai_embeddings = OpenAIEmbeddings(max_retries=1)
+    embeddings = CachedEmbeddings(openai_embeddings, model=openai_embeddings.model, cache_dir=args.cache_dir)
+    added, removed, unchanged = refresh_index(args.source, args.index_dir, embeddings, openai_embeddings.model,
+                                              force=args.force, batch_size=args.batch_size,
+                                              max_concurrency=args.concurrency, requests_per_minute=args.rpm)
+    print(f"Added {added}, removed {removed}, kept {unchanged} chunks.")
@@ -0,0 +1,79 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Any, Iterator
+
+
+class ExecutorBusyError(Exception):
+    """
+    Raised when the executor already holds as many requests as it is allowed to queue.
+    """
+
+
+class LLMExecutor:
+    """
+    Runs blocking LangChain calls on a bounded thread pool with admission control.
+
+    At most max_concurrency calls run at the same time and at most max_queue further
+    requests wait for a free worker. Requests beyond that are rejected immediately with
+    ExecutorBusyError, so the event loop and the cheap endpoints stay responsive under load.
+
+    Args:
+        max_concurrency: Number of chain calls running in parallel.
+        max_queue: Number of admitted requests allowed to wait for a worker.
+    """
+
+    def __init__(self, max_concurrency: int = 8, max_queue: int = 32) -> None:
+        if max_concurrency < 1 or max_queue < 0:
+            raise ValueError(f"Invalid limits: max_concurrency={max_concurrency}, max_queue={max_queue}")
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm")
+        self._admitted = 0
+        self._rejected = 0
+
+    @property
+    def saturated(self) -> bool:
+        return self._admitted >= self.max_concurrency + self.max_queue
+
+    @contextmanager
+    def admit(self) -> Iterator[None]:
+        """
+        Reserve a place for one request for the duration of the context.
+
+        Raises:
+            ExecutorBusyError: If the concurrency limit and the queue are both full.
+        """
+        if self.saturated:
+            self._rejected += 1
+            raise ExecutorBusyError(
+                f"{self._admitted} requests in flight, limit is {self.max_concurrency + self.max_queue}"
+            )
+        self._admitted += 1
+        try:
+            yield
+        finally:
+            self._admitted -= 1
+
+    async def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Run a blocking callable on the executor's thread pool and await its result.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def stats(self) -> dict:
+        """
+        Return the current admission statistics.
+        """
+        return {
+            "admitted": self._admitted,
+            "running": min(self._admitted, self.max_concurrency),
+            "rejected": self._rejected,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
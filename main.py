@@ -16,13 +16,18 @@ from aiogram.utils import executor
 from langchain.schema import messages_from_dict, messages_to_dict
 
 from config import DEFAULT_TEMPLATE, Prompt, WELCOME_MESSAGE, DATA_STRUCTURE, PREMIUM_MESSAGE, LIMIT_MESSAGE, \
-    ERROR_MESSAGE
-from utils import load_roles_from_file, load_user_roles, save_user_roles
+    ERROR_MESSAGE, BUSY_MESSAGE
+from llm_executor import LLMExecutor, ExecutorBusyError
+from utils import load_roles_from_file, load_user_roles, save_user_roles, index_roles
+from conversation_log import ConversationLog
+from quota import JSONQuotaStore, QuotaCounter
+from webhook import add_webhook_args, check_webhook_args, create_bot, start_webhook
 from langchain.chat_models import ChatOpenAI
 
 DATABASE_DIR = Path(__file__).parent / "database"
 ROLES_FILE = "config/roles.json"
 USER_ROLES_FILE = "user_roles.json"
+MESSAGE_COUNTS_FILE = "message_counts.json"
 
 
 def parse_args():
@@ -30,25 +35,40 @@ def parse_args():
     parser.add_argument(
         "--telegram_token", help="Telegram bot token", type=str, required=True
     )
+    add_webhook_args(parser)
     args = parser.parse_args()
+    check_webhook_args(parser, args)
     return args
 
 
 args = parse_args()
 
-bot = Bot(token=args.telegram_token)
+bot = create_bot(args)
 storage = MemoryStorage()
 
 dispatcher = Dispatcher(bot, storage=storage, loop=asyncio.get_event_loop())
 chain_type_kwargs = {"stop": ["\nHuman:"]}
 LLM = ChatOpenAI(model_name="gpt-4", model_kwargs=chain_type_kwargs)
+# Chain calls block, so they run on a bounded thread pool instead of the event loop
+LLM_EXECUTOR = LLMExecutor(
+    max_concurrency=int(os.environ.get("LLM_MAX_CONCURRENCY", 8)),
+    max_queue=int(os.environ.get("LLM_MAX_QUEUE", 32)),
+)
 
 # Load roles from the JSON file
 ROLES = load_roles_from_file(ROLES_FILE)
+ROLES_BY_COMMAND = index_roles(ROLES, "command")
+ROLES_BY_NAME = index_roles(ROLES, "name")
 
 # Load user roles at the start of your program
 USER_ROLES = load_user_roles(user_roles_file=USER_ROLES_FILE)
 
+# Message counts of the free quota, kept in memory and saved to the file in the background
+QUOTA = QuotaCounter(JSONQuotaStore(Path(MESSAGE_COUNTS_FILE)))
+
+# Append-only history of every user
+CONVERSATIONS = ConversationLog(DATABASE_DIR)
+
 
 @dispatcher.message_handler(commands=["assistant", "hypnotherapist", "psychotherapist", "doctor"])
 async def set_role(message: types.Message):
@@ -56,7 +76,7 @@ async def set_role(message: types.Message):
     command = message.get_command()
 
     # Find the role corresponding to the command
-    role = next((r for r in ROLES if r["command"] == command), None)
+    role = ROLES_BY_COMMAND.get(command)
 
     if role:
         USER_ROLES[user_id] = role["name"]
@@ -79,30 +99,14 @@ async def show_message_count(message: types.Message):
 async def show_message_count(message: types.Message):
     await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
     user_id = str(message.from_user.id)
-    # Load message counts from a JSON file (if it exists)
-    if os.path.isfile("message_counts.json"):
-        # If it exists, load the data from the file
-        with open("message_counts.json", "r") as f:
-            USER_TO_CONVERSATION_ID = json.load(f)
-    else:
-        USER_TO_CONVERSATION_ID = {}
-        # If it doesn't exist, create an empty dictionary
-        await bot.send_message(user_id, text=ERROR_MESSAGE)
-    print(USER_TO_CONVERSATION_ID)
-    count = USER_TO_CONVERSATION_ID[user_id]
-    remaining = 50 - int(count)
+    remaining = await QUOTA.remaining(user_id)
     await bot.send_message(user_id, text=f"Remaining {remaining} free messages.")
 
 
 @dispatcher.message_handler(commands=["start"])
 async def start(message: types.Message):
     await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
-    if not os.path.isdir(DATABASE_DIR):
-        os.mkdir(DATABASE_DIR)
-
-    if not os.path.isfile(DATABASE_DIR / f"{message.from_user.id}.json"):
-        with open(DATABASE_DIR / f"{message.from_user.id}.json", 'w', encoding="utf-8") as f:
-            json.dump(DATA_STRUCTURE, f)
+    CONVERSATIONS.create(message.from_user.id)
     USER_ROLES[str(message.from_user.id)] = "Main Assistant"
     await bot.send_message(message.from_user.id, text=WELCOME_MESSAGE)
 
@@ -111,42 +115,19 @@ async def start(message: types.Message):
 async def handle_message(message: types.Message) -> None:
     # translated_message = translate(message.text, from_lang="ru", to_lang="en")
 
-    # Load message counts from a JSON file (if it exists)
-    if os.path.isfile("message_counts.json"):
-        # If it exists, load the data from the file
-        with open("message_counts.json", "r") as f:
-            USER_TO_CONVERSATION_ID = json.load(f)
-    else:
-        # If it doesn't exist, create an empty dictionary
-        USER_TO_CONVERSATION_ID = {}
-        await bot.send_message(message.from_user.id, text=ERROR_MESSAGE)
-
     user_id = str(message.from_user.id)
 
     # Get the current role for the user or default to None if not set
     current_role = USER_ROLES.get(user_id)
 
-    # Check if user ID exists in the dictionary
-    if user_id in USER_TO_CONVERSATION_ID:
-        # Increment message count for the user
-        USER_TO_CONVERSATION_ID[user_id] = int(USER_TO_CONVERSATION_ID[user_id]) + 1
-    else:
-        # Add user ID to the dictionary with an initial count of 1
-        USER_TO_CONVERSATION_ID[user_id] = 1
-
-    # Check if message count for the user exceeds 50
-    if int(USER_TO_CONVERSATION_ID[user_id]) > 50:
+    # Count the message and check if the user exceeds the free limit
+    if await QUOTA.increment(user_id) > QUOTA.limit:
         await bot.send_message(message.from_user.id, text=LIMIT_MESSAGE)
-        with open("message_counts.json", "w") as f:
-            json.dump(USER_TO_CONVERSATION_ID, f)
         return
 
-    # Load the data from the file history
-    if os.path.isfile(DATABASE_DIR / f"{message.from_user.id}.json"):
-        with open(DATABASE_DIR / f"{message.from_user.id}.json", "r", encoding="utf-8") as f:
-            json_string = f.read()
-            # Parse the JSON data from the string
-            retrieved_from_db = json.loads(json_string)
+    # Load the whole history from the user's log, the chain sees the entire conversation
+    if CONVERSATIONS.exists(message.from_user.id):
+        retrieved_from_db = CONVERSATIONS.tail(message.from_user.id)
 
         retrieved_messages = messages_from_dict(retrieved_from_db)
         retrieved_chat_history = ChatMessageHistory(messages=retrieved_messages)
@@ -154,7 +135,7 @@ async def handle_message(message: types.Message) -> None:
 
         if current_role:
             # Find the role prompt for the current role
-            role_prompt = next((r["prompt"] for r in ROLES if r["name"] == current_role), "")
+            role_prompt = ROLES_BY_NAME.get(current_role, {}).get("prompt", "")
             Prompt.prompt = role_prompt
             print(Prompt.prompt)
         else:
@@ -168,20 +149,18 @@ async def handle_message(message: types.Message) -> None:
             prompt=PROMPT,
         )
         await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
-        chatbot_response = reloaded_chain.run(input=message.text)
+        try:
+            with LLM_EXECUTOR.admit():
+                chatbot_response = await LLM_EXECUTOR.run(reloaded_chain.run, input=message.text)
+        except ExecutorBusyError:
+            await bot.send_message(message.from_user.id, text=BUSY_MESSAGE)
+            return
         await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
         await bot.send_message(message.from_user.id, text=chatbot_response)
-        with open(DATABASE_DIR / f"{message.from_user.id}.json", "w") as f:
-            json.dump(USER_TO_CONVERSATION_ID, f)
-
         extracted_messages = reloaded_chain.memory.chat_memory.messages
-        ingest_to_db = messages_to_dict(extracted_messages)
-        # Save the data to the file with new messages
-        with open(DATABASE_DIR / f"{message.from_user.id}.json", "w", encoding="utf-8") as f:
-            json.dump(ingest_to_db, f)
-        # Update counts of messages
-        with open("message_counts.json", "w") as f:
-            json.dump(USER_TO_CONVERSATION_ID, f)
+        ingest_to_db = messages_to_dict(extracted_messages[len(retrieved_messages):])
+        # Append the new messages to the log
+        CONVERSATIONS.append(message.from_user.id, ingest_to_db)
     else:
 
         await bot.send_message(user_id, text=ERROR_MESSAGE)
@@ -190,6 +169,15 @@ async def handle_message(message: types.Message) -> None:
 # Save user roles before the bot exits
 atexit.register(save_user_roles, user_roles_file=USER_ROLES_FILE, user_roles=USER_ROLES)
 
+
+async def on_shutdown(dispatcher: Dispatcher):
+    # Save the message counts not written yet
+    await QUOTA.close()
+    LLM_EXECUTOR.shutdown()
+
 # Press the green button in the gutter to run the script.
 if __name__ == "__main__":
-    executor.start_polling(dispatcher, skip_updates=False)
+    if args.webhook_url:
+        start_webhook(dispatcher, args, on_shutdown=on_shutdown)
+    else:
+        executor.start_polling(dispatcher, skip_updates=False, on_shutdown=on_shutdown)
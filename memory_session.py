@@ -0,0 +1,182 @@
+import asyncio
+import weakref
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, AsyncIterator, Tuple
+
+from langchain.base_language import BaseLanguageModel
+from langchain.memory import ChatMessageHistory, ConversationSummaryBufferMemory
+from langchain.schema import BaseMessage, messages_from_dict, messages_to_dict
+from pydantic import Field
+
+# Tokens the chat format adds to every message besides its content
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class BudgetedSummaryBufferMemory(ConversationSummaryBufferMemory):
+    """
+    A ConversationSummaryBufferMemory that counts the tokens of every message only once.
+
+    The base class tokenizes the whole buffer on every turn, and again after every message it
+    prunes. Here the count of each message is kept in token_counts, keyed by the message object,
+    and stored with the checkpoint, so a turn only tokenizes the messages it adds.
+
+    With defer_summary set, pruned messages are collected in pruned_messages instead of being
+    summarised inline, so the summary can be updated after the reply, see SummaryWorker.
+    """
+
+    token_counts: Dict[int, int] = Field(default_factory=dict)
+    defer_summary: bool = False
+    pruned_messages: List[BaseMessage] = Field(default_factory=list)
+
+    def message_tokens(self, message: BaseMessage) -> int:
+        """
+        Return the number of tokens of a message, counting it on first use.
+        """
+        count = self.token_counts.get(id(message))
+        if count is None:
+            count = self.llm.get_num_tokens(message.content) + MESSAGE_OVERHEAD_TOKENS
+            self.token_counts[id(message)] = count
+        return count
+
+    @property
+    def buffer_tokens(self) -> int:
+        """
+        The number of tokens of the buffered messages.
+        """
+        return sum(self.message_tokens(message) for message in self.chat_memory.messages)
+
+    def prune(self) -> None:
+        buffer = self.chat_memory.messages
+        total = self.buffer_tokens
+        if total <= self.max_token_limit:
+            return
+        pruned = []
+        while buffer and total > self.max_token_limit:
+            message = buffer.pop(0)
+            total -= self.token_counts.pop(id(message))
+            pruned.append(message)
+        if self.defer_summary:
+            self.pruned_messages.extend(pruned)
+        else:
+            self.moving_summary_buffer = self.predict_new_summary(pruned, self.moving_summary_buffer)
+
+    def to_dicts(self, messages: List[BaseMessage]) -> List[dict]:
+        """
+        Convert messages to the messages_to_dict format, with their token count under "tokens".
+        """
+        return [
+            dict(message_dict, tokens=self.message_tokens(message))
+            for message, message_dict in zip(messages, messages_to_dict(messages))
+        ]
+
+
+class MemorySession:
+    """
+    A single user's conversation memory, built from their checkpoint for one request.
+
+    Every session owns its own ConversationSummaryBufferMemory, so concurrent requests of
+    different users never share mutable state.
+
+    Args:
+        user_id: ID of the user the memory belongs to.
+        memory: The memory object handed to the chain.
+    """
+
+    def __init__(self, user_id: str, memory: BudgetedSummaryBufferMemory) -> None:
+        self.user_id = user_id
+        self.memory = memory
+        # What the checkpoint held, to tell which messages a turn pruned and added
+        self._loaded = list(memory.chat_memory.messages)
+        self._loaded_summary = memory.moving_summary_buffer
+
+    @property
+    def history(self) -> List[dict]:
+        """
+        The buffered messages in the format stored by write_checkpoint.
+        """
+        return self.memory.to_dicts(self.memory.chat_memory.messages)
+
+    @property
+    def summary(self) -> str:
+        """
+        The moving summary of the messages pruned from the buffer.
+        """
+        return self.memory.moving_summary_buffer
+
+    def delta(self) -> Tuple[int, List[dict], Optional[str]]:
+        """
+        The changes of the buffer since the checkpoint was loaded, as stored by save_turn.
+
+        The memory only removes messages from the front of the buffer and adds them at the end,
+        so the stored buffer is brought up to date by dropping `pruned` messages and appending
+        the new ones.
+
+        Returns:
+            Tuple[int, List[dict], Optional[str]]: The number of loaded messages pruned, the new
+            messages in the format stored by write_checkpoint and the summary, or None if it is unchanged.
+        """
+        loaded = {id(message) for message in self._loaded}
+        buffer = self.memory.chat_memory.messages
+        kept = sum(id(message) in loaded for message in buffer)
+        added = [message for message in buffer if id(message) not in loaded]
+        summary = self.summary if self.summary != self._loaded_summary else None
+        return len(self._loaded) - kept, self.memory.to_dicts(added), summary
+
+
+class MemorySessionManager:
+    """
+    Creates MemorySession objects and serialises requests of the same user.
+
+    Requests of different users run in parallel; requests of the same user wait for each
+    other so that a turn always starts from the checkpoint written by the previous one.
+
+    Args:
+        llm: Language model used to count tokens and summarise pruned messages.
+        max_token_limit: Token limit of the buffer before messages are summarised.
+        defer_summary: Whether pruned messages are left to the caller to summarise.
+    """
+
+    def __init__(self, llm: BaseLanguageModel, max_token_limit: int = 2000, defer_summary: bool = False) -> None:
+        self.llm = llm
+        self.max_token_limit = max_token_limit
+        self.defer_summary = defer_summary
+        # Locks disappear as soon as no request of that user holds a reference to them
+        self._locks = weakref.WeakValueDictionary()
+
+    def create(self, user_id: str, history: List[dict], summary: Optional[str]) -> MemorySession:
+        """
+        Build a fresh session from a stored checkpoint.
+
+        Args:
+            user_id: ID of the user.
+            history: Stored messages, as returned by get_checkpoint_by_user_id.
+            summary: Stored moving summary buffer, or None for a new user.
+        """
+        memory = BudgetedSummaryBufferMemory(
+            llm=self.llm,
+            input_key='question',
+            output_key='answer',
+            max_token_limit=self.max_token_limit,
+            chat_memory=ChatMessageHistory(messages=messages_from_dict(history)),
+            moving_summary_buffer=summary or "",
+            defer_summary=self.defer_summary,
+        )
+        # Validation copies the messages, so the counts are keyed by the objects the memory holds;
+        # checkpoints written before the counts were stored are counted on first use
+        memory.token_counts = {
+            id(message): message_dict["tokens"]
+            for message, message_dict in zip(memory.chat_memory.messages, history) if "tokens" in message_dict
+        }
+        return MemorySession(user_id, memory)
+
+    @asynccontextmanager
+    async def user_lock(self, user_id: str) -> AsyncIterator[None]:
+        """
+        Hold the per-user lock for the duration of the context.
+        """
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[user_id] = lock
+        async with lock:
+            yield
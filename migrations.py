@@ -0,0 +1,348 @@
+"""
+Versioned schema migrations of the PostgreSQL database.
+
+Every migration runs once and is recorded in the schema_migrations table. Migrations are a
+deploy step: the API does not apply them, it refuses to start while some are pending, see
+check_migrations. Runs are serialised with a polled advisory lock. Indexes on existing tables
+are built with CREATE INDEX CONCURRENTLY and backfills run in batches, so migrations can be
+applied while the bot is serving users.
+
+Apply the pending migrations, or list them with --status:
+    python migrations.py --sql_config config/sql_config_prod.json
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import Callable, List, NamedTuple
+
+import psycopg2
+from psycopg2 import extensions
+
+# Key of the advisory lock held while migrating
+MIGRATION_LOCK_ID = 7259001
+# Seconds between two attempts to take the lock
+MIGRATION_LOCK_POLL = 0.5
+# Ids of ConversationHistory rows updated per transaction by backfills
+BACKFILL_BATCH_SIZE = 10000
+
+
+class PendingMigrationsError(Exception):
+    """
+    Raised when the database schema is behind the code, until `python migrations.py` is run.
+    """
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[extensions.cursor], None]
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    transactional: bool = True
+
+
+def create_index_concurrently(cursor: extensions.cursor, name: str, definition: str, unique: bool = False) -> None:
+    """
+    Build an index without blocking writes, replacing an invalid one left by an interrupted build.
+
+    Args:
+        cursor: A cursor of a connection in autocommit mode.
+        name: Name of the index.
+        definition: The rest of the statement, e.g. "ON ConversationHistory (user_id)".
+        unique: Whether to build a unique index.
+    """
+    cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,))
+    result = cursor.fetchone()
+    if result is not None and not result[0]:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    unique_clause = "UNIQUE " if unique else ""
+    cursor.execute(f"CREATE {unique_clause}INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}")
+
+
+def _base_schema(cursor: extensions.cursor) -> None:
+    # The tables SQLHistoryWriter used to create on connect
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ConversationHistory (
+        id SERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        user_message TEXT,
+        chatbot_message TEXT,
+        timestamp TIMESTAMP
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ConversationCheckpoints (
+            id SERIAL PRIMARY KEY,
+            user_id TEXT,
+            history JSONB,
+            memory_moving_summary_buffer TEXT
+        )
+        """
+    )
+    # history is a snapshot of the messages snapshot_start..snapshot_end, newer messages are
+    # rows of ConversationCheckpointMessages and the buffer starts at message history_start
+    cursor.execute(
+        """
+        ALTER TABLE ConversationCheckpoints
+            ADD COLUMN IF NOT EXISTS history_start BIGINT NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS snapshot_start BIGINT NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS snapshot_end BIGINT NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS next_seq BIGINT NOT NULL DEFAULT 0
+        """
+    )
+    # Checkpoints written before have their whole buffer in the snapshot
+    cursor.execute(
+        """
+        UPDATE ConversationCheckpoints
+        SET snapshot_end = jsonb_array_length(history),
+            next_seq = jsonb_array_length(history)
+        WHERE next_seq = 0 AND jsonb_typeof(history) = 'array' AND jsonb_array_length(history) > 0
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ConversationCheckpointMessages (
+            user_id TEXT NOT NULL,
+            seq BIGINT NOT NULL,
+            message JSONB NOT NULL,
+            PRIMARY KEY (user_id, seq)
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS payment (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            client_secret VARCHAR(255) NOT NULL,
+            client_email VARCHAR(255) NOT NULL,
+            subscription_id VARCHAR(255) NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS MessageQuota (
+        user_id TEXT PRIMARY KEY,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+        )
+        """
+    )
+
+
+def _payments_table(cursor: extensions.cursor) -> None:
+    # Read and written by the subscription queries but never created so far
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS testpayments (
+            id SERIAL PRIMARY KEY,
+            user_id TEXT NOT NULL UNIQUE,
+            client_secret VARCHAR(255) NOT NULL DEFAULT '',
+            client_email VARCHAR(255) NOT NULL DEFAULT '',
+            subscription_id VARCHAR(255) NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+        )
+        """
+    )
+
+
+def _dedupe_checkpoints(cursor: extensions.cursor) -> None:
+    # /start inserted a new checkpoint on every call; write_checkpoint updated all of them alike
+    cursor.execute(
+        """
+        DELETE FROM ConversationCheckpoints c
+        USING ConversationCheckpoints newer
+        WHERE c.user_id = newer.user_id AND c.id < newer.id
+        """
+    )
+
+
+def _checkpoints_user_index(cursor: extensions.cursor) -> None:
+    # Rows inserted by a /start while the index is built make it fail; dedupe again and retry
+    for attempt in range(3):
+        _dedupe_checkpoints(cursor)
+        try:
+            create_index_concurrently(
+                cursor, "ConversationCheckpoints_user_id", "ON ConversationCheckpoints (user_id)", unique=True
+            )
+            return
+        except psycopg2.IntegrityError:
+            if attempt == 2:
+                raise
+
+
+def _payments_user_index(cursor: extensions.cursor) -> None:
+    # testpayments tables created before _payments_table may lack the unique constraint
+    cursor.execute(
+        """
+        SELECT 1 FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+        WHERE i.indrelid = to_regclass('testpayments') AND a.attname = 'user_id'
+        """
+    )
+    if cursor.fetchone() is None:
+        create_index_concurrently(cursor, "testpayments_user_id", "ON testpayments (user_id)")
+    create_index_concurrently(cursor, "payment_user_id", "ON payment (user_id)")
+
+
+def _history_timestamps(cursor: extensions.cursor) -> None:
+    # Keyset pagination by (user_id, timestamp, id) would skip rows without a timestamp
+    cursor.execute("ALTER TABLE ConversationHistory ALTER COLUMN timestamp SET DEFAULT now()")
+    cursor.execute("SELECT min(id), max(id) FROM ConversationHistory")
+    first, last = cursor.fetchone()
+    if first is None:
+        return
+    # One short transaction per range of ids, so the table is never locked for long
+    for start in range(first, last + 1, BACKFILL_BATCH_SIZE):
+        cursor.execute(
+            """
+            UPDATE ConversationHistory SET timestamp = 'epoch'
+            WHERE id >= %s AND id < %s AND timestamp IS NULL
+            """,
+            (start, start + BACKFILL_BATCH_SIZE)
+        )
+
+
+def _history_user_index(cursor: extensions.cursor) -> None:
+    create_index_concurrently(
+        cursor, "ConversationHistory_user_id_timestamp_id", "ON ConversationHistory (user_id, timestamp, id)"
+    )
+
+
+def _summary_version(cursor: extensions.cursor) -> None:
+    # Incremented by every write of the summary, see SQLHistoryWriter.write_summary
+    cursor.execute(
+        "ALTER TABLE ConversationCheckpoints ADD COLUMN IF NOT EXISTS summary_version BIGINT NOT NULL DEFAULT 0"
+    )
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "base schema", _base_schema),
+    Migration(2, "create testpayments", _payments_table),
+    Migration(3, "dedupe checkpoints", _dedupe_checkpoints),
+    Migration(4, "unique checkpoint per user", _checkpoints_user_index, transactional=False),
+    Migration(5, "payments by user", _payments_user_index, transactional=False),
+    Migration(6, "history timestamps", _history_timestamps, transactional=False),
+    Migration(7, "history by user and time", _history_user_index, transactional=False),
+    Migration(8, "checkpoint summary version", _summary_version),
+]
+
+
+def _applied_versions(cursor: extensions.cursor) -> set:
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+        )
+        """
+    )
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {version for version, in cursor.fetchall()}
+
+
+def pending_migrations(connection: extensions.connection) -> List[Migration]:
+    """
+    Return the migrations not applied to the database yet.
+    """
+    with connection.cursor() as cursor:
+        applied = _applied_versions(cursor)
+    connection.commit()
+    return [migration for migration in MIGRATIONS if migration.version not in applied]
+
+
+def check_migrations(connection: extensions.connection) -> None:
+    """
+    Make sure the database schema is up to date.
+
+    Raises:
+        PendingMigrationsError: If some migrations have not been applied.
+    """
+    pending = pending_migrations(connection)
+    if pending:
+        names = ", ".join(f"{migration.version} ({migration.name})" for migration in pending)
+        raise PendingMigrationsError(f"Pending migrations {names}, run `python migrations.py` first")
+
+
+def apply_migrations(connection: extensions.connection) -> List[Migration]:
+    """
+    Apply the pending migrations in order, holding the migration lock.
+
+    Returns:
+        List[Migration]: The migrations applied by this call.
+    """
+    connection.commit()
+    autocommit = connection.autocommit
+    connection.autocommit = True
+    applied = []
+    try:
+        with connection.cursor() as cursor:
+            # A session blocked in pg_advisory_lock counts as a transaction that CREATE INDEX
+            # CONCURRENTLY of the lock holder waits for, so waiting workers poll instead
+            while True:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+                if cursor.fetchone()[0]:
+                    break
+                time.sleep(MIGRATION_LOCK_POLL)
+            try:
+                # Read under the lock, another process may just have migrated
+                done = _applied_versions(cursor)
+                for migration in MIGRATIONS:
+                    if migration.version in done:
+                        continue
+                    if migration.transactional:
+                        cursor.execute("BEGIN")
+                    try:
+                        migration.apply(cursor)
+                        cursor.execute(
+                            "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                            (migration.version, migration.name),
+                        )
+                    except Exception:
+                        if migration.transactional:
+                            cursor.execute("ROLLBACK")
+                        raise
+                    if migration.transactional:
+                        cursor.execute("COMMIT")
+                    applied.append(migration)
+                    print(f"Applied migration {migration.version}: {migration.name}")
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+    finally:
+        connection.autocommit = autocommit
+    return applied
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sql_config", help="Database configuration file", type=Path,
+                        default=Path("config/sql_config_prod.json"))
+    parser.add_argument("--status", help="Only list the pending migrations", action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = json.loads(args.sql_config.read_text())
+    config.pop("pool", None)
+    connection = psycopg2.connect(**config)
+    try:
+        if args.status:
+            for migration in pending_migrations(connection):
+                print(f"Pending migration {migration.version}: {migration.name}")
+        else:
+            apply_migrations(connection)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class ProfileCache:
+    """
+    In-process cache of user profiles, e.g. the subscription tier, with a TTL and LRU eviction.
+
+    Writes that change a profile must call invalidate(). A value loaded from the database is
+    only cached if no invalidation happened since the load started: take a token() before the
+    query and pass it to set(), so a stale read racing with an update is never cached.
+
+    Args:
+        max_size: Maximum number of cached users; the least recently used one is evicted.
+        ttl: Seconds a profile is served before it is loaded again.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._profiles = OrderedDict()
+        self._invalidations = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, user_id: str) -> Optional[dict]:
+        """
+        Return the cached profile of a user, or None if it is missing or expired.
+        """
+        entry = self._profiles.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._profiles[user_id]
+            self._misses += 1
+            return None
+        self._profiles.move_to_end(user_id)
+        self._hits += 1
+        return entry[1]
+
+    def token(self) -> int:
+        """
+        Return the token to pass to set() for a profile loaded after this call.
+        """
+        return self._invalidations
+
+    def set(self, user_id: str, profile: dict, token: int) -> None:
+        """
+        Cache the profile of a user unless a profile was invalidated since token() was taken.
+        """
+        if token != self._invalidations:
+            return
+        self._profiles[user_id] = (time.monotonic() + self.ttl, profile)
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self.max_size:
+            self._profiles.popitem(last=False)
+            self._evictions += 1
+
+    def invalidate(self, user_id: str) -> None:
+        """
+        Drop the profile of a user after it changed in the database.
+        """
+        self._invalidations += 1
+        self._profiles.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._profiles),
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+        }
@@ -0,0 +1,244 @@
+import asyncio
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from async_sql_writer import AsyncSQLHistoryWriter
+
+# Number of messages a user may send for free
+FREE_MESSAGE_LIMIT = 50
+
+
+class QuotaStore(ABC):
+    """
+    Persistent message counts of the users, read once per user and updated with added counts.
+    """
+
+    @abstractmethod
+    async def get(self, user_id: str) -> int:
+        """
+        Return the stored message count of a user.
+        """
+
+    @abstractmethod
+    async def add(self, counts: Dict[str, int]) -> None:
+        """
+        Add message counts to the stored counts of several users.
+        """
+
+
+class JSONQuotaStore(QuotaStore):
+    """
+    Message counts in a JSON file mapping user ids to counts, e.g. message_counts.json.
+
+    Added counts are appended to a log next to the file, one JSON object per batch, so a
+    write only costs the users in the batch. Once the log holds as many entries as the file
+    has users, the counts are written to the file atomically and the log is emptied.
+
+    Args:
+        path: Path of the JSON file.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.log_path = self.path.with_name(self.path.name + ".log")
+        self._counts: Optional[Dict[str, int]] = None
+        self._log_entries = 0
+        self._lock = threading.Lock()
+
+    def _read(self) -> Dict[str, int]:
+        if self._counts is None:
+            if self.path.is_file():
+                self._counts = {user_id: int(count) for user_id, count in json.loads(self.path.read_text()).items()}
+            else:
+                self._counts = {}
+            if self.log_path.is_file():
+                with open(self.log_path, "rb") as f:
+                    for line in f:
+                        # The last line may be partial after a crash
+                        if not line.endswith(b"\n"):
+                            break
+                        for user_id, count in json.loads(line).items():
+                            self._counts[user_id] = self._counts.get(user_id, 0) + count
+                            self._log_entries += 1
+                # Drop a partial last line so appends start on a new line
+                self._compact()
+        return self._counts
+
+    def _compact(self) -> None:
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        tmp_path.write_text(json.dumps(self._counts))
+        os.replace(tmp_path, self.path)
+        self.log_path.unlink(missing_ok=True)
+        self._log_entries = 0
+
+    def _get(self, user_id: str) -> int:
+        with self._lock:
+            return self._read().get(user_id, 0)
+
+    def _write(self, counts: Dict[str, int]) -> None:
+        with self._lock:
+            stored = self._read()
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(counts) + "\n")
+            for user_id, count in counts.items():
+                stored[user_id] = stored.get(user_id, 0) + count
+            self._log_entries += len(counts)
+            if self._log_entries >= len(stored):
+                self._compact()
+
+    async def get(self, user_id: str) -> int:
+        return await asyncio.get_running_loop().run_in_executor(None, self._get, user_id)
+
+    async def add(self, counts: Dict[str, int]) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self._write, counts)
+
+
+class SQLQuotaStore(QuotaStore):
+    """
+    Message counts in the MessageQuota table, added with one upsert per batch.
+
+    Args:
+        writer: The database pool of the backend.
+    """
+
+    def __init__(self, writer: "AsyncSQLHistoryWriter") -> None:
+        self.writer = writer
+
+    async def get(self, user_id: str) -> int:
+        return await self.writer.get_message_quota(user_id)
+
+    async def add(self, counts: Dict[str, int]) -> None:
+        await self.writer.add_message_quotas(counts)
+
+
+class QuotaCounter:
+    """
+    Counts the messages of every user in memory and persists the counts in the background.
+
+    A user's count is read from the store on first use; after that an increment is a dict
+    update that cannot interleave with another one on the event loop. The increments since the
+    last flush are added to the store every `flush_interval` seconds and on close. After a
+    flush, the least recently used counts beyond `max_users` are dropped from memory; they are
+    all in the store and read again on the user's next message.
+
+    Args:
+        store: Where the counts are persisted.
+        limit: Number of messages a user may send for free.
+        flush_interval: Seconds between two writes to the store.
+        max_users: Number of users whose counts are kept in memory.
+    """
+
+    def __init__(
+            self,
+            store: QuotaStore,
+            limit: int = FREE_MESSAGE_LIMIT,
+            flush_interval: float = 5.0,
+            max_users: int = 100000,
+    ) -> None:
+        self.store = store
+        self.limit = limit
+        self.flush_interval = flush_interval
+        self.max_users = max_users
+        self._counts: Dict[str, int] = OrderedDict()
+        self._pending: Dict[str, int] = {}
+        self._evictions = 0
+        self._stop = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def count(self, user_id) -> int:
+        """
+        Return the number of messages a user has sent.
+        """
+        user_id = str(user_id)
+        if user_id not in self._counts:
+            count = await self.store.get(user_id)
+            # Another call may have loaded and incremented the count meanwhile
+            self._counts.setdefault(user_id, count)
+        self._counts.move_to_end(user_id)
+        return self._counts[user_id]
+
+    async def increment(self, user_id) -> int:
+        """
+        Count a new message of a user.
+
+        Returns:
+            int: The number of messages of the user, including this one.
+        """
+        user_id = str(user_id)
+        await self.count(user_id)
+        self._counts[user_id] += 1
+        self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+        return self._counts[user_id]
+
+    async def remaining(self, user_id) -> int:
+        """
+        Return the number of free messages a user has left.
+        """
+        return self.limit - await self.count(user_id)
+
+    async def exceeded(self, user_id) -> bool:
+        """
+        Whether a user has sent more messages than the free limit.
+        """
+        return await self.count(user_id) > self.limit
+
+    async def flush(self) -> None:
+        """
+        Add the increments since the last flush to the store.
+        """
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            await self.store.add(pending)
+        except Exception:
+            # Keep the increments for the next flush
+            for user_id, count in pending.items():
+                self._pending[user_id] = self._pending.get(user_id, 0) + count
+            raise
+        self._evict()
+
+    def _evict(self) -> None:
+        # Counts with unsaved increments stay, the store does not know them yet
+        excess = len(self._counts) - self.max_users
+        evicted = []
+        for user_id in self._counts:
+            if len(evicted) >= excess:
+                break
+            if user_id not in self._pending:
+                evicted.append(user_id)
+        for user_id in evicted:
+            del self._counts[user_id]
+        self._evictions += len(evicted)
+
+    async def _flush_loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Saving message counts failed: {e}")
+
+    def stats(self) -> dict:
+        return {"users": len(self._counts), "pending_users": len(self._pending), "evictions": self._evictions}
+
+    async def close(self) -> None:
+        """
+        Stop the background writes and save the remaining increments.
+        """
+        self._stop.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    A token bucket for pacing calls against a rate limit.
+
+    Tokens are refilled continuously at `rate` per second up to `capacity`. The bucket can
+    also be paused, e.g. for the retry-after period of a 429 response.
+
+    Args:
+        rate: Tokens added per second.
+        capacity: Maximum number of tokens, i.e. the allowed burst.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        if rate <= 0 or capacity <= 0:
+            raise ValueError(f"Invalid token bucket: rate={rate}, capacity={capacity}")
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def available_in(self, tokens: float = 1) -> float:
+        """
+        Return the seconds until tokens will be available, without taking them.
+        """
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        if self._tokens >= tokens:
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """
+        Take tokens if they are available.
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise the seconds until they will be available.
+        """
+        wait = self.available_in(tokens)
+        if not wait:
+            self._tokens -= tokens
+        return wait
+
+    async def acquire(self, tokens: float = 1) -> None:
+        """
+        Wait until tokens are available and take them.
+        """
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Hand out no tokens for the given number of seconds.
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
@@ -0,0 +1,223 @@
+import math
+import queue
+import threading
+from concurrent.futures import Future
+from typing import List, Optional, Tuple, Callable
+
+import faiss
+import numpy as np
+from langchain.schema import Document
+from langchain.vectorstores import FAISS
+
+INDEX_TYPES = ("flat", "ivf", "hnsw")
+QUANTIZATIONS = ("none", "sq8", "pq")
+# An 8-bit product quantizer trains 256 centroids per sub-quantizer
+PQ_MIN_VECTORS = 256
+
+
+def build_faiss_index(
+        vectors: np.ndarray,
+        index_type: str = "flat",
+        quantization: str = "none",
+        nlist: Optional[int] = None,
+        hnsw_m: int = 32,
+        pq_m: int = 64,
+) -> faiss.Index:
+    """
+    Build and fill a FAISS index of the given type over the vectors.
+
+    Args:
+        vectors: float32 matrix with one vector per row.
+        index_type: "flat" (exact), "ivf" (inverted lists) or "hnsw" (graph).
+        quantization: "none" (float32), "sq8" (8-bit scalar) or "pq" (product quantization).
+        nlist: Number of IVF lists, defaults to 4 * sqrt(number of vectors); at most the number of vectors.
+        hnsw_m: Number of neighbours per HNSW node.
+        pq_m: Number of PQ sub-quantizers; lowered to the largest divisor of the vector dimension
+            if it does not divide it.
+
+    Corpora too small to train the requested index fall back to one that can be trained: PQ
+    to sq8 below PQ_MIN_VECTORS vectors, IVF to a flat index without vectors to train on.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    count, dimension = vectors.shape
+    if quantization == "pq" and dimension % pq_m:
+        divisor = max(m for m in range(1, min(pq_m, dimension) + 1) if dimension % m == 0)
+        print(f"pq_m={pq_m} does not divide the vector dimension {dimension}, using pq_m={divisor}")
+        pq_m = divisor
+    if quantization == "pq" and count < PQ_MIN_VECTORS:
+        print(f"{count} vectors are too few to train PQ, using sq8 instead")
+        quantization = "sq8"
+    if index_type == "ivf" and count == 0:
+        print("No vectors to train IVF lists on, using a flat index instead")
+        index_type = "flat"
+    sq8 = faiss.ScalarQuantizer.QT_8bit
+
+    if index_type == "flat":
+        index = {
+            "none": lambda: faiss.IndexFlatL2(dimension),
+            "sq8": lambda: faiss.IndexScalarQuantizer(dimension, sq8),
+            "pq": lambda: faiss.IndexPQ(dimension, pq_m, 8),
+        }[quantization]()
+    elif index_type == "ivf":
+        # Training needs at least one vector per list
+        nlist = max(1, min(nlist or int(4 * math.sqrt(count)), count))
+        coarse = faiss.IndexFlatL2(dimension)
+        index = {
+            "none": lambda: faiss.IndexIVFFlat(coarse, dimension, nlist),
+            "sq8": lambda: faiss.IndexIVFScalarQuantizer(coarse, dimension, nlist, sq8),
+            "pq": lambda: faiss.IndexIVFPQ(coarse, dimension, nlist, pq_m, 8),
+        }[quantization]()
+    else:
+        index = {
+            "none": lambda: faiss.IndexHNSWFlat(dimension, hnsw_m),
+            "sq8": lambda: faiss.IndexHNSWSQ(dimension, sq8, hnsw_m),
+            "pq": lambda: faiss.IndexHNSWPQ(dimension, pq_m, hnsw_m),
+        }[quantization]()
+
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+class RetrievalEngine:
+    """
+    Vectorized search over a FAISS store with a configurable index type.
+
+    The store on disk always holds a flat index, which ingestion can update in place; the
+    engine rebuilds it into the configured index type when it is created.
+
+    Args:
+        vector_store: The loaded FAISS store.
+        index_type: "flat", "ivf" or "hnsw", see build_faiss_index.
+        quantization: "none", "sq8" or "pq", see build_faiss_index.
+        k: Number of documents returned per query.
+        score_threshold: Maximum L2 distance of a returned document, None to disable.
+        nprobe: Number of IVF lists visited per query.
+        ef_search: Size of the HNSW search queue.
+        nlist: Number of IVF lists, see build_faiss_index.
+        hnsw_m: Number of neighbours per HNSW node.
+        pq_m: Number of PQ sub-quantizers, see build_faiss_index.
+        embed_queries: Embeds a list of queries in one call; defaults to one embed_query call per query.
+    """
+
+    def __init__(
+            self,
+            vector_store: FAISS,
+            index_type: str = "flat",
+            quantization: str = "none",
+            k: int = 4,
+            score_threshold: Optional[float] = None,
+            nprobe: int = 8,
+            ef_search: int = 64,
+            nlist: Optional[int] = None,
+            hnsw_m: int = 32,
+            pq_m: int = 64,
+            embed_queries: Optional[Callable[[List[str]], List[List[float]]]] = None,
+    ) -> None:
+        self.embed_queries = embed_queries or (
+            lambda queries: [vector_store.embedding_function(query) for query in queries]
+        )
+        self.docstore = vector_store.docstore
+        self.index_to_docstore_id = vector_store.index_to_docstore_id
+        self.k = k
+        self.score_threshold = score_threshold
+
+        if index_type == "flat" and quantization == "none":
+            self.index = vector_store.index
+        else:
+            vectors = vector_store.index.reconstruct_n(0, vector_store.index.ntotal)
+            self.index = build_faiss_index(vectors, index_type, quantization, nlist=nlist, hnsw_m=hnsw_m, pq_m=pq_m)
+        # The index type of a small corpus may have fallen back to flat
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            ivf.nprobe = nprobe
+        elif hasattr(self.index, "hnsw"):
+            self.index.hnsw.efSearch = ef_search
+
+    def search_vectors(
+            self,
+            vectors: np.ndarray,
+            k: Optional[int] = None,
+            score_threshold: Optional[float] = None,
+    ) -> List[List[Tuple[Document, float]]]:
+        """
+        Search the index for a matrix of query vectors in one call.
+
+        Returns:
+            list: For every query, the (document, distance) pairs ordered by distance.
+        """
+        k = k or self.k
+        score_threshold = self.score_threshold if score_threshold is None else score_threshold
+        distances, positions = self.index.search(np.ascontiguousarray(vectors, dtype=np.float32), k)
+
+        results = []
+        for row_distances, row_positions in zip(distances, positions):
+            hits = []
+            for distance, position in zip(row_distances, row_positions):
+                if position == -1 or (score_threshold is not None and distance > score_threshold):
+                    continue
+                hits.append((self.docstore.search(self.index_to_docstore_id[position]), float(distance)))
+            results.append(hits)
+        return results
+
+    def search_batch(self, queries: List[str], **kwargs) -> List[List[Document]]:
+        """
+        Embed several queries and search them in one vectorized call.
+        """
+        vectors = np.array(self.embed_queries(queries), dtype=np.float32)
+        return [[document for document, _ in hits] for hits in self.search_vectors(vectors, **kwargs)]
+
+    def search(self, query: str, **kwargs) -> List[Document]:
+        return self.search_batch([query], **kwargs)[0]
+
+
+class QueryBatcher:
+    """
+    Collects queries from concurrent threads and answers them with one search_batch call.
+
+    A background thread waits up to max_wait seconds after the first pending query for
+    more to arrive, then searches up to max_batch of them together.
+
+    Args:
+        engine: The engine answering the queries.
+        max_batch: Maximum number of queries per search.
+        max_wait: Seconds to wait for more queries before searching.
+    """
+
+    def __init__(self, engine: RetrievalEngine, max_batch: int = 32, max_wait: float = 0.005) -> None:
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name="retrieval-batcher", daemon=True)
+        self._thread.start()
+
+    def search(self, query: str) -> List[Document]:
+        future = Future()
+        self._pending.put((query, future))
+        return future.result()
+
+    def _loop(self) -> None:
+        while True:
+            batch = [self._pending.get()]
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(self._pending.get(timeout=self.max_wait))
+            except queue.Empty:
+                pass
+
+            try:
+                results = self.engine.search_batch([query for query, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), documents in zip(batch, results):
+                    future.set_result(documents)
+
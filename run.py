@@ -1,5 +1,8 @@
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
-
+from backend_client import BackendClient
+from debounce import DebounceScheduler
+from send_queue import OutboundScheduler
+from state_store import open_state_store, StateStoreStorage
+from webhook import add_webhook_args, check_webhook_args, create_bot, shard_of, start_webhook
 from config import WELCOME_MESSAGE
 import argparse
 import asyncio
@@ -10,33 +13,63 @@ from aiogram.utils import executor
 from aiogram.types import KeyboardButton
 import numpy as np
 import os
-import aiohttp
+import json
 import requests
 import asyncio
-from datetime import datetime, timedelta
 
 # Define a constant for the time window (in seconds)
 MESSAGE_BUFFER_TIME_WINDOW = 3
-
-# Define a dictionary to store user message buffers
-user_message_buffers = {}
+# Longest time (in seconds) a message waits in the buffer, even if the user keeps typing
+MESSAGE_BUFFER_MAX_WAIT = 15
+# Number of buffered messages sent at once without waiting for the time window
+MESSAGE_BUFFER_MAX_SIZE = 20
 
 MAX_MESSAGE_LENGTH = 4000
 
+START_ENDPOINT = "/api/start"
+MESSAGE_STREAM_ENDPOINT = "/api/message/stream"
+DELETE_ENDPOINT = "/api/delete_user_history"
+PREMIUM_ENDPOINT = "/api/premium_mode"
+BASIC_ENDPOINT = "/api/basic_mode"
+
+# Minimum time (in seconds) between two edits of a streamed answer
+STREAM_EDIT_INTERVAL = 1.0
+
+# State store namespaces of the buffering preference and the buffered messages of every user
+BUFFERING_NAMESPACE = "buffering"
+MESSAGE_BUFFER_NAMESPACE = "message_buffer"
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--telegram_token", help="Telegram bot token", type=str, required=True
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--backend_url", help="URL of the FastAPI backend", type=str,
+        default=os.environ.get("BACKEND_URL", "http://localhost:8000")
+    )
+    parser.add_argument(
+        "--state_store", help="Where to keep the bot state: memory, sqlite:<file> or postgres:<SQL config file>",
+        type=str, default=os.environ.get("STATE_STORE", "memory")
+    )
+    add_webhook_args(parser)
+    args = parser.parse_args()
+    check_webhook_args(parser, args)
+    return args
 
 
 args = parse_args()
 # Set up the Telegram bot
-bot = Bot(token=args.telegram_token)
-storage = MemoryStorage()
+bot = create_bot(args)
+# Preferences, buffered messages and FSM states live in the state store, shared by all workers
+state = open_state_store(args.state_store)
+storage = StateStoreStorage(state)
 dispatcher = Dispatcher(bot, storage=storage, loop=asyncio.get_event_loop())
+# One pooled HTTP client for all calls to the backend
+backend = BackendClient(args.backend_url)
+# Every call to the Telegram API goes through the rate-aware send queue
+outbox = OutboundScheduler(bot)
 
 # Define a ReplyKeyboardMarkup to show a "start" button
 RESTART_KEYBOARD = types.ReplyKeyboardMarkup(
@@ -57,12 +90,12 @@ def try_(func):
                 pass
             await asyncio.sleep(1)
         if "overloaded with other requests" in error:
-            await bot.send_message(
+            await outbox.send_message(
                 message.from_user.id,
                 "\nPlease, try again later, We are currently under heavy load",
             )
         else:
-            await bot.send_message(
+            await outbox.send_message(
                 message.from_user.id,
                 '\nSomething went wrong, please type "/start" to start over',
             )
@@ -75,18 +108,12 @@ def try_(func):
 @dispatcher.message_handler(commands=["start"])
 async def start(message: types.Message):
     # Show a "typing" action to the user
-    await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
-
-    async with aiohttp.ClientSession() as session:
-        # Example for MESSAGE_ENDPOINT
-        async with session.post(
-                "http://localhost:8000/api/start",
-                json={"message": message.text, "user_id": message.from_user.id},
-        ) as response:
-            result_text = await response.json()
+    await outbox.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
+
+    await backend.post(START_ENDPOINT, {"message": message.text, "user_id": message.from_user.id})
 
     # Send a welcome message with a "start" button
-    await bot.send_message(
+    await outbox.send_message(
         message.from_user.id,
         text=WELCOME_MESSAGE,
         # reply_markup=RESTART_KEYBOARD
@@ -97,18 +124,12 @@ async def start(message: types.Message):
 @dispatcher.message_handler(commands=["delete_my_history"])
 async def delete_history(message: types.Message):
     # Show a "typing" action to the user
-    await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
-
-    async with aiohttp.ClientSession() as session:
-        # Example for MESSAGE_ENDPOINT
-        async with session.post(
-                "http://localhost:8000/api/delete_user_history",
-                json={"message": message.text, "user_id": message.from_user.id},
-        ) as response:
-            result_text = await response.json()
+    await outbox.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
+
+    await backend.post(DELETE_ENDPOINT, {"message": message.text, "user_id": message.from_user.id})
 
     # Send a welcome message with a "start" button
-    await bot.send_message(
+    await outbox.send_message(
         message.from_user.id,
         text="History deleted! Press /start to start a new conversation.",
         # reply_markup=RESTART_KEYBOARD
@@ -118,18 +139,12 @@ async def delete_history(message: types.Message):
 @dispatcher.message_handler(commands=["premium_mode"])
 async def premium_mode(message: types.Message):
     # Show a "typing" action to the user
-    await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
-
-    async with aiohttp.ClientSession() as session:
-        # Example for MESSAGE_ENDPOINT
-        async with session.post(
-                "http://localhost:8000/api/premium_mode",
-                json={"message": message.text, "user_id": message.from_user.id},
-        ) as response:
-            result_text = await response.json()
+    await outbox.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
+
+    await backend.post(PREMIUM_ENDPOINT, {"message": message.text, "user_id": message.from_user.id})
 
     # Send a welcome message with a "start" button
-    await bot.send_message(
+    await outbox.send_message(
         message.from_user.id,
         text="Premium mode enabled!",
         # reply_markup=RESTART_KEYBOARD
@@ -139,37 +154,30 @@ async def premium_mode(message: types.Message):
 @dispatcher.message_handler(commands=["basic_mode"])
 async def basic_mode(message: types.Message):
     # Show a "typing" action to the user
-    await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
-
-    async with aiohttp.ClientSession() as session:
-        # Example for MESSAGE_ENDPOINT
-        async with session.post(
-                "http://localhost:8000/api/basic_mode",
-                json={"message": message.text, "user_id": message.from_user.id},
-        ) as response:
-            result_text = await response.json()
+    await outbox.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
+
+    await backend.post(BASIC_ENDPOINT, {"message": message.text, "user_id": message.from_user.id})
 
     # Send a welcome message with a "start" button
-    await bot.send_message(
+    await outbox.send_message(
         message.from_user.id,
         text="Basic mode enabled!",
         # reply_markup=RESTART_KEYBOARD
     )
-user_buffering_preference = {}
 
 
 @dispatcher.message_handler(commands=['enable_buffering'])
 async def enable_buffering(message: types.Message):
     user_id = message.from_user.id
-    user_buffering_preference[user_id] = True
-    await message.reply("Message buffering is now enabled!")
+    await state.set(BUFFERING_NAMESPACE, user_id, True)
+    await outbox.send_message(user_id, text="Message buffering is now enabled!", reply_to_message_id=message.message_id)
 
 
 @dispatcher.message_handler(commands=['disable_buffering'])
 async def disable_buffering(message: types.Message):
     user_id = message.from_user.id
-    user_buffering_preference[user_id] = False
-    await message.reply("Message buffering is now disabled!")
+    await state.set(BUFFERING_NAMESPACE, user_id, False)
+    await outbox.send_message(user_id, text="Message buffering is now disabled!", reply_to_message_id=message.message_id)
 
 
 @dispatcher.message_handler()
@@ -177,101 +185,110 @@ async def handle_query_command(message: types.Message):
     user_id = message.from_user.id
 
     # Check if the user has a preference set for buffering
-    buffering_enabled = user_buffering_preference.get(user_id, False)
+    buffering_enabled = await state.get(BUFFERING_NAMESPACE, user_id, False)
 
     if buffering_enabled:
-        # Get the current timestamp
-        now = datetime.now()
-
-        # Check if the user already has a message buffer
-        if user_id in user_message_buffers:
-            # Get the previous message buffer for this user
-            buffer_data = user_message_buffers[user_id]
-
-            # Reset the timer for the task (cancel and create a new one)
-            buffer_data["task"].cancel()
-            buffer_data["task"] = asyncio.create_task(process_message_buffer(user_id))
+        # Add the message to the user's buffer, sent once the user stops typing
+        await state.append(MESSAGE_BUFFER_NAMESPACE, user_id, message.text)
+        message_buffers.add(user_id, message.text)
 
-            # Add the current message to the buffer
-            buffer_data["messages"].append(message.text)
-            buffer_data["timestamp"] = now
-        else:
-            # Create a new message buffer for the user
-            user_message_buffers[user_id] = {
-                "messages": [message.text],
-                "timestamp": now,
-                "task": asyncio.create_task(process_message_buffer(user_id))
-            }
-
-        await bot.send_chat_action(user_id, action=types.ChatActions.TYPING)
+        await outbox.send_chat_action(user_id, action=types.ChatActions.TYPING)
     else:
         # If buffering is disabled, send the message immediately to the API
-        await bot.send_chat_action(user_id, action=types.ChatActions.TYPING)
-
-        # Send a request to the FastAPI endpoint to get the most relevant paragraph
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                    "http://localhost:8000/api/message",
-                    json={"message": message.text, "user_id": user_id},
-            ) as response:
-                result_text = await response.json()
-
-        # Send the API response as separate messages to the user
-        num_messages = len(result_text["result"]) // MAX_MESSAGE_LENGTH
-        for i in range(num_messages + 1):
-            await bot.send_chat_action(user_id, action=types.ChatActions.TYPING)
-            await asyncio.sleep(1)
-            await bot.send_message(
-                user_id,
-                text=result_text["result"][i * MAX_MESSAGE_LENGTH: (i + 1) * MAX_MESSAGE_LENGTH],
-            )
+        await outbox.send_chat_action(user_id, action=types.ChatActions.TYPING)
 
+        # Stream the answer of the FastAPI endpoint to the user as it is generated
+        await reply(user_id, message.text)
 
-# Function to process the message buffer and send the API request
-async def process_message_buffer(user_id):
-    # Get the message buffer for the user
-    buffer_data = user_message_buffers[user_id]
 
-    # Get the current timestamp
-    now = datetime.now()
+# Function to send the buffered messages of a user as a single request
+async def process_message_buffer(user_id, messages):
+    # The stored buffer also holds the messages received before a restart
+    messages = await state.take(MESSAGE_BUFFER_NAMESPACE, user_id)
+    if not messages:
+        return
 
-    # Check if the time window has elapsed since the last message in the buffer
-    if now - buffer_data["timestamp"] > timedelta(seconds=MESSAGE_BUFFER_TIME_WINDOW):
-        # Combine the messages into a single request
-        combined_message = "\n".join(buffer_data["messages"])
+    # Combine the messages into a single request
+    combined_message = "\n".join(messages)
 
-        # Send a request to the FastAPI endpoint to get the most relevant paragraph
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                    "http://localhost:8000/api/message",
-                    json={"message": combined_message, "user_id": user_id},
-            ) as response:
-                result_text = await response.json()
+    # Stream the answer of the FastAPI endpoint to the user as it is generated
+    await reply(user_id, combined_message)
 
-        # Send the API response as separate messages to the user
-        num_messages = len(result_text["result"]) // MAX_MESSAGE_LENGTH
-        for i in range(num_messages + 1):
-            await bot.send_chat_action(user_id, action=types.ChatActions.TYPING)
-            await asyncio.sleep(1)
-            await bot.send_message(
-                user_id,
-                text=result_text["result"][i * MAX_MESSAGE_LENGTH: (i + 1) * MAX_MESSAGE_LENGTH],
-            )
 
-        # Clear the user's message buffer after processing
-        del user_message_buffers[user_id]
-    else:
-        # If the time window hasn't elapsed, create a new task to wait for the remaining time
-        buffer_data["task"] = asyncio.create_task(wait_for_time_window(user_id))
+# Buffers the messages of users with buffering enabled until they stop typing
+message_buffers = DebounceScheduler(
+    process_message_buffer,
+    window=MESSAGE_BUFFER_TIME_WINDOW,
+    max_wait=MESSAGE_BUFFER_MAX_WAIT,
+    max_batch=MESSAGE_BUFFER_MAX_SIZE,
+)
+
+
+# Function to send a complete answer as separate messages of at most MAX_MESSAGE_LENGTH characters
+async def send_answer(user_id, text):
+    # The send queue paces the messages, no need to wait between them
+    for i in range(0, len(text), MAX_MESSAGE_LENGTH):
+        await outbox.send_message(user_id, text=text[i: i + MAX_MESSAGE_LENGTH])
+
+
+# Function to show the answer generated so far, editing the messages already sent
+async def show_partial_answer(user_id, text, sent_messages):
+    chunks = [text[i: i + MAX_MESSAGE_LENGTH] for i in range(0, len(text), MAX_MESSAGE_LENGTH)]
+    for i, chunk in enumerate(chunks):
+        # Telegram rejects empty messages
+        if not chunk.strip():
+            break
+        if i < len(sent_messages):
+            sent_message, shown_text = sent_messages[i]
+            if shown_text != chunk:
+                await outbox.edit_message_text(chunk, chat_id=user_id, message_id=sent_message.message_id)
+                sent_messages[i][1] = chunk
+        else:
+            sent_messages.append([await outbox.send_message(user_id, text=chunk), chunk])
+
+
+# Function to stream the API answer to the user, editing the message at most every STREAM_EDIT_INTERVAL seconds
+async def reply(user_id, text):
+    async with backend.stream(MESSAGE_STREAM_ENDPOINT, {"message": text, "user_id": user_id}) as response:
+        if response.content_type != "text/event-stream":
+            # The API answers with plain JSON when it is too busy to stream
+            result_text = await response.json()
+            await send_answer(user_id, result_text["result"])
+            return
+
+        answer = ""
+        sent_messages = []
+        last_update = None
+        async for line in response.content:
+            if not line.startswith(b"data:"):
+                continue
+            event = json.loads(line[len(b"data:"):])
+            answer = event["result"] if event.get("done") else answer + event["token"]
 
+            now = asyncio.get_event_loop().time()
+            if event.get("done") or last_update is None or now - last_update >= STREAM_EDIT_INTERVAL:
+                await show_partial_answer(user_id, answer, sent_messages)
+                last_update = now
 
-# Function to wait for the time window before processing the buffer
-async def wait_for_time_window(user_id):
-    await asyncio.sleep(MESSAGE_BUFFER_TIME_WINDOW)
-    # Process the message buffer after the time window
-    await process_message_buffer(user_id)
+
+async def on_startup(dispatcher: Dispatcher):
+    # Resume the buffers of the users of this worker's shard, see WebhookServer
+    shard_count = len(args.shard_urls) or 1
+    for user_id in await state.keys(MESSAGE_BUFFER_NAMESPACE):
+        if shard_of(user_id, shard_count) == args.shard_index:
+            message_buffers.add(int(user_id), None)
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    # A durable store keeps the buffers for the next start
+    await message_buffers.close(flush_pending=not state.durable)
+    await backend.close()
+    await outbox.close()
 
 
 # Start polling for updates from Telegram
 if __name__ == "__main__":
-    executor.start_polling(dispatcher, skip_updates=False)
+    if args.webhook_url:
+        start_webhook(dispatcher, args, on_startup=on_startup, on_shutdown=on_shutdown)
+    else:
+        executor.start_polling(dispatcher, skip_updates=False, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,178 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set, Tuple
+
+from aiogram import Bot, types
+from aiogram.utils.exceptions import RetryAfter
+
+from rate_limit import TokenBucket
+
+Call = Callable[[], Awaitable[Any]]
+
+# Seconds between two passes dropping the state of idle chats
+SWEEP_INTERVAL = 60.0
+
+
+class _Chat:
+    def __init__(self, bucket: TokenBucket) -> None:
+        self.bucket = bucket
+        self.pending: Deque[Tuple[Call, asyncio.Future]] = deque()
+        self.busy = False
+        self.typing_sent_at = 0.0
+
+
+class OutboundScheduler:
+    """
+    Sends bot messages as fast as Telegram's per-chat and global limits allow.
+
+    Every call is queued per chat and sent as soon as both the chat's token bucket and the
+    global one have budget. Chats with pending messages are served round-robin, so a chat
+    with a long answer cannot starve the others. Calls to the same chat are sent one at a
+    time in order. A 429 response pauses the chat and the global budget for its retry-after
+    period and the call is retried. Typing actions are dropped while the last one is still
+    displayed.
+
+    Args:
+        bot: The bot used to call the Telegram API.
+        global_rate: Calls per second across all chats.
+        chat_rate: Calls per second to a single chat.
+        chat_burst: Calls a single chat may receive back to back.
+        typing_interval: Seconds a typing action stays visible.
+    """
+
+    def __init__(
+            self,
+            bot: Bot,
+            global_rate: float = 30,
+            chat_rate: float = 1,
+            chat_burst: float = 3,
+            typing_interval: float = 4.5,
+    ) -> None:
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.typing_interval = typing_interval
+        self._global = TokenBucket(rate=global_rate, capacity=global_rate)
+        self._chats: Dict[int, _Chat] = {}
+        self._ready: Deque[int] = deque()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._deliveries: Set[asyncio.Task] = set()
+
+    def _chat(self, chat_id: int) -> _Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(TokenBucket(rate=self.chat_rate, capacity=self.chat_burst))
+        return chat
+
+    def _submit(self, chat_id: int, call: Call) -> asyncio.Future:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        chat = self._chat(chat_id)
+        chat.pending.append((call, future))
+        if not chat.busy and len(chat.pending) == 1:
+            self._ready.append(chat_id)
+            self._wakeup.set()
+        return future
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> types.Message:
+        message = await self._submit(chat_id, lambda: self.bot.send_message(chat_id, text=text, **kwargs))
+        # A new message ends the typing indicator, so the next typing action must be sent
+        chat = self._chats.get(chat_id)
+        if chat is not None:
+            chat.typing_sent_at = 0.0
+        return message
+
+    async def edit_message_text(self, text: str, chat_id: int, message_id: int, **kwargs) -> Any:
+        return await self._submit(
+            chat_id, lambda: self.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, **kwargs)
+        )
+
+    async def send_chat_action(self, chat_id: int, action: str = types.ChatActions.TYPING) -> None:
+        chat = self._chat(chat_id)
+        now = time.monotonic()
+        if now - chat.typing_sent_at < self.typing_interval:
+            return
+        chat.typing_sent_at = now
+        await self._submit(chat_id, lambda: self.bot.send_chat_action(chat_id, action=action))
+
+    def _next_chat(self) -> Tuple[Optional[int], float]:
+        # Round-robin over the chats with pending calls, skipping those out of budget
+        shortest_wait = float("inf")
+        for _ in range(len(self._ready)):
+            chat_id = self._ready[0]
+            wait = self._chats[chat_id].bucket.available_in()
+            if not wait:
+                self._ready.popleft()
+                return chat_id, 0.0
+            self._ready.rotate(-1)
+            shortest_wait = min(shortest_wait, wait)
+        return None, shortest_wait
+
+    def _sweep(self) -> None:
+        # Forget idle chats whose state is back to the defaults
+        now = time.monotonic()
+        for chat_id, chat in list(self._chats.items()):
+            if (not chat.busy and not chat.pending and now - chat.typing_sent_at >= self.typing_interval
+                    and not chat.bucket.available_in(self.chat_burst)):
+                del self._chats[chat_id]
+
+    async def _run(self) -> None:
+        last_sweep = time.monotonic()
+        while True:
+            if time.monotonic() - last_sweep > SWEEP_INTERVAL:
+                self._sweep()
+                last_sweep = time.monotonic()
+            self._wakeup.clear()
+            chat_id, wait = self._next_chat()
+            if chat_id is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=min(wait, SWEEP_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._global.acquire()
+            chat = self._chats[chat_id]
+            chat.bucket.try_acquire()
+            chat.busy = True
+            delivery = asyncio.create_task(self._deliver(chat_id, chat))
+            self._deliveries.add(delivery)
+            delivery.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, chat_id: int, chat: _Chat) -> None:
+        call, future = chat.pending.popleft()
+        try:
+            result = await call()
+        except RetryAfter as e:
+            chat.bucket.pause(e.timeout)
+            self._global.pause(e.timeout)
+            chat.pending.appendleft((call, future))
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            chat.busy = False
+            if chat.pending:
+                self._ready.append(chat_id)
+                self._wakeup.set()
+
+    async def close(self) -> None:
+        """
+        Stop sending; calls already sent to Telegram are awaited, calls still queued are cancelled.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._deliveries:
+            await asyncio.gather(*self._deliveries, return_exceptions=True)
+        for chat in self._chats.values():
+            for _, future in chat.pending:
+                future.cancel()
+        self._chats.clear()
+        self._ready.clear()
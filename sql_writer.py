@@ -1,12 +1,49 @@
 import datetime
 import json
 import os
+import uuid
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Dict, Iterator
 
 import psycopg2
 
 from psycopg2 import extensions
+from psycopg2.extras import execute_values
+
+from migrations import check_migrations
+
+# Number of checkpoint messages stored outside the snapshot before a checkpoint is compacted
+CHECKPOINT_COMPACT_EVERY = 50
+
+# The buffer of the checkpoint row c: the live part of its snapshot followed by its newer messages
+CHECKPOINT_BUFFER_SQL = """
+    COALESCE((
+        SELECT jsonb_agg(e.message ORDER BY e.position)
+        FROM jsonb_array_elements(c.history) WITH ORDINALITY AS e(message, position)
+        WHERE c.snapshot_start + e.position - 1 >= c.history_start
+    ), '[]'::jsonb) || COALESCE((
+        SELECT jsonb_agg(m.message ORDER BY m.seq)
+        FROM ConversationCheckpointMessages m
+        WHERE m.user_id = c.user_id AND m.seq >= GREATEST(c.history_start, c.snapshot_end)
+    ), '[]'::jsonb)
+"""
+
+# The subscription of the user %(user_id)s
+SUBSCRIPTION_SQL = "(SELECT subscription_id FROM testpayments WHERE user_id = %(user_id)s LIMIT 1)"
+
+# Columns of the rows returned by get_history_page and iter_history
+HISTORY_EXPORT_COLUMNS = ("id", "user_id", "user_message", "chatbot_message", "timestamp")
+
+# Position of a row in the export order: user_id, timestamp, id
+HistoryKey = Tuple[str, datetime.datetime, int]
+
+
+def history_key(row: tuple) -> HistoryKey:
+    """
+    Return the keyset pagination key of a row with the columns of HISTORY_EXPORT_COLUMNS.
+    """
+    return row[1], row[4], row[0]
 
 
 class SQLHistoryWriter:
@@ -19,6 +56,7 @@ class SQLHistoryWriter:
         user: PostgreSQL Database user.
         password: PostgreSQL Database user password.
         database: PostgreSQL Database name.
+        check_schema: Whether to make sure no migration is pending on connect (default: True).
         **kwargs: Additional arguments to pass to psycopg2.connect.
     """
 
@@ -29,6 +67,7 @@ class SQLHistoryWriter:
             user: str,
             password: str,
             database: str,
+            check_schema: bool = True,
             **kwargs
     ) -> None:
         self._connection = psycopg2.connect(
@@ -49,23 +88,63 @@ class SQLHistoryWriter:
             **kwargs
         }
 
-        self._create_history_table()
-        self._create_checkpoints_table()
-        self._create_payment_table()
-        print("Database Conversations created")
+        if check_schema:
+            # Migrations are applied by `python migrations.py` when deploying, not on connect
+            check_migrations(self._connection)
 
     def _connect(self):
         self._connection = psycopg2.connect(**self._connection_params)
 
+    def close(self) -> None:
+        """
+        Close the underlying database connection.
+        """
+        if not self._connection.closed:
+            self._connection.close()
+
     @property
     def connection(self) -> psycopg2.extensions.connection:
+        # Liveness is only checked by ping(), not on every access
+        if self._connection.closed:
+            self._connect()
+        return self._connection
+
+    def ping(self) -> None:
+        """
+        Check that the server answers, reconnecting once if the connection was lost.
+        """
         try:
-            self._connection.cursor().execute('SELECT 1')
-            return self._connection
-        except psycopg2.InterfaceError:
+            with self.connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            self._connection.rollback()
+        except (psycopg2.InterfaceError, psycopg2.OperationalError):
             self._connection.close()
             self._connect()
-            return self._connection
+
+    def reset(self) -> None:
+        """
+        Roll back the transaction left open by a read or aborted by a failed statement.
+        """
+        connection = self._connection
+        if not connection.closed and connection.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            connection.rollback()
+
+    @contextmanager
+    def _autocommit(self) -> Iterator[psycopg2.extensions.cursor]:
+        """
+        Yield a cursor whose every statement commits on its own, saving the COMMIT round trip.
+        """
+        connection = self.connection
+        if connection.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            # A read left its transaction open
+            connection.rollback()
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                yield cursor
+        finally:
+            if not connection.closed:
+                connection.autocommit = False
 
     @classmethod
     def from_config(cls, file_path: Path) -> "SQLHistoryWriter":
@@ -76,32 +155,16 @@ class SQLHistoryWriter:
             file_path: Path to JSON file.
         """
         data = json.loads(file_path.read_text())
+        # Pool settings are only meaningful for AsyncSQLHistoryWriter
+        data.pop("pool", None)
         return cls(**data)
 
-    def _create_history_table(self) -> None:
-        """
-        Create the ConversationHistory database.
-        """
-        with self._connection.cursor() as cursor:
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS ConversationHistory (
-                id SERIAL PRIMARY KEY,
-                user_id TEXT NOT NULL,                
-                user_message TEXT,
-                chatbot_message TEXT,
-                timestamp TIMESTAMP
-                )
-                """
-            )
-        self._connection.commit()
-
     def write_message(
             self,
             user_id: str,
             user_message: str,
             chatbot_message: str,
-            timestamp: Optional[str] = None,
+            timestamp: Optional[datetime.datetime] = None,
     ) -> None:
         """
         Add a new row to the ConversationHistory table.
@@ -110,36 +173,26 @@ class SQLHistoryWriter:
             user_id: ID of the user who sent the message.
             user_message: Message sent by the user.
             chatbot_message: Message sent by the chatbot.
-            env: Environment where the message was sent (default: PROD_ENV).
-            timestamp: Timestamp for the message.
+            timestamp: Timestamp for the message (default: now).
         """
-        timestamp = (
-            timestamp
-            if timestamp
-            else datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        )
+        self.write_messages([(user_id, user_message, chatbot_message, timestamp or datetime.datetime.now())])
 
-        try:
-            with self._connection.cursor() as cursor:
-                cursor.execute(
-                    """
-                    INSERT INTO ConversationHistory (user_id, user_message, chatbot_message, timestamp)
-                    VALUES (%s, %s, %s, to_timestamp(%s, 'YYYY-MM-DD HH24:MI:SS'))
-                    """,
-                    (
-                        user_id,
-                        user_message,
-                        chatbot_message,
-                        timestamp,
-                    ),
-                )
-            self._connection.commit()
+    def write_messages(self, rows: List[Tuple[str, str, str, datetime.datetime]]) -> None:
+        """
+        Add several rows to the ConversationHistory table with one statement.
 
-        except psycopg2.InterfaceError:
-            self._connection.close()
-            self._connection = psycopg2.connect(**self._connection_params)
-            self.write_message(
-                user_id, user_message, chatbot_message, timestamp
+        Args:
+            rows: Tuples of the user id, user message, chatbot message and time of every message.
+        """
+        with self._autocommit() as cursor:
+            execute_values(
+                cursor,
+                """
+                INSERT INTO ConversationHistory (user_id, user_message, chatbot_message, timestamp)
+                VALUES %s
+                """,
+                rows,
+                page_size=len(rows),
             )
 
     def write_checkpoint(
@@ -149,7 +202,7 @@ class SQLHistoryWriter:
             memory_moving_summary_buffer: str
     ) -> None:
         """
-        Add a new row to the ConversationCheckpoints table or update an existing row.
+        Replace the checkpoint of a user with a new snapshot of the whole buffer.
 
         Parameters:
             user_id (str): The unique identifier of the user.
@@ -165,10 +218,18 @@ class SQLHistoryWriter:
                     """
                     UPDATE ConversationCheckpoints
                 SET history = %s::jsonb,
-                    memory_moving_summary_buffer = %s
+                    memory_moving_summary_buffer = %s,
+                    summary_version = summary_version + 1,
+                    history_start = next_seq,
+                    snapshot_start = next_seq,
+                    snapshot_end = next_seq + %s,
+                    next_seq = next_seq + %s
                 WHERE user_id = %s
                     """,
-                    (history_json, memory_moving_summary_buffer, user_id)
+                    (history_json, memory_moving_summary_buffer, len(history), len(history), user_id)
+                )
+                cursor.execute(
+                    "DELETE FROM ConversationCheckpointMessages WHERE user_id = %s", (user_id,)
                 )
 
             self._connection.commit()
@@ -178,45 +239,134 @@ class SQLHistoryWriter:
             self._connection = psycopg2.connect(**self._connection_params)
             self.write_checkpoint(user_id, history, memory_moving_summary_buffer)
 
-    def _create_checkpoints_table(self) -> None:
+    def load_turn(
+            self,
+            user_id: str,
+            with_subscription: bool = True,
+    ) -> Tuple[Optional[str], List[dict], Optional[str]]:
         """
-        Create the Companions table.
+        Fetch everything a turn needs in one query.
+
+        Args:
+            user_id: The unique identifier of the user.
+            with_subscription: Whether to look up the subscription, e.g. unless it is cached.
+
+        Returns:
+            Tuple[Optional[str], List[dict], Optional[str]]: The subscription id (None if the user has
+            no subscription or with_subscription is False), the buffered messages and the moving summary (None without a checkpoint).
         """
-        with self._connection.cursor() as cursor:
+        with self._autocommit() as cursor:
+            cursor.execute(
+                f"""
+                SELECT
+                    {SUBSCRIPTION_SQL if with_subscription else "NULL"},
+                    checkpoint.history,
+                    checkpoint.memory_moving_summary_buffer
+                FROM (SELECT 1) AS one
+                LEFT JOIN LATERAL (
+                    SELECT {CHECKPOINT_BUFFER_SQL} AS history, c.memory_moving_summary_buffer
+                    FROM ConversationCheckpoints c
+                    WHERE c.user_id = %(user_id)s
+                    LIMIT 1
+                ) checkpoint ON true
+                """,
+                {"user_id": user_id}
+            )
+            subscription_id, history, summary = cursor.fetchone()
+        return subscription_id, history or [], summary
+
+    def save_turn(
+            self,
+            user_id: str,
+            pruned: int,
+            messages: List[dict],
+            memory_moving_summary_buffer: Optional[str],
+            compact_every: int = CHECKPOINT_COMPACT_EVERY,
+    ) -> Optional[int]:
+        """
+        Persist the checkpoint changes of a turn with one statement; its history row is written
+        separately, see HistoryQueue.
+
+        The statement commits on its own, so the turn costs a single round trip; the checkpoint
+        compaction runs in a second transaction when it is due.
+
+        Args:
+            user_id: The unique identifier of the user.
+            pruned: Number of messages removed from the front of the stored buffer.
+            messages: Messages added to the end of the buffer.
+            memory_moving_summary_buffer: The new summary, or None if it did not change.
+            compact_every: Number of messages outside the snapshot that triggers a compaction.
+
+        Returns:
+            Optional[int]: The id of the checkpoint row, or None if the user has no checkpoint.
+        """
+        with self._autocommit() as cursor:
             cursor.execute(
                 """
-                CREATE TABLE IF NOT EXISTS ConversationCheckpoints (
-                    id SERIAL PRIMARY KEY,
-                    user_id TEXT,                    
-                    history JSONB,
-                    memory_moving_summary_buffer TEXT                              
+                WITH checkpoint AS (
+                    UPDATE ConversationCheckpoints
+                    SET history_start = history_start + %(pruned)s,
+                        next_seq = next_seq + %(count)s,
+                        memory_moving_summary_buffer = COALESCE(%(summary)s, memory_moving_summary_buffer),
+                        summary_version = summary_version + (%(summary)s::text IS NOT NULL)::int
+                    WHERE user_id = %(user_id)s
+                    RETURNING id, next_seq - %(count)s AS first_seq, next_seq - snapshot_end AS unsnapshotted
+                ), new_messages AS (
+                    INSERT INTO ConversationCheckpointMessages (user_id, seq, message)
+                    SELECT %(user_id)s, checkpoint.first_seq + m.position - 1, m.message
+                    FROM checkpoint, jsonb_array_elements(%(messages)s::jsonb) WITH ORDINALITY AS m(message, position)
                 )
-                """
+                SELECT id, unsnapshotted FROM checkpoint
+                """,
+                {
+                    "user_id": user_id,
+                    "pruned": pruned,
+                    "count": len(messages),
+                    "messages": json.dumps(messages),
+                    "summary": memory_moving_summary_buffer,
+                }
             )
-        self._connection.commit()
+            result = cursor.fetchone()
+        if result is None:
+            return None
+        checkpoint_id, unsnapshotted = result
+        if unsnapshotted >= compact_every:
+            self.compact_checkpoint(user_id)
+        return checkpoint_id
+
+    @staticmethod
+    def _compact_checkpoint(cursor, user_id: str) -> None:
+        # The SET expressions all see the row as it was before the update
+        cursor.execute(
+            f"""
+            UPDATE ConversationCheckpoints c
+            SET history = {CHECKPOINT_BUFFER_SQL},
+                snapshot_start = c.history_start,
+                snapshot_end = c.next_seq
+            WHERE c.user_id = %s
+            """,
+            (user_id,)
+        )
+        cursor.execute(
+            """
+            DELETE FROM ConversationCheckpointMessages m
+            USING ConversationCheckpoints c
+            WHERE m.user_id = %s AND c.user_id = m.user_id AND m.seq < c.snapshot_end
+            """,
+            (user_id,)
+        )
 
-    def _create_payment_table(self) -> None:
+    def compact_checkpoint(self, user_id: str) -> None:
         """
-        Create the payment table.
+        Fold the message rows of a user's checkpoint into its snapshot and drop pruned messages.
         """
         with self._connection.cursor() as cursor:
-            create_table_query = '''
-                CREATE TABLE IF NOT EXISTS payment (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    client_secret VARCHAR(255) NOT NULL,
-                    client_email VARCHAR(255) NOT NULL,
-                    subscription_id VARCHAR(255) NOT NULL,
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
-                    updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
-                )
-            '''
-            cursor.execute(create_table_query)
+            self._compact_checkpoint(cursor, user_id)
         self._connection.commit()
 
     def create_new_user(self, user_id) -> None:
         """
-        Create a new user in the database.
+        Create a new user in the database, keeping the checkpoint of an existing one.
         """
         try:
             with self._connection.cursor() as cursor:
@@ -232,6 +382,7 @@ class SQLHistoryWriter:
                             %(history)s,
                             %(memory_moving_summary_buffer)s                            
                         )
+                        ON CONFLICT (user_id) DO NOTHING
                         """,
                     {"user_id": user_id,
                      "history": str([]),
@@ -253,6 +404,8 @@ class SQLHistoryWriter:
                     """
                     DELETE FROM ConversationCheckpoints
                     WHERE user_id = %(user_id)s;
+                    DELETE FROM ConversationCheckpointMessages
+                    WHERE user_id = %(user_id)s;
                     """,
                     {"user_id": user_id}
                 )
@@ -263,73 +416,119 @@ class SQLHistoryWriter:
             self.delete_user_history(user_id)
 
 
-    def get_all_messages_companions(self):
+    def _iter_query(self, query: str, params: tuple = (), fetch_size: int = 2000) -> Iterator[tuple]:
         """
-        Returns a list of all messages in the ConversationHistory table.
+        Yield the rows of a query from a server-side cursor, fetch_size rows per round trip.
+
+        The rows are read from one snapshot in a transaction that stays open until the
+        generator is exhausted or closed, so the connection must not be used meanwhile.
         """
-        with self._connection.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT * FROM Companions
-                """
-            )
-            rows = cursor.fetchall()
-        return rows
+        connection = self.connection
+        if connection.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            connection.rollback()
+        try:
+            with connection.cursor(name=f"export_{uuid.uuid4().hex}") as cursor:
+                cursor.itersize = fetch_size
+                cursor.execute(query, params)
+                yield from cursor
+        finally:
+            if not connection.closed:
+                connection.rollback()
+
+    def get_all_messages_companions(self, fetch_size: int = 2000) -> Iterator[tuple]:
+        """
+        Yield all messages in the Companions table, see _iter_query.
+        """
+        return self._iter_query("SELECT * FROM Companions", fetch_size=fetch_size)
 
-    def get_all_messages(self):
+    def get_all_messages(self, fetch_size: int = 2000) -> Iterator[tuple]:
         """
-        Returns a list of all messages in the ConversationHistory table.
+        Yield all messages in the ConversationHistory table, see _iter_query.
         """
-        with self._connection.cursor() as cursor:
+        return self._iter_query("SELECT * FROM ConversationHistory", fetch_size=fetch_size)
+
+    def get_history_page(
+            self,
+            user_id: Optional[str] = None,
+            after: Optional[HistoryKey] = None,
+            limit: int = 1000,
+    ) -> List[tuple]:
+        """
+        Fetch a page of ConversationHistory rows in (user_id, timestamp, id) order.
+
+        Every page is a short query that seeks in the (user_id, timestamp, id) index, so an
+        export holds no transaction open between pages and can resume from any row.
+
+        Args:
+            user_id: Only fetch the rows of this user (default: all users).
+            after: Key (user_id, timestamp, id) of the last row of the previous page.
+            limit: Maximum number of rows of the page.
+
+        Returns:
+            List[tuple]: Rows with the columns of HISTORY_EXPORT_COLUMNS.
+        """
+        conditions, params = [], []
+        if user_id is not None:
+            conditions.append("user_id = %s")
+            params.append(user_id)
+        if after is not None:
+            conditions.append("(user_id, timestamp, id) > (%s, %s, %s)")
+            params.extend(after)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._autocommit() as cursor:
             cursor.execute(
-                """
-                SELECT * FROM ConversationHistory
-                """
+                f"""
+                SELECT {', '.join(HISTORY_EXPORT_COLUMNS)}
+                FROM ConversationHistory
+                {where}
+                ORDER BY user_id, timestamp, id
+                LIMIT %s
+                """,
+                (*params, limit)
             )
-            rows = cursor.fetchall()
-        return rows
+            return cursor.fetchall()
+
+    def iter_history(
+            self,
+            user_id: Optional[str] = None,
+            after: Optional[HistoryKey] = None,
+            page_size: int = 1000,
+    ) -> Iterator[tuple]:
+        """
+        Yield ConversationHistory rows page by page, see get_history_page.
+        """
+        while True:
+            rows = self.get_history_page(user_id, after, page_size)
+            yield from rows
+            if len(rows) < page_size:
+                return
+            after = history_key(rows[-1])
 
     def get_chat_history(
             self,
-            user_id: int
+            user_id: str
     ) -> List[dict]:
         """
-        Retrieve the chat history for a given conversation_id and user_id.
+        Retrieve the chat history of a user.
 
         Args:
-            conversation_id: Unique ID for the conversation.
             user_id: ID of the user.
 
         Returns:
-            A list of tuples, where each tuple represents a message in the conversation.
-            The tuple contains the following fields:
-            - user_id: ID of the user who sent the message.
-            - message: The text of the message.
-            - is_user: True if the message was sent by the user, False if sent by the chatbot.
-            - timestamp: The timestamp of the message.
+            A list of dicts, one per message in chronological order, with the fields
+            conversation_id (the id of the row), user_id, user_message, chatbot_message and
+            timestamp.
         """
-
-        messages = []
-        with self._connection.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT user_id, user_message, chatbot_message, timestamp
-                FROM ConversationHistory
-                WHERE user_id = %s
-                ORDER BY timestamp ASC
-                """,
-                (user_id)
-            )
-            rows = cursor.fetchall()
-            for row in rows:
-                messages.append({
-                    "conversation_id": row[0],
-                    "user_id": row[1],
-                    "user_message": row[2],
-                    "chatbot_message": row[3],
-                    "timestamp": row[4].strftime("%Y-%m-%d %H:%M:%S")
-                })
-            return messages
+        return [
+            {
+                "conversation_id": row[0],
+                "user_id": row[1],
+                "user_message": row[2],
+                "chatbot_message": row[3],
+                "timestamp": row[4].strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            for row in self.iter_history(str(user_id))
+        ]
 
     def get_message_count_by_user_id(
             self,
@@ -394,9 +593,9 @@ class SQLHistoryWriter:
         """
         with self._connection.cursor() as cursor:
             cursor.execute(
-                """
-                SELECT history, memory_moving_summary_buffer
-                FROM ConversationCheckpoints
+                f"""
+                SELECT {CHECKPOINT_BUFFER_SQL}, memory_moving_summary_buffer
+                FROM ConversationCheckpoints c
                 WHERE user_id = %s
                 """,
                 (user_id,)
@@ -410,6 +609,66 @@ class SQLHistoryWriter:
         else:
             return [], None  # If user_id not found, return an empty list and None for memory_moving_summary_buffer
 
+    def get_summary(self, user_id: str, checkpoint_id: int) -> Tuple[Optional[str], Optional[int]]:
+        """
+        Get the moving summary of a user's checkpoint with its version.
+
+        Args:
+            user_id: The unique identifier of the user.
+            checkpoint_id: The id of the checkpoint row, as returned by save_turn.
+
+        Returns:
+            Tuple[Optional[str], Optional[int]]: The summary and its summary_version, or (None, None)
+            if the checkpoint was deleted, even if the user started a new one since.
+        """
+        with self._autocommit() as cursor:
+            cursor.execute(
+                """
+                SELECT memory_moving_summary_buffer, summary_version
+                FROM ConversationCheckpoints
+                WHERE user_id = %s AND id = %s
+                """,
+                (user_id, checkpoint_id)
+            )
+            result = cursor.fetchone()
+        return result if result else (None, None)
+
+    def write_summary(
+            self,
+            user_id: str,
+            checkpoint_id: int,
+            memory_moving_summary_buffer: str,
+            version: int,
+    ) -> bool:
+        """
+        Replace the moving summary of a user's checkpoint unless it changed since it was read.
+
+        Every write of the summary increments summary_version, so a summary computed from an
+        older version is rejected instead of overwriting newer state. A checkpoint created after
+        the history was deleted has a new id and starts again at version 0, so the id is
+        compared as well.
+
+        Args:
+            user_id: The unique identifier of the user.
+            checkpoint_id: The id of the checkpoint row the summary was read from.
+            memory_moving_summary_buffer: The new summary.
+            version: The summary_version returned by get_summary with the summary it extends.
+
+        Returns:
+            bool: Whether the summary was written.
+        """
+        with self._autocommit() as cursor:
+            cursor.execute(
+                """
+                UPDATE ConversationCheckpoints
+                SET memory_moving_summary_buffer = %s,
+                    summary_version = summary_version + 1
+                WHERE user_id = %s AND id = %s AND summary_version = %s
+                """,
+                (memory_moving_summary_buffer, user_id, checkpoint_id, version)
+            )
+            return cursor.rowcount == 1
+
     def get_subscription_id(self, user_id: str) -> Optional[str]:
         try:
             with self._connection.cursor() as cursor:
@@ -487,4 +746,39 @@ class SQLHistoryWriter:
         except psycopg2.InterfaceError:
             self._connection.close()
             self._connection = psycopg2.connect(**self._connection_params)
-            return self.add_new_user_with_basic_subscription(user_id)
\ No newline at end of file
+            return self.add_new_user_with_basic_subscription(user_id)
+
+    def get_message_quota(self, user_id: str) -> int:
+        """
+        Get the number of messages counted against the free quota of a user.
+        """
+        with self._connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT message_count FROM MessageQuota
+                WHERE user_id = %s
+                """,
+                (user_id,),
+            )
+            result = cursor.fetchone()
+        return result[0] if result else 0
+
+    def add_message_quotas(self, counts: Dict[str, int]) -> None:
+        """
+        Add message counts to the quota of several users in one statement.
+
+        Args:
+            counts: Number of new messages of every user.
+        """
+        with self._connection.cursor() as cursor:
+            execute_values(
+                cursor,
+                """
+                INSERT INTO MessageQuota (user_id, message_count)
+                VALUES %s
+                ON CONFLICT (user_id) DO UPDATE
+                SET message_count = MessageQuota.message_count + EXCLUDED.message_count, updated_at = now()
+                """,
+                list(counts.items()),
+            )
+        self._connection.commit()
@@ -0,0 +1,366 @@
+import asyncio
+import functools
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from aiogram.dispatcher.storage import BaseStorage
+
+
+class StateStore(ABC):
+    """
+    Key-value state of the bot shared by its workers, with values stored as JSON.
+
+    Keys are grouped in namespaces, e.g. one namespace per user setting. Besides plain values,
+    a key can hold a list of items that are appended one by one and taken all at once, which
+    is what message buffers need.
+    """
+
+    # Whether the state survives a restart of the bot
+    durable = True
+
+    @abstractmethod
+    async def get(self, namespace: str, key: Any, default: Any = None) -> Any:
+        """
+        Return the value of a key, or default if it has none.
+        """
+
+    @abstractmethod
+    async def set(self, namespace: str, key: Any, value: Any) -> None:
+        """
+        Store the value of a key.
+        """
+
+    @abstractmethod
+    async def delete(self, namespace: str, key: Any) -> None:
+        """
+        Remove the value and the items of a key.
+        """
+
+    @abstractmethod
+    async def append(self, namespace: str, key: Any, item: Any) -> None:
+        """
+        Append an item to the list of a key.
+        """
+
+    @abstractmethod
+    async def take(self, namespace: str, key: Any) -> List[Any]:
+        """
+        Remove and return the items of a key, oldest first.
+        """
+
+    @abstractmethod
+    async def keys(self, namespace: str) -> List[str]:
+        """
+        Return the keys of a namespace that hold a value or items.
+        """
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryStateStore(StateStore):
+    """
+    A StateStore kept in the process; it is lost on restart and not shared between workers.
+    """
+
+    durable = False
+
+    def __init__(self) -> None:
+        self._values: Dict[str, Dict[str, Any]] = {}
+        self._items: Dict[str, Dict[str, List[Any]]] = {}
+
+    async def get(self, namespace: str, key: Any, default: Any = None) -> Any:
+        return self._values.get(namespace, {}).get(str(key), default)
+
+    async def set(self, namespace: str, key: Any, value: Any) -> None:
+        self._values.setdefault(namespace, {})[str(key)] = value
+
+    async def delete(self, namespace: str, key: Any) -> None:
+        self._values.get(namespace, {}).pop(str(key), None)
+        self._items.get(namespace, {}).pop(str(key), None)
+
+    async def append(self, namespace: str, key: Any, item: Any) -> None:
+        self._items.setdefault(namespace, {}).setdefault(str(key), []).append(item)
+
+    async def take(self, namespace: str, key: Any) -> List[Any]:
+        return self._items.get(namespace, {}).pop(str(key), [])
+
+    async def keys(self, namespace: str) -> List[str]:
+        return list(set(self._values.get(namespace, {})) | set(self._items.get(namespace, {})))
+
+
+class SQLStateStore(StateStore):
+    """
+    A StateStore in two SQL tables, used through a single connection on a worker thread.
+
+    Subclasses open the connection and set the parameter style of their driver.
+    """
+
+    PARAMETER = "?"
+    ITEMS_TABLE = ""
+
+    def __init__(self) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-store")
+        self._connection = None
+
+    @abstractmethod
+    def _connect(self):
+        """
+        Open the connection to the database.
+        """
+
+    def _execute(self, query: str, params: tuple = (), fetch: bool = False) -> Optional[list]:
+        if self._connection is None:
+            self._connection = self._connect()
+            self._create_tables()
+        cursor = self._connection.cursor()
+        try:
+            cursor.execute(query.replace("?", self.PARAMETER), params)
+            rows = cursor.fetchall() if fetch else None
+            self._connection.commit()
+            return rows
+        except Exception:
+            if getattr(self._connection, "closed", False):
+                # The server went away; reconnect on the next call
+                self._connection = None
+            else:
+                self._connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def _create_tables(self) -> None:
+        self._execute(
+            """
+            CREATE TABLE IF NOT EXISTS BotState (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+            """
+        )
+        self._execute(self.ITEMS_TABLE)
+        self._execute("CREATE INDEX IF NOT EXISTS BotStateItems_key ON BotStateItems (namespace, key, id)")
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    async def get(self, namespace: str, key: Any, default: Any = None) -> Any:
+        rows = await self._call(
+            self._execute, "SELECT value FROM BotState WHERE namespace = ? AND key = ?", (namespace, str(key)), True
+        )
+        return json.loads(rows[0][0]) if rows else default
+
+    async def set(self, namespace: str, key: Any, value: Any) -> None:
+        await self._call(
+            self._execute,
+            "INSERT INTO BotState (namespace, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value",
+            (namespace, str(key), json.dumps(value)),
+        )
+
+    def _delete(self, namespace: str, key: str) -> None:
+        self._execute("DELETE FROM BotState WHERE namespace = ? AND key = ?", (namespace, key))
+        self._execute("DELETE FROM BotStateItems WHERE namespace = ? AND key = ?", (namespace, key))
+
+    async def delete(self, namespace: str, key: Any) -> None:
+        await self._call(self._delete, namespace, str(key))
+
+    async def append(self, namespace: str, key: Any, item: Any) -> None:
+        await self._call(
+            self._execute,
+            "INSERT INTO BotStateItems (namespace, key, value) VALUES (?, ?, ?)",
+            (namespace, str(key), json.dumps(item)),
+        )
+
+    async def take(self, namespace: str, key: Any) -> List[Any]:
+        # A single DELETE ... RETURNING, so items appended meanwhile are either taken or kept
+        rows = await self._call(
+            self._execute,
+            "DELETE FROM BotStateItems WHERE namespace = ? AND key = ? RETURNING id, value",
+            (namespace, str(key)),
+            True,
+        )
+        return [json.loads(value) for _, value in sorted(rows)]
+
+    async def keys(self, namespace: str) -> List[str]:
+        rows = await self._call(
+            self._execute,
+            "SELECT key FROM BotState WHERE namespace = ? UNION SELECT key FROM BotStateItems WHERE namespace = ?",
+            (namespace, namespace),
+            True,
+        )
+        return [key for key, in rows]
+
+    async def close(self) -> None:
+        if self._connection is not None:
+            await self._call(self._connection.close)
+            self._connection = None
+        self._executor.shutdown(wait=False)
+
+
+class SQLiteStateStore(SQLStateStore):
+    """
+    A StateStore in a SQLite file, shared by the bot workers of one host.
+
+    Args:
+        path: Path of the database file.
+    """
+
+    ITEMS_TABLE = """
+        CREATE TABLE IF NOT EXISTS BotStateItems (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL
+        )
+    """
+
+    def __init__(self, path: Path) -> None:
+        super().__init__()
+        self.path = Path(path)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        # Readers in other workers do not block writers
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+
+class PostgresStateStore(SQLStateStore):
+    """
+    A StateStore in the PostgreSQL database of the backend, shared by bot workers on any host.
+
+    Args:
+        **kwargs: Arguments to pass to psycopg2.connect.
+    """
+
+    PARAMETER = "%s"
+    ITEMS_TABLE = """
+        CREATE TABLE IF NOT EXISTS BotStateItems (
+            id BIGSERIAL PRIMARY KEY,
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL
+        )
+    """
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__()
+        self._connection_params = kwargs
+
+    @classmethod
+    def from_config(cls, file_path: Path) -> "PostgresStateStore":
+        """
+        Load the database configuration from the JSON file of SQLHistoryWriter.
+
+        Args:
+            file_path: Path to JSON file.
+        """
+        data = json.loads(Path(file_path).read_text())
+        data.pop("pool", None)
+        return cls(**data)
+
+    def _connect(self):
+        import psycopg2
+
+        return psycopg2.connect(**self._connection_params)
+
+
+def open_state_store(spec: str) -> StateStore:
+    """
+    Create a StateStore from a command line value.
+
+    Args:
+        spec: "memory", "sqlite:<database file>" or "postgres:<SQL config file>".
+    """
+    kind, _, location = spec.partition(":")
+    if kind == "memory":
+        return MemoryStateStore()
+    if kind == "sqlite" and location:
+        return SQLiteStateStore(Path(location))
+    if kind == "postgres" and location:
+        return PostgresStateStore.from_config(Path(location))
+    raise ValueError(f"Unknown state store {spec!r}, expected memory, sqlite:<file> or postgres:<config>")
+
+
+class StateStoreStorage(BaseStorage):
+    """
+    FSM storage of aiogram keeping the state, data and bucket of every chat and user in a StateStore.
+
+    Args:
+        store: The store holding the records.
+        namespace: Namespace of the records in the store.
+    """
+
+    def __init__(self, store: StateStore, namespace: str = "fsm") -> None:
+        self.store = store
+        self.namespace = namespace
+
+    def _key(self, chat, user) -> str:
+        chat, user = self.check_address(chat=chat, user=user)
+        return f"{chat}:{user}"
+
+    async def _record(self, chat, user) -> dict:
+        return await self.store.get(self.namespace, self._key(chat, user), {})
+
+    async def _update(self, chat, user, **fields) -> None:
+        key = self._key(chat, user)
+        record = await self.store.get(self.namespace, key, {})
+        record.update(fields)
+        if any(record.values()):
+            await self.store.set(self.namespace, key, record)
+        else:
+            await self.store.delete(self.namespace, key)
+
+    async def get_state(self, *, chat=None, user=None, default=None) -> Optional[str]:
+        return (await self._record(chat, user)).get("state") or self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None) -> dict:
+        return (await self._record(chat, user)).get("data") or dict(default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None) -> None:
+        await self._update(chat, user, state=self.resolve_state(state))
+
+    async def set_data(self, *, chat=None, user=None, data=None) -> None:
+        await self._update(chat, user, data=data or {})
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs) -> None:
+        current = await self.get_data(chat=chat, user=user)
+        current.update(data or {}, **kwargs)
+        await self.set_data(chat=chat, user=user, data=current)
+
+    def has_bucket(self) -> bool:
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None) -> dict:
+        return (await self._record(chat, user)).get("bucket") or dict(default or {})
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None) -> None:
+        await self._update(chat, user, bucket=bucket or {})
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs) -> None:
+        current = await self.get_bucket(chat=chat, user=user)
+        current.update(bucket or {}, **kwargs)
+        await self.set_bucket(chat=chat, user=user, bucket=current)
+
+    async def reset_all(self, full: bool = True) -> None:
+        for key in await self.store.keys(self.namespace):
+            if full:
+                await self.store.delete(self.namespace, key)
+            else:
+                record = await self.store.get(self.namespace, key, {})
+                record["state"] = None
+                await self.store.set(self.namespace, key, record)
+
+    async def close(self) -> None:
+        await self.store.close()
+
+    async def wait_closed(self) -> None:
+        pass
@@ -0,0 +1,62 @@
+import asyncio
+import json
+from typing import Any, Awaitable, Callable, List, AsyncIterator
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+
+def sse_event(data: dict) -> str:
+    """
+    Format a dictionary as a server-sent event.
+    """
+    return f"data: {json.dumps(data)}\n\n"
+
+
+class TokenQueueHandler(BaseCallbackHandler):
+    """
+    Forwards the tokens of a streaming LLM, running on a worker thread, to an asyncio queue.
+
+    Args:
+        loop: The event loop owning the queue.
+        queue: Queue receiving every new token.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue) -> None:
+        self.loop = loop
+        self.queue = queue
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, token)
+
+
+async def stream_answer(
+        answer: Callable[[List[BaseCallbackHandler]], Awaitable[dict]]
+) -> AsyncIterator[str]:
+    """
+    Run an answer coroutine and yield its tokens as server-sent events while it runs.
+
+    Every token is sent as {"token": ...}; the last event is {"result": ..., "done": true}
+    with the complete answer, which clients should prefer over the concatenated tokens.
+
+    Args:
+        answer: Called with the callbacks to pass to the chain; returns {"result": ...}.
+    """
+    tokens = asyncio.Queue()
+    task = asyncio.create_task(answer([TokenQueueHandler(asyncio.get_running_loop(), tokens)]))
+    try:
+        while not task.done():
+            next_token = asyncio.create_task(tokens.get())
+            await asyncio.wait({next_token, task}, return_when=asyncio.FIRST_COMPLETED)
+            if next_token.done():
+                yield sse_event({"token": next_token.result()})
+            else:
+                next_token.cancel()
+
+        # Tokens are queued before the worker thread reports completion
+        while not tokens.empty():
+            yield sse_event({"token": tokens.get_nowait()})
+        yield sse_event({"result": task.result()["result"], "done": True})
+    finally:
+        # The client went away; let the answer finish so its turn is still saved
+        if not task.done():
+            task.add_done_callback(lambda t: t.exception())
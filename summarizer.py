@@ -0,0 +1,130 @@
+import asyncio
+from typing import Dict, List, Optional, Set, Tuple, TYPE_CHECKING
+
+from langchain.base_language import BaseLanguageModel
+from langchain.memory import ConversationSummaryMemory
+from langchain.schema import BaseMessage
+
+if TYPE_CHECKING:
+    from async_sql_writer import AsyncSQLHistoryWriter
+
+
+class SummaryWorker:
+    """
+    Folds the messages pruned from the users' buffers into their moving summaries in the background.
+
+    A request hands its pruned messages to submit() and answers without waiting for the summary.
+    Jobs of the same checkpoint run one after the other and jobs submitted meanwhile are merged.
+    A job reads the stored summary with its version, summarises on a worker thread and writes
+    back with write_summary; if the summary changed in between, e.g. another process summarised
+    the same user, the job starts over from the new summary. Jobs are bound to the checkpoint
+    row they were submitted for, so a history deleted meanwhile is never summarised into the
+    user's next conversation.
+
+    Args:
+        llm: Language model writing the summaries, can be cheaper than the one answering.
+        writer: The database pool of the backend.
+        concurrency: Number of summaries computed at the same time.
+        max_attempts: Attempts of a job before its messages are left out of the summary.
+    """
+
+    def __init__(
+            self,
+            llm: BaseLanguageModel,
+            writer: "AsyncSQLHistoryWriter",
+            concurrency: int = 2,
+            max_attempts: int = 3,
+    ) -> None:
+        self.writer = writer
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self._summarizer = ConversationSummaryMemory(llm=llm)
+        self._pending: Dict[Tuple[str, int], List[BaseMessage]] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued: Set[Tuple[str, int]] = set()
+        self._active: Set[Tuple[str, int]] = set()
+        self._tasks: List[asyncio.Task] = []
+        self._written = 0
+        self._conflicts = 0
+        self._failed = 0
+
+    def submit(self, user_id: str, checkpoint_id: int, messages: List[BaseMessage]) -> None:
+        """
+        Queue messages pruned from a user's buffer to be added to the summary of their checkpoint.
+
+        Args:
+            user_id: ID of the user.
+            checkpoint_id: The checkpoint row the messages were pruned from, as returned by save_turn.
+            messages: The pruned messages.
+        """
+        if not messages:
+            return
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+        job = (user_id, checkpoint_id)
+        self._pending.setdefault(job, []).extend(messages)
+        # A checkpoint being summarised is queued again once the running job is done
+        if job not in self._queued and job not in self._active:
+            self._queued.add(job)
+            self._queue.put_nowait(job)
+
+    async def _summarize(self, user_id: str, checkpoint_id: int, messages: List[BaseMessage]) -> None:
+        loop = asyncio.get_running_loop()
+        for _ in range(self.max_attempts):
+            summary, version = await self.writer.get_summary(user_id, checkpoint_id)
+            if version is None:
+                # The history was deleted meanwhile
+                return
+            new_summary = await loop.run_in_executor(
+                None, self._summarizer.predict_new_summary, messages, summary or ""
+            )
+            if await self.writer.write_summary(user_id, checkpoint_id, new_summary, version):
+                self._written += 1
+                return
+            self._conflicts += 1
+        self._failed += 1
+        print(f"Summary of user {user_id} kept changing, {len(messages)} messages were not summarised")
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._queue.get()
+            user_id, checkpoint_id = job
+            self._queued.discard(job)
+            self._active.add(job)
+            try:
+                await self._summarize(user_id, checkpoint_id, self._pending.pop(job, []))
+            except Exception as e:
+                self._failed += 1
+                print(f"Summarising the history of user {user_id} failed: {e}")
+            finally:
+                self._active.discard(job)
+                if job in self._pending:
+                    self._queued.add(job)
+                    self._queue.put_nowait(job)
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._queued),
+            "active": len(self._active),
+            "written": self._written,
+            "conflicts": self._conflicts,
+            "failed": self._failed,
+        }
+
+    async def close(self, timeout: float = 30.0) -> None:
+        """
+        Wait up to timeout seconds for the queued summaries, then stop the workers.
+        """
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"Dropping the summaries of {len(self._pending)} users on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
@@ -8,6 +8,17 @@ def load_roles_from_file(file_path):
     return data["roles"]
 
 
+def index_roles(roles, key: str) -> dict:
+    """
+    Index roles by one of their fields, e.g. "command" or "name", for constant-time lookups.
+    """
+    index = {}
+    for role in roles:
+        # Like a linear search, the first role with a value wins
+        index.setdefault(role[key], role)
+    return index
+
+
 def load_user_roles(user_roles_file: str):
     if os.path.isfile(user_roles_file):
         with open(user_roles_file, "r") as f:
@@ -0,0 +1,282 @@
+import argparse
+import asyncio
+import os
+from typing import Awaitable, Callable, List, Optional, Sequence
+from urllib.parse import urlparse
+
+import aiohttp
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
+from aiohttp import web
+
+# Header carrying the secret token Telegram was given in setWebhook
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+Hook = Callable[[Dispatcher], Awaitable[None]]
+
+
+def add_webhook_args(parser: argparse.ArgumentParser) -> None:
+    """
+    Add the options of the webhook mode to a bot's argument parser.
+    """
+    parser.add_argument(
+        "--webhook_url", help="Public URL Telegram sends updates to; polls for updates if not set", type=str,
+        default=os.environ.get("WEBHOOK_URL")
+    )
+    parser.add_argument("--webhook_host", help="Address the webhook server listens on", type=str, default="0.0.0.0")
+    parser.add_argument("--webhook_port", help="Port the webhook server listens on", type=int, default=8080)
+    parser.add_argument("--webhook_workers", help="Updates processed in parallel", type=int, default=64)
+    parser.add_argument("--webhook_queue", help="Updates waiting per worker", type=int, default=100)
+    parser.add_argument(
+        "--webhook_secret", help="Secret token Telegram sends with every update", type=str,
+        default=os.environ.get("WEBHOOK_SECRET")
+    )
+    parser.add_argument(
+        "--telegram_api", help="Base URL of the Telegram Bot API, e.g. a local fake for load tests", type=str,
+        default=None
+    )
+    parser.add_argument(
+        "--shard_urls", help="Webhook URLs of all bot workers in shard order, reachable from each other; "
+                             "updates of the users of another shard are forwarded to its worker",
+        type=str, nargs="+", default=[]
+    )
+    parser.add_argument("--shard_index", help="Index of this worker in --shard_urls", type=int, default=0)
+
+
+def check_webhook_args(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    """
+    Reject option combinations of add_webhook_args that cannot work.
+    """
+    if args.shard_urls and not args.webhook_url:
+        # Only one getUpdates poller is allowed per bot token
+        parser.error("--shard_urls needs the webhook mode, set --webhook_url")
+    if args.shard_urls and not 0 <= args.shard_index < len(args.shard_urls):
+        parser.error(f"--shard_index must be below the number of --shard_urls ({len(args.shard_urls)})")
+
+
+def shard_of(user_id: int, shard_count: int) -> int:
+    """
+    Return the bot worker responsible for a user when running shard_count workers.
+    """
+    return int(user_id) % shard_count
+
+
+def create_bot(args: argparse.Namespace) -> Bot:
+    """
+    Create the bot of the given token, talking to the Bot API given with --telegram_api if any.
+    """
+    if args.telegram_api:
+        return Bot(token=args.telegram_token, server=TelegramAPIServer.from_base(args.telegram_api))
+    return Bot(token=args.telegram_token)
+
+
+def chat_key(update: types.Update) -> int:
+    """
+    Return the id of the chat an update belongs to, or the update id if it has none.
+    """
+    message = update.message or update.edited_message or update.channel_post or update.edited_channel_post
+    if message is not None:
+        return message.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    for name in ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query",
+                 "my_chat_member", "chat_member", "chat_join_request"):
+        event = getattr(update, name, None)
+        if event is not None:
+            return event.from_user.id
+    return update.update_id
+
+
+class WebhookServer:
+    """
+    Receives Telegram updates on a local HTTP server and processes them on a pool of workers.
+
+    Updates are partitioned by chat over the workers, so the updates of one chat are processed
+    in order while different chats are processed in parallel.
+
+    With several bot processes, each one owns the users of its shard. Telegram sends every
+    update to the one public webhook URL, e.g. a load balancer in front of the processes; an
+    update received by a process that does not own its user is forwarded to the owner, so the
+    state of a user is only ever changed by one process. Every worker has a bounded queue:
+    when the handlers, e.g. the backend, are slower than the incoming updates, the queue fills
+    up and the webhook answers 503 after `enqueue_timeout` seconds so Telegram delivers the
+    update again later.
+
+    Args:
+        dispatcher: The dispatcher whose handlers process the updates.
+        webhook_url: Public URL Telegram sends updates to.
+        host: Address the server listens on.
+        port: Port the server listens on.
+        workers: Number of updates processed in parallel.
+        queue_size: Updates waiting per worker.
+        secret_token: Secret token registered with Telegram and checked on every update.
+        enqueue_timeout: Seconds an update may wait for room in a full queue.
+        shard_urls: Webhook URLs of all bot processes in shard order, empty for a single process.
+        shard_index: Index of this process in shard_urls.
+    """
+
+    def __init__(
+            self,
+            dispatcher: Dispatcher,
+            webhook_url: str,
+            host: str = "0.0.0.0",
+            port: int = 8080,
+            workers: int = 64,
+            queue_size: int = 100,
+            secret_token: Optional[str] = None,
+            enqueue_timeout: float = 10.0,
+            shard_urls: Sequence[str] = (),
+            shard_index: int = 0,
+    ) -> None:
+        self.dispatcher = dispatcher
+        self.webhook_url = webhook_url
+        self.path = urlparse(webhook_url).path or "/"
+        self.host = host
+        self.port = port
+        self.secret_token = secret_token
+        self.enqueue_timeout = enqueue_timeout
+        self.shard_urls = list(shard_urls)
+        self.shard_index = shard_index
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._workers: List[asyncio.Task] = []
+        self._runner: Optional[web.AppRunner] = None
+        self.received = 0
+        self.rejected = 0
+        self.forwarded = 0
+
+    async def _receive(self, request: web.Request) -> web.Response:
+        if self.secret_token is not None and request.headers.get(SECRET_TOKEN_HEADER) != self.secret_token:
+            raise web.HTTPUnauthorized()
+        data = await request.json()
+        update = types.Update.to_object(data)
+        key = chat_key(update)
+        if self.shard_urls:
+            shard = shard_of(key, len(self.shard_urls))
+            if shard != self.shard_index:
+                return await self._forward(self.shard_urls[shard], data)
+        queue = self._queues[key % len(self._queues)]
+        try:
+            await asyncio.wait_for(queue.put(update), timeout=self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise web.HTTPServiceUnavailable()
+        self.received += 1
+        return web.Response()
+
+    async def _forward(self, url: str, data: dict) -> web.Response:
+        headers = {SECRET_TOKEN_HEADER: self.secret_token} if self.secret_token is not None else {}
+        try:
+            async with self._session.post(url, json=data, headers=headers) as response:
+                status = response.status
+        except aiohttp.ClientError as e:
+            # Telegram delivers the update again later
+            print(f"Forwarding update {data.get('update_id')} to {url} failed: {e}")
+            self.rejected += 1
+            raise web.HTTPServiceUnavailable()
+        if status == 200:
+            self.forwarded += 1
+        return web.Response(status=status)
+
+    async def _work(self, queue: asyncio.Queue) -> None:
+        Bot.set_current(self.dispatcher.bot)
+        Dispatcher.set_current(self.dispatcher)
+        while True:
+            update = await queue.get()
+            try:
+                await self.dispatcher.process_update(update)
+            except Exception as e:
+                print(f"Processing update {update.update_id} failed: {e}")
+            finally:
+                queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "received": self.received,
+            "rejected": self.rejected,
+            "forwarded": self.forwarded,
+            "queued": sum(queue.qsize() for queue in self._queues),
+        }
+
+    async def start(self, set_webhook: bool = True) -> None:
+        """
+        Start the workers and the HTTP server, and register the webhook with Telegram.
+        """
+        self._workers = [asyncio.create_task(self._work(queue)) for queue in self._queues]
+        if self.shard_urls:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.enqueue_timeout + 5))
+        app = web.Application()
+        app.router.add_post(self.path, self._receive)
+        app.router.add_get("/stats", lambda request: web.json_response(self.stats()))
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        if set_webhook:
+            options = {"secret_token": self.secret_token} if self.secret_token is not None else {}
+            await self.dispatcher.bot.set_webhook(self.webhook_url, max_connections=100, **options)
+
+    async def stop(self, drain_timeout: float = 30.0) -> None:
+        """
+        Stop accepting updates, let the queued ones finish and stop the workers.
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"{self.stats()['queued']} updates were still queued at shutdown")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def start_webhook(
+        dispatcher: Dispatcher,
+        args: argparse.Namespace,
+        on_startup: Optional[Hook] = None,
+        on_shutdown: Optional[Hook] = None,
+) -> None:
+    """
+    Run a bot in webhook mode until it is interrupted, with the options of add_webhook_args.
+    """
+    server = WebhookServer(
+        dispatcher,
+        args.webhook_url,
+        host=args.webhook_host,
+        port=args.webhook_port,
+        workers=args.webhook_workers,
+        queue_size=args.webhook_queue,
+        secret_token=args.webhook_secret,
+        shard_urls=args.shard_urls,
+        shard_index=args.shard_index,
+    )
+    loop = asyncio.get_event_loop()
+
+    async def startup():
+        await server.start()
+        if on_startup is not None:
+            await on_startup(dispatcher)
+        print(f"Receiving updates on {args.webhook_host}:{args.webhook_port}{server.path}")
+
+    async def shutdown():
+        await server.stop()
+        if on_shutdown is not None:
+            await on_shutdown(dispatcher)
+        await dispatcher.storage.close()
+        await dispatcher.storage.wait_closed()
+        await (await dispatcher.bot.get_session()).close()
+
+    loop.run_until_complete(startup())
+    try:
+        loop.run_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        loop.run_until_complete(shutdown())